@@ -11,13 +11,23 @@
 # later as published by the Python Software Foundation.
 # No warranty expressed or implied. See the file LICENSE.PSF-2 for details.
 
-from lockfile.pidlockfile import PIDLockFile
-
 from . import version
 from . import exceptions
+from . import pidfiles
+from .pidfiles import FlockPidfile, PIDLockFile
 from .background import Daemon
+from .execdaemon import ExecDaemon
+from .handshake import notify_ready
+from .drain import in_flight, shutdown_requested
+from .threadpool import AcceptSource, QueueSource, SpoolSource
+from .sockets import Listener, listening_sockets
 from .launcher import Launcher
+from .asynclauncher import AsyncLauncher
+from .forkserver import ForkServer
+from .termination import TerminationPolicy
+from .workers import RestartPolicy
 from .customLaunchers import BoundLauncher, CLILauncher
+from .fleet import DaemonFleet
 
 __doc__ = version.description
 _version = version.version
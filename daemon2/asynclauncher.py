@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+
+"""Launcher driven by an ``asyncio`` event loop.
+
+`AsyncLauncher` starts, terminates and waits for daemons without blocking
+the calling thread: the status pipe of a starting daemon and the pidfd of
+an exiting one are watched by the event loop (``loop.add_reader``) and the
+timeouts are loop timers, so one control process can operate hundreds of
+daemons concurrently without a thread per operation::
+
+    pid = yield From(launcher.start(daemon, wait_ready=True))
+    report = yield From(launcher.terminate())
+
+The operations are ``trollius`` coroutines and return their tasks.
+``trollius`` is imported by the first `AsyncLauncher` operation, so
+``import daemon2`` does not pay for it.
+"""
+import collections
+import functools
+import logging
+import sys
+import time
+
+from . import (
+    exceptions,
+    handshake,
+    launcher,
+    termination,
+    util,
+    waiter,
+)
+
+log = logging.getLogger(__name__)
+
+def _asyncio():
+    import trollius
+    return trollius
+
+def _newFuture(loop):
+    create = getattr(loop, "create_future", None)
+    if create is not None:
+        return create()
+    return _asyncio().Future(loop=loop)
+
+def _completed(loop, value):
+    future = _newFuture(loop)
+    future.set_result(value)
+    return future
+
+def From(obj):
+    """``trollius.From``, for the coroutines of this module."""
+    return _asyncio().From(obj)
+
+def Return(value=None):
+    """``trollius.Return`` to be raised by the coroutines of this module."""
+    return _asyncio().Return(value)
+
+def _coroutine(func):
+    """ Make the generator method `func` a ``trollius`` coroutine scheduled on the loop of its object.
+
+        Calling the method returns the task. The decorator is applied on
+        the first call, so that ``trollius`` is not imported before.
+        """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        asyncio = _asyncio()
+        return asyncio.ensure_future(asyncio.coroutine(func)(self, *args, **kwargs), loop=self.loop)
+    return wrapper
+
+def poll(loop, predicate, timeout=None):
+    """ Return the future telling whether `predicate()` became true within `timeout` seconds.
+
+        The predicate is checked with a growing period (up to 50 ms) by
+        loop timers.
+        """
+    future = _newFuture(loop)
+    deadline = None if timeout is None else time.time() + timeout
+    state = {"delay": 0.001, "handle": None}
+
+    def _check():
+        state["handle"] = None
+        if future.done():
+            return
+        if predicate():
+            future.set_result(True)
+            return
+        pause = state["delay"]
+        if deadline is not None:
+            pause = min(pause, deadline - time.time())
+            if pause <= 0:
+                future.set_result(False)
+                return
+        state["delay"] = min(state["delay"] * 2, 0.05)
+        state["handle"] = loop.call_later(pause, _check)
+
+    def _onDone(_):
+        if state["handle"] is not None:
+            state["handle"].cancel()
+
+    future.add_done_callback(_onDone)
+    _check()
+    return future
+
+def wait_for_exit(loop, pid, timeout=None):
+    """ Return the future telling whether the process `pid` exited within `timeout` seconds.
+
+        The pidfd of the process is watched by the loop; systems without
+        pidfds get the process probed by `poll`. The process is reaped if
+        it is a child of ours.
+        """
+    try:
+        fd = waiter.pidfd_open(pid)
+    except OSError:
+        return _completed(loop, True)
+    if fd is None:
+        return poll(loop, lambda: waiter.reap(pid) or not waiter.pid_exists(pid), timeout)
+
+    future = _newFuture(loop)
+    state = {"fd": fd, "timer": None}
+
+    def _cleanup(_=None):
+        if state["fd"] is not None:
+            loop.remove_reader(state["fd"])
+            util.close_fd(state["fd"])
+            state["fd"] = None
+        if state["timer"] is not None:
+            state["timer"].cancel()
+            state["timer"] = None
+
+    def _finish(exited):
+        _cleanup()
+        if exited:
+            waiter.reap(pid)
+        if not future.done():
+            future.set_result(exited)
+
+    future.add_done_callback(_cleanup)
+    loop.add_reader(fd, _finish, True)
+    if timeout is not None:
+        state["timer"] = loop.call_later(timeout, _finish, False)
+    return future
+
+class StatusWatcher(object):
+    """ Receives the messages of the `handshake.StatusReader` when the loop finds the pipe readable.
+
+        `handshake.CompletedStatus` is answered right away.
+    """
+
+    def __init__(self, loop, status):
+        super(StatusWatcher, self).__init__()
+        self.loop = loop
+        self.status = status
+        self._pending = collections.deque()
+        self._watching = False
+        self._timer = None
+
+    def waitFor(self, kind, timeout=None):
+        """Return the future of the payload of the message of `kind` (see `handshake.StatusReader.waitFor`)."""
+        future = _newFuture(self.loop)
+        if not hasattr(self.status, "feed"):
+            try:
+                future.set_result(self.status.waitFor(kind))
+            except Exception as exc:
+                future.set_exception(exc)
+            return future
+
+        def _check():
+            while self._pending and not future.done():
+                msg = self._pending.popleft()
+                try:
+                    matched = handshake.expect(kind, msg)
+                except Exception as exc:
+                    self._stop()
+                    future.set_exception(exc)
+                    return
+                if matched:
+                    self._stop()
+                    future.set_result(msg[1])
+
+        def _onReadable():
+            self._pending.extend(self.status.feed())
+            _check()
+
+        def _expired():
+            self._timer = None
+            self._stop()
+            if not future.done():
+                future.set_exception(exceptions.DaemonTimeoutError(
+                    "Daemon did not report {0!r} in {1} seconds.".format(kind, timeout)))
+
+        def _onDone(_):
+            if future.cancelled():
+                self._stop()
+
+        future.add_done_callback(_onDone)
+        _check()
+        if not future.done():
+            self._watching = True
+            self.loop.add_reader(self.status.fd, _onReadable)
+            if timeout is not None:
+                self._timer = self.loop.call_later(timeout, _expired)
+        return future
+
+    def _stop(self):
+        if self._watching:
+            self.loop.remove_reader(self.status.fd)
+            self._watching = False
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def close(self):
+        self._stop()
+        self.status.close()
+
+class AsyncLauncher(launcher.Launcher):
+    """ `launcher.Launcher` whose operations do not block the event loop.
+
+        `start`, `terminate`, `wait`, `restart` and `reload` take the
+        arguments of their blocking counterparts and return futures of
+        `loop` (the current event loop by default). The status checks
+        (`running`, `pid`) are cheap and inherited as they are.
+    """
+
+    def __init__(self, pidfile=None, forkServer=None, requires=(), loop=None):
+        super(AsyncLauncher, self).__init__(pidfile, forkServer, requires)
+        self._loop = loop
+
+    @property
+    def loop(self):
+        return self._loop or _asyncio().get_event_loop()
+
+    @_coroutine
+    def start(self, daemon, wait_ready=False, timeout=None):
+        """Start the daemon; the future resolves to its PID (see `launcher.Launcher.start`)."""
+        token = self._prepareStart()
+        (childPid, watcher) = yield From(self._forkDaemonAsync(daemon, False, token))
+        try:
+            self._setSpawnedPid(childPid, token)
+            if wait_ready and childPid:
+                yield From(watcher.waitFor(handshake.READY, timeout))
+                log.debug("Daemon is ready (pid={}).".format(childPid))
+        finally:
+            watcher.close()
+        raise Return(childPid)
+
+    @_coroutine
+    def _forkDaemonAsync(self, daemon, takeover, token):
+        """Resolves to the daemon PID and the `StatusWatcher` connected to it (see `_forkDaemon`)."""
+        (firstPid, status) = self._spawn(daemon, takeover, token)
+        watcher = StatusWatcher(self.loop, status)
+        excInfo = None
+        try:
+            childPid = yield From(watcher.waitFor(handshake.PID, self.pidTimeout))
+        except:
+            excInfo = sys.exc_info()
+            watcher.close()
+            if not firstPid or isinstance(excInfo[1], _asyncio().CancelledError):
+                if firstPid:
+                    wait_for_exit(self.loop, firstPid, self.pidTimeout)
+                self._startupFailed(takeover, firstPid, excInfo)
+        if excInfo is not None:
+            # The first child holds the reserved lock until it exits.
+            yield From(wait_for_exit(self.loop, firstPid, self.pidTimeout))
+            self._startupFailed(takeover, firstPid, excInfo)
+        if firstPid:
+            # Reaped by the loop once it quits after the second fork.
+            wait_for_exit(self.loop, firstPid, self.pidTimeout)
+        self._noteTimings(status)
+        raise Return((childPid, watcher))
+
+    @_coroutine
+    def terminate(self, block=True, timeout=None, policy=None):
+        """Terminate the daemon; the future resolves to the `termination.TerminationReport`.
+
+        Escalates as `termination.TerminationPolicy.execute` does and fails
+        with `DaemonTimeoutError` if the daemon survives the whole policy
+        (see `launcher.Launcher.terminate`).
+        """
+        (pid, policy) = self._terminationTarget(policy)
+        report = yield From(self._execute(policy, pid, timeout, block))
+        raise Return(self._checkTerminated(report))
+
+    @_coroutine
+    def _execute(self, policy, pid, grace=None, block=True):
+        """Terminate `pid` as `policy.execute` does, waiting on the loop."""
+        steps = policy.steps(pid, block=block, grace=grace)
+        step = next(steps)
+        while not isinstance(step, termination.TerminationReport):
+            exited = yield From(self._waitAll(*step))
+            step = steps.send(exited)
+        raise Return(step)
+
+    @_coroutine
+    def reload(self, daemon, timeout=None, policy=None):
+        """Reload the daemon; the future resolves to the new PID (see `launcher.Launcher.reload`)."""
+        self._unlockPidfile()
+        if not self.running:
+            pid = yield From(self.start(daemon, wait_ready=True, timeout=timeout))
+            raise Return(pid)
+        (oldPid, token) = self._prepareReload()
+        (newPid, watcher) = yield From(self._forkDaemonAsync(daemon, True, token))
+        excInfo = None
+        try:
+            yield From(watcher.waitFor(handshake.READY, timeout))
+        except:
+            excInfo = sys.exc_info()
+        finally:
+            watcher.close()
+        if excInfo is not None:
+            if self._reloadFailed(newPid, oldPid):
+                yield From(self._execute(policy or self.terminationPolicy, newPid))
+            raise excInfo[0], excInfo[1], excInfo[2]
+
+        self._switchOver(newPid, token)
+        report = yield From(self._execute(policy or self.terminationPolicy, oldPid))
+        self._checkTerminated(report, u"Old daemon")
+        log.debug("Daemon reloaded (pid={0} -> {1}).".format(oldPid, newPid))
+        raise Return(newPid)
+
+    @_coroutine
+    def _waitAll(self, pid, pgid, timeout):
+        deadline = time.time() + timeout
+        exited = yield From(wait_for_exit(self.loop, pid, timeout))
+        if exited and pgid:
+            exited = yield From(poll(self.loop, lambda: not termination.group_alive(pgid),
+                max(deadline - time.time(), 0)))
+        raise Return(exited)
+
+    def wait(self, timeout=None):
+        """Return the future telling whether the daemon exited within `timeout` seconds."""
+        pid = self.pid
+        if not pid:
+            return _completed(self.loop, True)
+        return wait_for_exit(self.loop, pid, timeout)
+
+    @_coroutine
+    def restart(self, daemon, wait_ready=False, timeout=None):
+        """Restart the daemon (starting it if it was not running); the future resolves to the new PID."""
+        self._unlockPidfile()
+        if self.running:
+            yield From(self.terminate())
+        pid = yield From(self.start(daemon, wait_ready=wait_ready, timeout=timeout))
+        raise Return(pid)
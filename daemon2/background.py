@@ -5,16 +5,27 @@ import contextlib
 import itertools
 import logging
 import os
-import pty
-import setproctitle
 import signal
 import sys
 import traceback
 
-from . import util
+from . import (
+    drain,
+    eventloop,
+    handshake,
+    memory,
+    pidfiles,
+    signals,
+    sockets,
+    threadpool,
+    util,
+    workers,
+)
 
 log = logging.getLogger(__name__)
 
+(STDIN_FILENO, STDOUT_FILENO, STDERR_FILENO) = (0, 1, 2)
+
 class Daemon(object):
     """Object represending daemons' demonic side.
 
@@ -95,9 +106,11 @@ class Daemon(object):
             * A value of ``None`` will ignore the signal (by setting the
               signal action to ``signal.SIG_IGN``).
 
-            * Any other value will be used as the action for the
-              signal handler. See the ``signal.signal`` documentation
-              for details of the signal handler interface.
+            * Any other value is a callable taking no arguments. It is
+              not called by the signal handler itself but by the signal
+              dispatcher thread, bursts of the signal being coalesced
+              (see `daemon2.signals`). The ``SIGTERM`` handler is called
+              right before the daemon exits.
 
             The default value depends on which signals are defined on the
             running system. Each item from the list below whose signal is
@@ -166,9 +179,136 @@ class Daemon(object):
 
             Dictionary describing logging configuration for the daemon.
             Applied via the `logging.config.dictConfig` call.
+
+        `explicit_ready`
+            :Default: ``False``
+
+            If false, the daemon reports itself ready to the launcher right
+            before `target` is called. If true, `target` is responsible for
+            calling `daemon2.notify_ready` once it is able to serve.
+
+        `workers`
+            :Default: ``None``
+
+            Number of worker processes to pre-fork. If set, the daemon
+            process becomes the master that forks `workers` processes each
+            running `target`, respawns the ones that crash and forwards
+            ``SIGTERM`` to them on shutdown. If ``None``, `target` is
+            executed by the daemon process itself.
+
+        `supervise`
+            :Default: ``False``
+
+            If true (and `workers` is not set), the daemon process
+            supervises a single worker process running `target` and
+            re-forks it whenever it exits abnormally.
+
+        `restart_policy`
+            :Default: ``None``
+
+            `workers.RestartPolicy` instance defining the respawn backoff
+            and the crash loop threshold for the `workers` and `supervise`
+            modes. If ``None``, the default policy is used.
+
+        `listen`
+            :Default: ``()``
+
+            Listening sockets to create on daemon start, before the root
+            directory, the UID and the GID are changed, so that privileged
+            ports can be used by an unprivileged daemon. Elements are
+            `sockets.Listener` instances or ``kind://address`` strings
+            (``tcp://0.0.0.0:80``, ``udp://[::]:53``, ``unix:///run/x.sock``).
+
+            The sockets are kept open, are inherited by the workers and are
+            available to the target via `daemon2.listening_sockets`; their
+            file descriptors are also exported in the ``DAEMON2_LISTEN_FDS``
+            environment variable.
+
+        `fresh_interpreter`
+            :Default: ``False``
+
+            If true, the launcher does not fork itself but executes a new
+            Python interpreter (``python -m daemon2.run``) which imports
+            `target` and becomes the daemon, so the daemon does not inherit
+            the launcher's modules and heap. All the settings of the daemon
+            have to be serializable (see `daemon2.run`); the import costs
+            are reported in `Launcher.startupTimings`.
+
+        `cleanup_timeout`
+            :Default: ``5.0``
+
+            Seconds a coroutine `target` (``async def``) is given to finish
+            its cleanup once ``SIGTERM`` cancelled it. Such target is run on
+            a new event loop by the daemon, and the `signal_map` handlers
+            are called by that loop (see `daemon2.eventloop`).
+
+        `drain_timeout`
+            :Default: ``None``
+
+            Seconds the work in flight is given to finish on ``SIGTERM``.
+            If set, ``SIGTERM`` only sets the `stopping` event (see
+            `daemon2.shutdown_requested`); the daemon exits once the work
+            marked with `daemon2.in_flight` is done, the target returns or
+            the timeout expires, whichever comes first. The drain duration
+            is logged. If ``None``, ``SIGTERM`` raises ``SystemExit`` in
+            the target right away. The termination grace period of the
+            launcher (`TerminationPolicy.grace`) has to be longer.
+
+        `threads`
+            :Default: ``None``
+
+            Number of worker threads. If set, `target` is a handler called
+            with each item of the `source` by one of the threads (see
+            `daemon2.threadpool`); ``SIGTERM`` stops reading the source and
+            drains the items taken, within `drain_timeout` (or
+            `threadpool.DEFAULT_DRAIN_TIMEOUT`). Combined with `workers`,
+            every worker process runs its own pool.
+
+        `source`
+            :Default: ``None``
+
+            Source of the items for the `threads` mode:
+            `threadpool.QueueSource`, `threadpool.AcceptSource`,
+            `threadpool.SpoolSource` or an object with the same interface.
+
+        `queue_size`
+            :Default: ``None``
+
+            Number of items taken from the `source` that may wait for a
+            free thread (twice the number of `threads` if ``None``). The
+            source is not read while the queue is full.
+
+        `preload`
+            :Default: ``()``
+
+            Modules to import (names) and callables to call once by the
+            daemon process, before it reports itself ready and forks the
+            `workers`. The workers share the memory of the loaded modules
+            and data with the master (copy-on-write).
+
+        `gc_freeze`
+            :Default: ``False``
+
+            If true, the garbage is collected after the `preload` and the
+            surviving objects are frozen (``gc.freeze``, Python 3.7+), so
+            that the garbage collections in the workers do not write to
+            the pages shared with the master.
+
+        `gc_threshold`
+            :Default: ``None``
+
+            Collection thresholds (a tuple for ``gc.set_threshold``) set
+            after the `preload`; higher thresholds mean fewer collections
+            touching the shared objects. The memory the workers share with
+            the master is reported by `WorkerPool.memory` and
+            `Launcher.memory` (see `daemon2.memory`).
     """
 
     pidfile = None
+    stage = None # Name of the startup step being executed.
+    signalDispatcher = None # `signals.SignalDispatcher` running the user signal handlers.
+    drainer = None # `drain.Drain` started by ``SIGTERM``.
+    handoffServer = None # `sockets.HandoffServer` serving the `listen` sockets.
 
     def __init__(self, name, target,
         chroot_directory=None,
@@ -183,6 +323,20 @@ class Daemon(object):
         stderr=None,
         signal_map=None,
         logging=None,
+        explicit_ready=False,
+        workers=None,
+        supervise=False,
+        restart_policy=None,
+        listen=(),
+        fresh_interpreter=False,
+        cleanup_timeout=5.0,
+        drain_timeout=None,
+        threads=None,
+        source=None,
+        queue_size=None,
+        preload=(),
+        gc_freeze=False,
+        gc_threshold=None,
     ):
         super(Daemon, self).__init__()
         self.target = target
@@ -206,38 +360,142 @@ class Daemon(object):
 
         self.signal_map = signal_map or {}
         self.loggingConfig = logging
-
-
-    def run(self, pidfile):
-        """Execute the main functionality."""
+        self.explicit_ready = explicit_ready
+        self.workers = workers
+        self.supervise = supervise
+        self.restart_policy = restart_policy
+        self.listen = listen
+        self.listenSockets = []
+        self.fresh_interpreter = fresh_interpreter
+        self.cleanup_timeout = cleanup_timeout
+        self.drain_timeout = drain_timeout
+        if threads and source is None:
+            raise ValueError("The worker thread mode requires the source of the items.")
+        self.threads = threads
+        self.source = source
+        self.queue_size = queue_size
+        self.preload = preload
+        self.gc_freeze = gc_freeze
+        self.gc_threshold = gc_threshold
+
+
+    def run(self, pidfile, status=None, acquirePidfile=True, token=None):
+        """Execute the main functionality.
+
+        `status` is the `handshake.StatusWriter` connected to the launcher.
+        If `acquirePidfile` is false, the pidfile is not locked on start:
+        it was locked before forking (see `launcher.spawn_daemon`) or the
+        launcher hands it over once the daemon is ready (see
+        `Launcher.reload`). `token` is the instance token the launcher
+        generated for the daemon, it is recorded in the pidfile.
+        """
         rc = 255
+        handshake.activate(status)
+        self.stage = u"configureSystem"
         try:
             with self.system():
                 rc = 254
-                with self.pidlock(pidfile):
+                self.stage = u"pidlock"
+                with self.pidlock(pidfile, acquire=acquirePidfile, token=token):
                     rc = 253
+                    self.stage = u"setupLogging"
                     self.setupLogging()
                     log.debug("Daemon started (pid={}).".format(os.getpid()))
+                    self.stage = u"handoff"
+                    self.serveHandoff(pidfile)
+                    self.stage = u"preload"
+                    self.preloadHeap()
+                    self.stage = u"target"
+                    if not self.explicit_ready:
+                        handshake.notify_ready()
                     try:
-                        self.target()
-                        rc = 0
-                    except SystemExit as err:
-                        if err.code == signal.SIGTERM:
-                            # Termination exception is part of correct shutdown sequence.
-                            pass
+                        if self.workers or self.supervise:
+                            pool = workers.WorkerPool(self, self.workers or 1,
+                                restartPolicy=self.restart_policy,
+                                shutdownTimeout=max(10.0, self._drainTimeout() or 0))
+                            rc = pool.run()
                         else:
-                            raise
+                            rc = self.runTarget()
                     finally:
                         log.debug("Daemon terminated.")
+        except:
+            handshake.notify_failure(self.stage)
+            self._dropPidfile(pidfile)
         finally:
             os._exit(rc)
 
+    def _dropPidfile(self, pidfile):
+        """Remove the pidfile locked for this process before `pidlock` took it over.
+
+        The pidfile reserved and stamped by `launcher.spawn_daemon` would
+        name the process that failed to start otherwise.
+        """
+        try:
+            if pidfile and pidfile.read_pid() == os.getpid() and pidfile.i_am_locking():
+                pidfile.release()
+        except Exception:
+            log.exception("Failed to remove the pidfile {0!r}.".format(pidfile))
+
+    def serveHandoff(self, pidfile):
+        """Start handing the `listen` sockets over to the next daemon generation (see `sockets.HandoffServer`)."""
+        path = getattr(pidfile, "path", None)
+        if self.listenSockets and path:
+            keys = [sockets.as_listener(spec).key for spec in self.listen]
+            self.handoffServer = sockets.HandoffServer(path, zip(keys, self.listenSockets))
+            self.handoffServer.start()
+
+    def preloadHeap(self):
+        """Execute the `preload` steps and get the heap ready to be shared with the forks."""
+        for step in self.preload:
+            if callable(step):
+                step()
+            else:
+                __import__(step)
+        if self.gc_freeze or self.gc_threshold:
+            frozen = memory.prepare_fork(freeze=self.gc_freeze, threshold=self.gc_threshold)
+            log.debug("Heap prepared for forking ({0} object(s) frozen).".format(frozen or 0))
+
+    def runTarget(self):
+        """Execute the `target`, return the exit code."""
+        if self.threads:
+            target = threadpool.ThreadPool(self.target, self.source, self.threads, self.queue_size).run
+        elif eventloop.is_coroutine_function(self.target):
+            return eventloop.run(self)
+        else:
+            target = self.target
+        if self._drainTimeout():
+            self.drainer = drain.Drain(self._drainTimeout())
+            self.drainer.arm()
+        try:
+            target()
+            if self.drainer is not None:
+                # The target returned on the stop request; let the rest of the work finish.
+                self.drainer.wait()
+        except SystemExit as err:
+            if err.code == signal.SIGTERM:
+                # Termination exception is part of correct shutdown sequence.
+                pass
+            else:
+                raise
+        finally:
+            if self.drainer is not None:
+                self.drainer.finish()
+                if self.drainer.started is not None:
+                    log.info(self.drainer.report())
+        return 0
+
+    @property
+    def stopping(self):
+        """Event set once the daemon is requested to stop (see `drain.StopEvent`)."""
+        return drain.stopping
+
     @contextlib.contextmanager
     def system(self):
         self.configureSystem()
         try:
             yield
         except:
+            handshake.notify_failure(self.stage)
             self._announceException("Top-level exception in the daemon {0!r} (pid={1})".format(
                 self.name, os.getpid(),
             ))
@@ -245,15 +503,33 @@ class Daemon(object):
             self.teardownSystem()
 
     @contextlib.contextmanager
-    def pidlock(self, pidfile):
-        """Locks the pidfile."""
-        if pidfile:
+    def pidlock(self, pidfile, acquire=True, token=None):
+        """Locks the pidfile.
+
+        The acquired pidfile is extended with the process start time, boot id
+        and the `token` (see `pidfiles`). If `acquire` is false, the lock
+        reserved before forking is held through the inherited descriptor;
+        the pidfile the launcher hands over (see `Launcher.reload`) is
+        adopted in the background by the pidfiles supporting it
+        (`pidfiles.FlockPidfile`).
+        The lock is released on exit only if the pidfile still names this
+        process; it might have been handed over to the next daemon generation.
+        """
+        if pidfile and acquire:
             pidfile.acquire(120)
+            pidfiles.stamp(pidfile, token)
+        elif pidfile and hasattr(pidfile, "adopt") and not pidfile.i_am_locking():
+            # Lock the pidfile the launcher hands over once the previous generation exits.
+            pidfile.adopt()
         try:
             yield
         finally:
             if pidfile:
-                pidfile.release()
+                owner = pidfile.read_pid()
+                if owner == os.getpid() and pidfile.i_am_locking():
+                    pidfile.release()
+                else:
+                    log.debug("Pidfile is owned by the pid {0}, not releasing it.".format(owner))
 
 
     def configureSystem(self):
@@ -261,7 +537,9 @@ class Daemon(object):
         # Setup signal handlers
         for (sigId, handler) in self.getSignalHandlers():
             signal.signal(sigId, handler)
+        self.signalDispatcher.start()
 
+        import setproctitle
         setproctitle.setproctitle(self.name)
 
     def setupLogging(self):
@@ -273,12 +551,21 @@ class Daemon(object):
             import logging.config
             logging.config.dictConfig(self.loggingConfig)
 
-    def setupProcessSession(self, extraFdExcludes=()):
+    def setupProcessSession(self, extraFdExcludes=(), predecessor=None):
         """Called by launcher to set up process session.
 
         Params:
             `extraFdExcludes` - list of extra file descriptors that should not be closed.
+            `predecessor` - pidfile of the running daemon generation to take
+                the `listen` sockets over from (see `Launcher.reload`).
         """
+        if self.listen:
+            inherited = {}
+            if predecessor and getattr(predecessor, "path", None):
+                inherited = sockets.receive(predecessor.path, predecessor.read_pid())
+            # Bind while the process is still privileged.
+            self.listenSockets = sockets.bind_all(self.listen, inherited)
+
         if self.chroot_directory is not None:
             util.change_root_directory(self.chroot_directory)
 
@@ -291,25 +578,30 @@ class Daemon(object):
 
         util.close_all_open_files(exclude=self._get_exclude_file_descriptors(extraFdExcludes))
 
-        util.redirect_stream(pty.STDIN_FILENO, self.stdin)
-        util.redirect_stream(pty.STDOUT_FILENO, self.stdout)
-        util.redirect_stream(pty.STDERR_FILENO, self.stderr)
+        util.redirect_stream(STDIN_FILENO, self.stdin)
+        util.redirect_stream(STDOUT_FILENO, self.stdout)
+        util.redirect_stream(STDERR_FILENO, self.stderr)
         # Update python-side objects
-        sys.stdin = os.fdopen(pty.STDIN_FILENO, "r")
-        sys.stdout = os.fdopen(pty.STDOUT_FILENO, "w")
-        sys.stderr = os.fdopen(pty.STDERR_FILENO, "w")
+        sys.stdin = os.fdopen(STDIN_FILENO, "r")
+        sys.stdout = os.fdopen(STDOUT_FILENO, "w")
+        sys.stderr = os.fdopen(STDERR_FILENO, "w")
 
     def teardownSystem(self):
         """Executed on the daemon shutdown."""
+        if self.signalDispatcher:
+            self.signalDispatcher.stop()
+            log.debug("Signal dispatch statistics: {0}".format(self.signalDispatcher.stats()))
         # Close everyting.
         util.close_all_open_files()
 
 
     def getSignalHandlers(self):
+        if self.signalDispatcher is None:
+            self.signalDispatcher = signals.SignalDispatcher()
         out = {}
         for (name, handle) in self.signal_map.items():
             sigId = getattr(signal, name)
-            if handle:
+            if handle and sigId != signal.SIGTERM:
                 out[sigId] = self._getUserSignalHandle(name)
         out[signal.SIGTERM] = self.onTerminateSignal
         return out.items()
@@ -320,11 +612,21 @@ class Daemon(object):
         :Return: ``None``
 
         Signal handler for the ``signal.SIGTERM`` signal. Performs the
-        following step:
+        following steps:
+
+        * Set the `stopping` event.
 
-        * Raise a ``SystemExit`` exception explaining the signal.
+        * Start draining the work in flight if `drain_timeout` is set
+          and there is any, or raise a ``SystemExit`` exception
+          explaining the signal.
+
+        The drain sends ``SIGTERM`` again once it is over; then the
+        ``SystemExit`` exception is raised right away.
 
         """
+        if self.drainer is not None and self.drainer.exitDue:
+            raise SystemExit(signal_number)
+        drain.stopping.set()
         userHandle = self.signal_map.get("SIGTERM")
         try:
             if userHandle:
@@ -333,24 +635,38 @@ class Daemon(object):
                 except:
                     self._announceException("Top-level user SIGTERM error.")
         finally:
-            raise SystemExit(signal_number)
+            if not self._startDrain():
+                raise SystemExit(signal_number)
+
+    def _startDrain(self):
+        """Start draining the work in flight; returns ``False`` if the daemon has to exit right away."""
+        if self.drainer is None:
+            # Not running the target (yet), or without `drain_timeout`.
+            return False
+        return self.drainer.begin()
+
+    def _drainTimeout(self):
+        if self.drain_timeout is None and self.threads:
+            return threadpool.DEFAULT_DRAIN_TIMEOUT
+        return self.drain_timeout
 
     def _getUserSignalHandle(self, name):
-        def _dummyHandle(signal_number, stack_frame):
+        """Return the signal handler deferring the user handler of `name` to `signalDispatcher`."""
+        def _dummyHandle():
             handle = self.signal_map[name]
             try:
                 handle()
             except:
                 self._announceException("Top-level user {!r} error".format(name))
         _dummyHandle.__name__ += "::{0}".format(name)
-        return _dummyHandle
+        return self.signalDispatcher.register(getattr(signal, name), _dummyHandle)
 
     def _get_exclude_file_descriptors(self, extra):
         """ Return the set of file descriptors to exclude closing.
 
             Returns a set containing the file descriptors for the
-            items in `files_preserve`, and also each of `stdin`,
-            `stdout`, and `stderr`:
+            items in `files_preserve`, the `listen` sockets, and also
+            each of `stdin`, `stdout`, and `stderr`:
 
             * If the item is ``None``, it is omitted from the return
               set.
@@ -363,6 +679,7 @@ class Daemon(object):
             """
         all_objs = itertools.chain(
             self.files_preserve,
+            self.listenSockets,
             extra,
             [self.stdin, self.stdout, self.stderr]
         )
@@ -1,10 +1,10 @@
 import os
 
-from lockfile.pidlockfile import PIDLockFile
-
 from . import (
     background,
     launcher,
+    memory,
+    pidfiles,
 )
 
 class BoundLauncher(launcher.Launcher):
@@ -18,25 +18,37 @@ class BoundLauncher(launcher.Launcher):
         except KeyError:
             raise TypeError("{0!r} requires `pidfile` argument.".format(self.__class__.__name__))
 
-        super(BoundLauncher, self).__init__(pidfile=self._makePidfile(pidfile))
+        forkServer = kwargs.pop("forkServer", None)
+        requires = kwargs.pop("requires", ())
+        super(BoundLauncher, self).__init__(pidfile=self._makePidfile(pidfile), forkServer=forkServer,
+            requires=requires)
         # Pass reminder kwargs to the backgreound daemon object
         self._daemonObject = self.backgroundDaemonCls(**kwargs)
 
-    def start(self, myDaemon=None):
+    @property
+    def name(self):
+        return self._daemonObject.name
+
+    def start(self, myDaemon=None, wait_ready=False, timeout=None):
         if myDaemon is not None:
             # the 'daemon' object can be passed by the parents' `restart()` call.
             assert myDaemon is self._daemonObject
-        return super(BoundLauncher, self).start(self._daemonObject)
+        return super(BoundLauncher, self).start(self._daemonObject,
+            wait_ready=wait_ready, timeout=timeout)
 
-    def restart(self):
-        return super(BoundLauncher, self).restart(self._daemonObject)
+    def restart(self, wait_ready=False, timeout=None):
+        return super(BoundLauncher, self).restart(self._daemonObject,
+            wait_ready=wait_ready, timeout=timeout)
+
+    def reload(self, timeout=None):
+        return super(BoundLauncher, self).reload(self._daemonObject, timeout=timeout)
 
     def _makePidfile(self, param):
         if isinstance(param, basestring):
             path = os.path.abspath(param)
             if not os.path.isdir(os.path.dirname(path)):
                 raise TypeError("{0!r} is not located in the existing directory.".format(path))
-            rv = PIDLockFile(path)
+            rv = pidfiles.FlockPidfile(path)
         elif hasattr(param, "read_pid"):
             # Assuming param to be pidfile object
             rv = param
@@ -58,7 +70,7 @@ class CLILauncher(BoundLauncher):
                 # No action performed
                 rc = 1
             else:
-                self.start()
+                self.start(wait_ready=namespace.wait_ready, timeout=namespace.timeout)
                 rc = 0
         elif namespace.action == "stop":
             if isRunning:
@@ -75,8 +87,16 @@ class CLILauncher(BoundLauncher):
                 msg = "stopped"
                 rc = 1
             print msg
+        elif namespace.action == "memory":
+            report = self.memory()
+            for (pid, usage) in report.items():
+                print "{0}: {1}".format(pid, memory.describe(usage))
+            rc = 0 if report else 1
         elif namespace.action == "restart":
-            self.restart()
+            self.restart(wait_ready=namespace.wait_ready, timeout=namespace.timeout)
+            rc = 0
+        elif namespace.action == "reload":
+            self.reload(timeout=namespace.timeout)
             rc = 0
         else:
             raise NotImplementedError(namespace)
@@ -85,6 +105,10 @@ class CLILauncher(BoundLauncher):
     def _getParser(self):
         import argparse
         parser = argparse.ArgumentParser(description="Python daemon command line interface")
-        parser.add_argument("action", choices=["start", "stop", "status", "restart"],
+        parser.add_argument("action", choices=["start", "stop", "status", "restart", "reload", "memory"],
             help="Action to be performed")
+        parser.add_argument("--wait-ready", action="store_true", default=False,
+            help="Return from start/restart only once the daemon reports that it is ready")
+        parser.add_argument("--timeout", type=float, default=None,
+            help="Seconds to wait for the daemon readiness")
         return parser
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+
+"""Stopping without dropping the work in flight.
+
+On ``SIGTERM`` the daemon sets the `stopping` event (see
+`shutdown_requested`) instead of raising ``SystemExit`` right away, if its
+`background.Daemon.drain_timeout` is set. The target stops taking new work
+and the work it already took (wrapped in `in_flight`) is given up to the
+drain timeout to finish::
+
+    while not daemon2.shutdown_requested():
+        with daemon2.in_flight():
+            job = take_job(timeout=1.0) # None if there was none
+            if job is not None:
+                process(job)
+
+``SIGTERM`` arriving while nothing is in flight still ends the target
+right away, so the work has to be taken inside the `in_flight` block:
+a job taken before entering it would be lost. Blocking waits inside the
+block delay the drain, keep them short.
+
+The daemon exits once nothing is in flight (or the target returns); the
+work still in flight when the drain timeout expires is abandoned. The
+drain duration is logged when the daemon exits.
+"""
+import contextlib
+import errno
+import fcntl
+import logging
+import os
+import select
+import signal
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+class StopEvent(object):
+    """ ``threading.Event`` look-alike that can be set from a signal handler.
+
+        Setting it takes no lock (it writes into a pipe the waiters select
+        on), so the signal handler can not deadlock on a lock held by the
+        code it interrupted.
+    """
+
+    def __init__(self):
+        super(StopEvent, self).__init__()
+        self._flag = False
+        self._pipe = None
+        self._pid = None
+        self._lock = threading.Lock() # Taken by the waiters only.
+
+    def is_set(self):
+        return self._flag
+
+    isSet = is_set
+
+    def set(self):
+        self._flag = True
+        pipe = self._pipe
+        if pipe is not None and self._pid == os.getpid():
+            try:
+                os.write(pipe[1], b"\0")
+            except OSError as exc:
+                if exc.errno != errno.EAGAIN:
+                    raise
+
+    def clear(self):
+        self._flag = False
+        pipe = self._pipe
+        if pipe is not None and self._pid == os.getpid():
+            try:
+                while os.read(pipe[0], 512):
+                    pass
+            except OSError as exc:
+                if exc.errno != errno.EAGAIN:
+                    raise
+
+    def wait(self, timeout=None):
+        """Block until the event is set or `timeout` seconds pass; returns whether it is set."""
+        if self._flag:
+            return True
+        rfd = self._readFd()
+        deadline = None if timeout is None else time.time() + timeout
+        while not self._flag:
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                break
+            try:
+                select.select([rfd], (), (), remaining)
+            except (select.error, OSError) as exc:
+                if exc.args[0] != errno.EINTR:
+                    raise
+        return self._flag
+
+    def _readFd(self):
+        with self._lock:
+            if self._pipe is None or self._pid != os.getpid():
+                # The pipe of the parent process is not ours to wait on.
+                pipe = os.pipe()
+                for fd in pipe:
+                    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+                    fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+                (self._pipe, self._pid) = (pipe, os.getpid())
+            return self._pipe[0]
+
+class InFlightTracker(object):
+    """Counts the units of work in progress."""
+
+    def __init__(self):
+        super(InFlightTracker, self).__init__()
+        self.count = 0
+        self._cond = threading.Condition()
+
+    @contextlib.contextmanager
+    def track(self):
+        """Context manager marking the work done in its block as in flight."""
+        self.begin()
+        try:
+            yield
+        finally:
+            self.end()
+
+    def begin(self):
+        with self._cond:
+            self.count += 1
+
+    def end(self):
+        with self._cond:
+            self.count -= 1
+            if not self.count:
+                self._cond.notify_all()
+
+    def wait_idle(self, timeout=None):
+        """Block until nothing is in flight; returns ``False`` if that did not happen in `timeout` seconds."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self.count:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+stopping = StopEvent()
+tracker = InFlightTracker()
+
+def shutdown_requested():
+    """Tell whether the daemon was requested to stop."""
+    return stopping.is_set()
+
+def in_flight():
+    """Context manager marking the work done in its block as in flight (see `InFlightTracker`)."""
+    return tracker.track()
+
+class Drain(object):
+    """ Waits for the work in flight after the stop request, at most `timeout` seconds.
+
+        Armed before the target runs: a watcher thread waits for `begin`
+        (called by the ``SIGTERM`` handler), then for the work in flight.
+        Once nothing is in flight anymore or the timeout expires, it sends
+        ``SIGTERM`` to the process again and the handler raises
+        ``SystemExit`` in the main thread (see `exitDue`). Neither the
+        alarm timer nor ``SIGALRM`` are used, they stay the target's.
+    """
+
+    def __init__(self, timeout, tracker=tracker):
+        super(Drain, self).__init__()
+        self.timeout = timeout
+        self.tracker = tracker
+        self.started = None
+        self.finished = None
+        self.abandoned = 0 # Units of work still in flight when the timeout expired.
+        self.exitDue = False # Set by the watcher thread right before it signals the process.
+        self._begun = StopEvent()
+        self._lock = threading.Lock() # Not taken by the signal handler.
+        self._thread = None
+
+    @property
+    def duration(self):
+        if self.started is None:
+            return None
+        return (self.finished or time.time()) - self.started
+
+    def arm(self):
+        """Start the watcher thread; called from the main thread before the target runs."""
+        self._begun._readFd()
+        self._thread = threading.Thread(target=self._watch, name="drain-watcher")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def begin(self):
+        """Start draining (from the signal handler); returns ``False`` if there is nothing to wait for."""
+        if self.started is None:
+            self.started = time.time()
+            if not self.tracker.count:
+                self.finished = self.started
+                return False
+            self._begun.set()
+        # Repeated SIGTERM does not cut the drain short.
+        return self.finished is None
+
+    def wait(self):
+        """Called once the target returned: waits for the rest of the work in flight."""
+        if self.started is not None and self.finished is None:
+            self.tracker.wait_idle(max(self.started + self.timeout - time.time(), 0))
+            self.finish()
+
+    def finish(self):
+        """Stop the drain, unless the watcher thread finished it already."""
+        with self._lock:
+            if self.finished is None and self.started is not None:
+                self.finished = time.time()
+                self.abandoned = self.tracker.count
+        # Lets the watcher thread go if the drain never began.
+        self._begun.set()
+
+    def report(self):
+        if self.abandoned:
+            return "Drain timed out after {0:.3f} seconds, {1} unit(s) of work abandoned.".format(
+                self.duration, self.abandoned)
+        return "Drained in {0:.3f} seconds.".format(self.duration)
+
+    def _watch(self):
+        self._begun.wait()
+        if self.started is None:
+            return
+        self.tracker.wait_idle(max(self.started + self.timeout - time.time(), 0))
+        with self._lock:
+            if self.finished is not None:
+                # The target returned first.
+                return
+            self.finished = time.time()
+            self.abandoned = self.tracker.count
+            self.exitDue = True
+        os.kill(os.getpid(), signal.SIGTERM)
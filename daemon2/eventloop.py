@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+"""Running coroutine targets.
+
+A daemon whose `target` is a coroutine function (``async def``, or a
+``@trollius.coroutine`` generator on Python 2) gets a fresh event loop
+running the target as its main task. The ``signal_map`` handlers are
+installed with ``loop.add_signal_handler``, so they run between the loop
+callbacks rather than at an arbitrary point of the target. ``SIGTERM``
+cancels the main task instead of raising ``SystemExit``: the target sees
+the cancellation at its current ``await`` and gets `Daemon.cleanup_timeout`
+seconds to finish its cleanup.
+"""
+import logging
+import signal
+
+from . import drain
+
+log = logging.getLogger(__name__)
+
+# ``co_flags`` of ``async def`` functions and of ``types.coroutine`` generators.
+CO_COROUTINES = 0x80 | 0x100
+
+def _asyncio():
+    try:
+        import asyncio
+    except ImportError:
+        import trollius as asyncio
+    return asyncio
+
+def is_coroutine_function(func):
+    """ Tell whether calling `func` returns a coroutine.
+
+        Does not import ``asyncio``: checks the code flags and the marker
+        the ``@coroutine`` decorators set.
+        """
+    code = getattr(func, "__code__", None)
+    if code is not None and code.co_flags & CO_COROUTINES:
+        return True
+    return bool(getattr(func, "_is_coroutine", False))
+
+def run(daemon):
+    """ Run the coroutine `daemon.target` on a new event loop; return the exit code.
+
+        Coroutines returned by the ``signal_map`` handlers are scheduled as
+        tasks. The exit code is non-zero if the cleanup after ``SIGTERM``
+        did not finish in `daemon.cleanup_timeout` seconds.
+        """
+    asyncio = _asyncio()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    state = {"terminating": False, "expired": False}
+
+    def _callUser(name):
+        try:
+            result = daemon.signal_map[name]()
+            if asyncio.iscoroutine(result):
+                loop.create_task(result)
+        except Exception:
+            daemon._announceException("Top-level user {0!r} error".format(name))
+
+    def _terminate():
+        if state["terminating"]:
+            return
+        state["terminating"] = True
+        drain.stopping.set()
+        log.debug("Termination requested, cancelling the target.")
+        if daemon.signal_map.get("SIGTERM"):
+            _callUser("SIGTERM")
+        main.cancel()
+        loop.call_later(daemon.cleanup_timeout, _expired)
+
+    def _expired():
+        log.error("Target did not finish its cleanup in {0} seconds.".format(daemon.cleanup_timeout))
+        state["expired"] = True
+        loop.stop()
+
+    try:
+        main = loop.create_task(daemon.target())
+        for (name, handle) in daemon.signal_map.items():
+            if handle and name != "SIGTERM":
+                loop.add_signal_handler(getattr(signal, name), _callUser, name)
+        loop.add_signal_handler(signal.SIGTERM, _terminate)
+        try:
+            loop.run_until_complete(main)
+        except asyncio.CancelledError:
+            pass
+        except RuntimeError:
+            # The loop got stopped before the main task finished.
+            if not state["expired"]:
+                raise
+            return 1
+        return 0
+    finally:
+        loop.close()
@@ -8,6 +8,24 @@ class DaemonOSEnvironmentError(DaemonError, OSError):
 class DaemonProcessDetachError(DaemonError, OSError):
     """ Exception raised when process detach fails. """
 
+class DaemonTimeoutError(DaemonError):
+    """ Raised when the daemon does not reach the expected state in time. """
+
+class DaemonStartupError(DaemonError):
+    """ Raised when the daemon fails before it reports being up and running.
+
+        `stage` names the startup step that failed; `excType`, `excMessage`
+        and `remoteTraceback` describe the exception raised in the daemon
+        process (all of them are ``None`` if the daemon died silently).
+        """
+
+    def __init__(self, message, stage=None, excType=None, excMessage=None, remoteTraceback=None):
+        super(DaemonStartupError, self).__init__(message)
+        self.stage = stage
+        self.excType = excType
+        self.excMessage = excMessage
+        self.remoteTraceback = remoteTraceback
+
 class DaemonProcessTerminate(DaemonError, SystemExit):
     """Daemon termination exception."""
 
@@ -27,4 +45,7 @@ class PIDFileError(Exception):
     """ Abstract base class for errors specific to PID files. """
 
 class PIDFileParseError(ValueError, PIDFileError):
-    """ Raised when parsing contents of PID file fails. """
\ No newline at end of file
+    """ Raised when parsing contents of PID file fails. """
+
+class PIDFileLockedError(PIDFileError):
+    """ Raised when the PID file lock is held by another process. """
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+
+"""Daemonization of external commands without forking the launcher."""
+import contextlib
+import errno
+import fcntl
+import json
+import os
+import signal
+import sys
+import threading
+
+from . import (
+    exceptions,
+    pidfiles,
+    sockets,
+    util,
+)
+
+# Signals Python sets to SIG_IGN; the executed command gets the defaults back.
+_RESET_SIGNALS = tuple(
+    getattr(signal, name) for name in ("SIGPIPE", "SIGXFSZ")
+    if hasattr(signal, name)
+)
+
+# Applies the umask and the working directory in the spawned process, then
+# executes the command: ``sh -c _TRAMPOLINE name umask directory argv...``.
+_TRAMPOLINE = u'umask "$1" && cd -- "$2" && shift 2 && exec "$@"'
+_SHELL = u"/bin/sh"
+
+# ``posix_spawnattr_setflags`` flags, the same in glibc and musl.
+_POSIX_SPAWN_SETSIGDEF = 0x04
+_POSIX_SPAWN_SETSID = 0x80
+# Room for ``posix_spawn_file_actions_t``, ``posix_spawnattr_t`` and ``sigset_t``
+# (80, 336 and 128 bytes in glibc on x86_64).
+_OPAQUE_SIZE = 1024
+
+# Serializes the changes of the close-on-exec flags of the preserved descriptors.
+_spawnLock = threading.Lock()
+
+_libc = None
+
+class ExecDaemon(object):
+    """ Daemon that executes the external command `argv`.
+
+        Usable with `Launcher` in place of `background.Daemon`. The command
+        is started in a new session with ``posix_spawn`` of the C library
+        (called through ``ctypes``), so the launcher's address space is
+        never copied; a ``/bin/sh`` trampoline applies the working directory
+        and the umask, the launcher's own are left alone. Where the C
+        library can not start a new session that way, the command is
+        started by fork and exec.
+
+        `env` is the environment of the command (``os.environ`` if ``None``),
+        `stdin`, `stdout`, `stderr`, `files_preserve`, `working_directory`
+        and `umask` have the same meaning as for `background.Daemon`.
+        Sockets declared in `listen` are bound by the launcher and passed to
+        the command in the ``DAEMON2_LISTEN_FDS`` environment variable.
+
+        The command is a child of the launching process; it is reaped by
+        `Launcher.wait` and `Launcher.terminate`. The PID file is locked
+        before the spawn as for `background.Daemon` and the lock is handed
+        over to the command (a `pidfiles.FlockPidfile` stays locked as long
+        as the command runs). The file is not removed when the command
+        exits; it is broken as stale on the next start.
+    """
+
+    def __init__(self, argv, env=None,
+        working_directory=u'/',
+        umask=0,
+        files_preserve=(),
+        stdin=None,
+        stdout=None,
+        stderr=None,
+        listen=(),
+    ):
+        super(ExecDaemon, self).__init__()
+        if not argv:
+            raise ValueError("Empty command line.")
+        self.argv = list(argv)
+        self.name = self.argv[0]
+        self.env = env
+        self.working_directory = working_directory
+        self.umask = umask
+        self.files_preserve = files_preserve
+        self.stdin = stdin
+        self.stdout = stdout
+        self.stderr = stderr
+        self.listen = listen
+
+    def spawn(self, pidfile, token=None, takeover=False):
+        """Start the command, write the `pidfile` and return PID of the command.
+
+        Raises `exceptions.PIDFileLockedError` if another daemon holds the
+        `pidfile`. `token` is recorded in the pidfile (see `pidfiles`).
+        If `takeover` is set, the pidfile is left to the caller (see
+        `Launcher.reload`).
+        """
+        reserved = bool(pidfile) and not takeover
+        if reserved:
+            pidfiles.reserve(pidfile)
+        try:
+            pid = self._spawn(pidfiles.lock_descriptors(pidfile) if reserved else [])
+            if reserved:
+                pidfiles.stamp(pidfile, token, pid=pid)
+        except:
+            if reserved:
+                pidfile.release()
+            raise
+        if reserved:
+            pidfiles.hand_over(pidfile)
+        return pid
+
+    def _spawn(self, lockDescriptors):
+        listenSockets = [sockets.as_listener(spec).open() for spec in self.listen]
+        try:
+            env = dict(os.environ if self.env is None else self.env)
+            if listenSockets:
+                env[sockets.LISTEN_FDS_ENV] = u",".join(str(sock.fileno()) for sock in listenSockets)
+            keep = set(_fileno(obj) for obj in self.files_preserve)
+            keep.update(sock.fileno() for sock in listenSockets)
+            keep.update(lockDescriptors)
+            pid = self._posixSpawn(env, keep)
+            if pid is None:
+                pid = self._forkExec(env, keep)
+            return pid
+        finally:
+            for sock in listenSockets:
+                sock.close()
+
+    def _stdio(self):
+        """Return ``(target fd, source fd or None, open flags)`` for the standard streams."""
+        return (
+            (0, _fileno(self.stdin), os.O_RDONLY),
+            (1, _fileno(self.stdout), os.O_WRONLY),
+            (2, _fileno(self.stderr), os.O_WRONLY),
+        )
+
+    def _posixSpawn(self, env, keep):
+        """Spawn the trampoline with ``posix_spawn``; returns ``None`` if the C library can not."""
+        libc = _spawnLibrary()
+        if libc is None:
+            return None
+        fileActions = []
+        for (target, source, flags) in self._stdio():
+            if source is None:
+                fileActions.append((libc.posix_spawn_file_actions_addopen, target, _cString(os.devnull), flags, 0))
+            elif source != target:
+                fileActions.append((libc.posix_spawn_file_actions_adddup2, source, target))
+        for fd in (util.get_open_file_descriptors() or ()):
+            if fd > 2 and fd not in keep and _isInheritable(fd):
+                fileActions.append((libc.posix_spawn_file_actions_addclose, fd))
+        self._checkCommand(env)
+        # ``posix_spawn`` has no portable way to set the working directory and
+        # the umask of the child only; the trampoline shell does it.
+        argv = [_SHELL, u"-c", _TRAMPOLINE, self.name, u"{0:04o}".format(self.umask),
+            self.working_directory] + self.argv
+        with _inheritable(keep):
+            try:
+                return _libcSpawn(libc, _SHELL, argv,
+                    [_cString(key) + b"=" + _cString(value) for (key, value) in env.items()], fileActions)
+            except OSError as exc:
+                raise exceptions.DaemonStartupError(
+                    u"Failed to execute {0!r}: {1}".format(self.argv, exc),
+                    stage=u"exec", excType=u"OSError", excMessage=u"{0}".format(exc))
+
+    def _checkCommand(self, env):
+        """Raise `DaemonStartupError` if the trampoline would fail to execute the command."""
+        error = None
+        if not os.path.isdir(self.working_directory):
+            error = OSError(errno.ENOENT, os.strerror(errno.ENOENT), self.working_directory)
+        elif os.sep in self.argv[0]:
+            # Relative to the working directory of the command.
+            if not _isExecutable(os.path.join(self.working_directory, self.argv[0])):
+                error = OSError(errno.ENOENT, os.strerror(errno.ENOENT), self.argv[0])
+        elif not any(
+            _isExecutable(os.path.join(self.working_directory, directory, self.argv[0]))
+            for directory in env.get(u"PATH", os.defpath).split(os.pathsep)
+        ):
+            error = OSError(errno.ENOENT, os.strerror(errno.ENOENT), self.argv[0])
+        if error is not None:
+            raise exceptions.DaemonStartupError(
+                u"Failed to execute {0!r}: {1}".format(self.argv, error),
+                stage=u"exec", excType=u"OSError", excMessage=u"{0}".format(error))
+
+    def _forkExec(self, env, keep):
+        (errRead, errWrite) = os.pipe()
+        fcntl.fcntl(errWrite, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        pid = os.fork()
+        if not pid:
+            try:
+                for fd in keep:
+                    _setCloseOnExec(fd, False)
+                os.setsid()
+                for signalNumber in _RESET_SIGNALS:
+                    signal.signal(signalNumber, signal.SIG_DFL)
+                util.change_file_creation_mask(self.umask)
+                util.change_working_directory(self.working_directory)
+                for (target, source, flags) in self._stdio():
+                    if source is None:
+                        source = os.open(os.devnull, flags)
+                    if source != target:
+                        os.dup2(source, target)
+                util.close_all_open_files(exclude=keep | set([0, 1, 2, errWrite]))
+                os.execvpe(self.argv[0], self.argv, env)
+            except BaseException as exc:
+                os.write(errWrite, json.dumps([type(exc).__name__, u"{0}".format(exc)]).encode("utf-8"))
+            finally:
+                os._exit(127)
+
+        os.close(errWrite)
+        with os.fdopen(errRead, "rb") as fobj:
+            # Closed by a successful exec.
+            report = fobj.read()
+        if report:
+            os.waitpid(pid, 0)
+            (excType, excMessage) = json.loads(report.decode("utf-8"))
+            raise exceptions.DaemonStartupError(
+                u"Failed to execute {0!r}: {1}: {2}".format(self.argv, excType, excMessage),
+                stage=u"exec", excType=excType, excMessage=excMessage)
+        return pid
+
+def _spawnLibrary():
+    """Return the C library if it can ``posix_spawn`` into a new session (``None`` otherwise)."""
+    global _libc
+    if _libc is None:
+        _libc = False
+        if sys.platform.startswith("linux"):
+            import ctypes
+            libc = ctypes.CDLL(None, use_errno=True)
+            if hasattr(libc, "posix_spawn") and _setSpawnFlags(libc, _POSIX_SPAWN_SETSID):
+                _libc = libc
+    return _libc or None
+
+def _setSpawnFlags(libc, flags, attr=None):
+    """Set `flags` in the ``posix_spawnattr_t`` `attr` (a scratch one if ``None``); tells whether they are known."""
+    import ctypes
+    if attr is None:
+        attr = ctypes.create_string_buffer(_OPAQUE_SIZE)
+        _check(libc.posix_spawnattr_init(attr))
+        try:
+            return _setSpawnFlags(libc, flags, attr)
+        finally:
+            libc.posix_spawnattr_destroy(attr)
+    # Unknown flags (``POSIX_SPAWN_SETSID`` before glibc 2.26) are refused with ``EINVAL``.
+    return libc.posix_spawnattr_setflags(attr, ctypes.c_short(flags)) == 0
+
+def _libcSpawn(libc, path, argv, env, fileActions):
+    """ Call ``posix_spawn`` of the C `libc`; returns PID of the new process.
+
+        The process gets a new session and the default handlers of
+        `_RESET_SIGNALS`. `fileActions` are ``(function, args...)`` tuples
+        of the ``posix_spawn_file_actions_add*`` calls. Raises ``OSError``
+        if the process can not be spawned.
+        """
+    import ctypes
+    actions = ctypes.create_string_buffer(_OPAQUE_SIZE)
+    attr = ctypes.create_string_buffer(_OPAQUE_SIZE)
+    defaultSignals = ctypes.create_string_buffer(_OPAQUE_SIZE)
+    _check(libc.posix_spawn_file_actions_init(actions))
+    try:
+        _check(libc.posix_spawnattr_init(attr))
+        try:
+            for action in fileActions:
+                _check(action[0](actions, *action[1:]))
+            libc.sigemptyset(defaultSignals)
+            for signalNumber in _RESET_SIGNALS:
+                libc.sigaddset(defaultSignals, signalNumber)
+            _check(libc.posix_spawnattr_setsigdefault(attr, defaultSignals))
+            if not _setSpawnFlags(libc, _POSIX_SPAWN_SETSID | _POSIX_SPAWN_SETSIGDEF, attr):
+                _check(errno.EINVAL)
+            pid = ctypes.c_int()
+            _check(libc.posix_spawn(ctypes.byref(pid), _cString(path), actions, attr,
+                _cStringArray(argv), _cStringArray(env)))
+            return pid.value
+        finally:
+            libc.posix_spawnattr_destroy(attr)
+    finally:
+        libc.posix_spawn_file_actions_destroy(actions)
+
+def _check(err):
+    """Raise ``OSError`` for the error number returned by a ``posix_spawn*`` function."""
+    if err:
+        raise OSError(err, os.strerror(err))
+
+def _cString(value):
+    if isinstance(value, unicode):
+        return value.encode(sys.getfilesystemencoding() or "utf-8")
+    return value
+
+def _cStringArray(values):
+    """Return the ``NULL`` terminated ``char *`` array of `values`."""
+    import ctypes
+    return (ctypes.c_char_p * (len(values) + 1))(*([_cString(value) for value in values] + [None]))
+
+@contextlib.contextmanager
+def _inheritable(fds):
+    """Make `fds` inheritable while the command is spawned, restore the flags afterwards."""
+    with _spawnLock:
+        changed = [fd for fd in fds if not _isInheritable(fd)]
+        for fd in changed:
+            _setCloseOnExec(fd, False)
+        try:
+            yield
+        finally:
+            for fd in changed:
+                _setCloseOnExec(fd, True)
+
+def _setCloseOnExec(fd, value):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC if value else flags & ~fcntl.FD_CLOEXEC)
+
+def _isExecutable(path):
+    return os.path.isfile(path) and os.access(path, os.X_OK)
+
+def _fileno(obj):
+    if obj is None or isinstance(obj, int):
+        return obj
+    return obj.fileno()
+
+def _isInheritable(fd):
+    try:
+        return not fcntl.fcntl(fd, fcntl.F_GETFD) & fcntl.FD_CLOEXEC
+    except (IOError, OSError) as exc:
+        if exc.errno == errno.EBADF:
+            return False
+        raise
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+
+"""Operating many daemons at once.
+
+`DaemonFleet` runs the launcher operations of a group of daemons in
+parallel (by at most `concurrency` threads), so that a host-wide restart
+takes as long as its slowest daemon. Daemons declaring dependencies
+(`Launcher.requires`) are started once their prerequisites are ready and
+stopped before them. The status of the whole fleet is computed from a
+single scan of ``/proc`` and the pidfile records.
+
+Started as ``python -m daemon2.fleet DIRECTORY {status,stop}``, the fleet
+consists of the daemons whose pidfiles are found in the directory.
+"""
+import collections
+import fnmatch
+import logging
+import os
+import sys
+import threading
+import time
+
+from . import (
+    exceptions,
+    launcher,
+    liveness,
+    pidfiles,
+)
+
+log = logging.getLogger(__name__)
+
+# Outcome of an operation on a single daemon; `error` is the exception it raised (if any).
+FleetResult = collections.namedtuple("FleetResult", "name ok value error elapsed")
+FleetStatus = collections.namedtuple("FleetStatus", "name running pid")
+
+class DaemonFleet(object):
+    """ Group of daemons operated together.
+
+        `launchers` is a mapping of daemon names to their launchers or a
+        sequence of launchers, named after their daemon (`BoundLauncher`) or
+        their pidfile. Starting (and so restarting and reloading) requires
+        launchers that know their daemon, i.e. `BoundLauncher` instances.
+
+        `dependencies` maps daemon names to the names of the daemons they
+        require, in addition to those declared by the launchers themselves
+        (`Launcher.requires`). A daemon is started only after its
+        prerequisites got ready and stopped only after the daemons requiring
+        it are gone; independent daemons are operated in parallel.
+
+        Every operation returns the ordered mapping of daemon names to
+        `FleetResult`. The failure of one daemon does not stop the others,
+        except for the daemons depending on it, which fail too.
+    """
+
+    def __init__(self, launchers, concurrency=8, dependencies=None):
+        super(DaemonFleet, self).__init__()
+        if not hasattr(launchers, "items"):
+            launchers = [(_launcherName(obj), obj) for obj in launchers]
+        else:
+            launchers = sorted(launchers.items())
+        self.launchers = collections.OrderedDict(launchers)
+        if len(self.launchers) != len(launchers):
+            raise ValueError("Daemon names are not unique: {0!r}".format([name for (name, _) in launchers]))
+        if concurrency < 1:
+            raise ValueError("Concurrency has to be positive, got {0!r}".format(concurrency))
+        self.concurrency = concurrency
+        self.requires = dict(
+            (name, frozenset(getattr(obj, "requires", ())) | frozenset((dependencies or {}).get(name, ())))
+            for (name, obj) in self.launchers.items()
+        )
+        self._checkDependencies()
+
+    def _checkDependencies(self):
+        for (name, required) in self.requires.items():
+            unknown = required.difference(self.launchers)
+            if unknown:
+                raise ValueError("{0!r} requires unknown daemons {1!r}".format(name, sorted(unknown)))
+        # Kahn's algorithm; whatever can not be ordered is a part of a cycle.
+        blocked = dict((name, set(required)) for (name, required) in self.requires.items())
+        ready = [name for (name, required) in blocked.items() if not required]
+        while ready:
+            done = ready.pop()
+            del blocked[done]
+            for (name, required) in blocked.items():
+                if done in required:
+                    required.discard(done)
+                    if not required:
+                        ready.append(name)
+        if blocked:
+            raise ValueError("Dependency cycle among {0!r}".format(sorted(blocked)))
+
+    def dependents(self, name):
+        """Return the names of the daemons requiring `name`."""
+        return frozenset(other for (other, required) in self.requires.items() if name in required)
+
+    def prerequisites(self, names):
+        """Return `names` along with the names of all the daemons they require, directly or not."""
+        rv = set(names)
+        pending = list(rv)
+        while pending:
+            for required in self.requires[pending.pop()]:
+                if required not in rv:
+                    rv.add(required)
+                    pending.append(required)
+        return frozenset(rv)
+
+    @classmethod
+    def from_directory(cls, directory, pattern=u"*.pid", pidfileFactory=pidfiles.FlockPidfile, **kwargs):
+        """ Create the fleet of the daemons whose pidfiles are in `directory`.
+
+            Such fleet can report the status of the daemons and stop them.
+            `pidfileFactory` creates the pidfile object for a path; it has to
+            match the pidfiles the daemons were started with.
+            """
+        launchers = {}
+        for fname in sorted(os.listdir(directory)):
+            if fnmatch.fnmatch(fname, pattern):
+                path = os.path.abspath(os.path.join(directory, fname))
+                launchers[os.path.splitext(fname)[0]] = launcher.Launcher(pidfileFactory(path))
+        return cls(launchers, **kwargs)
+
+    def status(self):
+        """Return the mapping of daemon names to `FleetStatus`."""
+        livePids = liveness.running_pids()
+        rv = collections.OrderedDict()
+        for (name, obj) in self.launchers.items():
+            record = obj.record
+            running = not pidfiles.is_stale(record, livePids)
+            rv[name] = FleetStatus(name, running, record.pid if record else None)
+        return rv
+
+    def start(self, names=None, wait_ready=False, timeout=None):
+        """Start the daemons that are not running.
+
+        The daemons the selected ones require are started too (if they
+        are not running) and reported along with them. Daemons required by
+        other daemons are always waited for to get ready, `wait_ready`
+        applies to the rest.
+        """
+        selected = self.prerequisites(self._select(names))
+        def _start(name, obj):
+            mustWait = wait_ready or bool(self.dependents(name) & selected)
+            return obj.start(wait_ready=mustWait, timeout=timeout)
+        return self._onEach(selected, False, _start, self.requires.get)
+
+    def stop(self, names=None, timeout=None):
+        """Terminate the running daemons."""
+        return self._onEach(self._select(names), True,
+            lambda name, obj: obj.terminate(timeout=timeout), self.dependents)
+
+    def restart(self, names=None, wait_ready=False, timeout=None):
+        """Stop the daemons and start them again (starting those that were not running)."""
+        stopped = self.stop(names, timeout=timeout)
+        started = self.start(names, wait_ready=wait_ready, timeout=timeout)
+        rv = collections.OrderedDict()
+        for (name, result) in started.items():
+            if name not in stopped:
+                # Prerequisite started along with the selected daemons.
+                rv[name] = result
+                continue
+            if not stopped[name].ok:
+                result = stopped[name]
+            rv[name] = result._replace(elapsed=stopped[name].elapsed + result.elapsed)
+        return rv
+
+    def reload(self, names=None, timeout=None):
+        """Reload the daemons (see `launcher.Launcher.reload`), prerequisites first."""
+        return self._onEach(self._select(names), None,
+            lambda name, obj: obj.reload(timeout=timeout), self.requires.get)
+
+    def _select(self, names):
+        if names is None:
+            return frozenset(self.launchers)
+        unknown = [name for name in names if name not in self.launchers]
+        if unknown:
+            raise KeyError("Unknown daemons: {0!r}".format(unknown))
+        return frozenset(names)
+
+    def _onEach(self, selected, running, func, predecessors):
+        """Call `func(name, launcher)` for the `selected` daemons in parallel.
+
+        A daemon is operated once the operation succeeded for all of its
+        `predecessors(name)` (selected ones only); if it failed for any of
+        them, the daemon fails without being operated. If `running` is not
+        ``None``, only daemons in that state are operated; the others get
+        a successful `FleetResult` with ``None`` value.
+        """
+        states = self.status() if running is not None else {}
+        results = collections.OrderedDict((name, None) for name in self.launchers if name in selected)
+        blocked = dict((name, set(predecessors(name) or ()) & selected) for name in results)
+        failed = collections.defaultdict(list) # name -> failed predecessors
+        ready = collections.deque(name for name in results if not blocked[name])
+        cond = threading.Condition()
+        inFlight = [0]
+
+        def _operate(name):
+            if failed[name]:
+                return FleetResult(name, False, None, exceptions.DaemonError(
+                    "Not operated, {0!r} failed".format(sorted(failed[name]))), 0.0)
+            if running is not None and states[name].running != running:
+                return FleetResult(name, True, None, None, 0.0)
+            started = time.time()
+            try:
+                value = func(name, self.launchers[name])
+            except Exception as exc:
+                log.error("{0!r} failed: {1}".format(name, exc))
+                return FleetResult(name, False, None, exc, time.time() - started)
+            return FleetResult(name, True, value, None, time.time() - started)
+
+        def _worker():
+            while True:
+                with cond:
+                    while not ready and inFlight[0]:
+                        cond.wait()
+                    if not ready:
+                        return
+                    name = ready.popleft()
+                    inFlight[0] += 1
+                result = _operate(name)
+                with cond:
+                    inFlight[0] -= 1
+                    results[name] = result
+                    for (other, waitingFor) in blocked.items():
+                        if name in waitingFor:
+                            waitingFor.discard(name)
+                            if not result.ok:
+                                failed[other].append(name)
+                            if not waitingFor:
+                                ready.append(other)
+                    cond.notify_all()
+
+        threads = [
+            threading.Thread(target=_worker, name="fleet-{0}".format(idx))
+            for idx in range(min(self.concurrency, len(results)))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def act(self, args, actions=("start", "stop", "status", "restart", "reload"), out=None):
+        """Perform the command line `args`; returns the exit code.
+
+        The outcome is written to `out` (``sys.stdout`` by default).
+        """
+        if out is None:
+            out = sys.stdout
+        namespace = self._getParser(actions).parse_args(args)
+        names = namespace.names or None
+        if namespace.action == "status":
+            states = self.status()
+            if names:
+                states = collections.OrderedDict((name, states[name]) for name in names)
+            for state in states.values():
+                out.write("{0}: {1}\n".format(state.name,
+                    "running (pid {0})".format(state.pid) if state.running else "stopped"))
+            return 0 if all(state.running for state in states.values()) else 1
+
+        if namespace.action in ("start", "restart"):
+            results = getattr(self, namespace.action)(names,
+                wait_ready=namespace.wait_ready, timeout=namespace.timeout)
+        else:
+            results = getattr(self, namespace.action)(names, timeout=namespace.timeout)
+        for result in results.values():
+            out.write("{0}: {1} ({2:.3f}s)\n".format(result.name,
+                "ok" if result.ok else "failed: {0}".format(result.error), result.elapsed))
+        return 0 if all(result.ok for result in results.values()) else 1
+
+    def _getParser(self, actions):
+        import argparse
+        parser = argparse.ArgumentParser(description="Python daemon fleet command line interface")
+        parser.add_argument("action", choices=actions, help="Action to be performed")
+        parser.add_argument("names", nargs="*", help="Daemons to operate (all by default)")
+        parser.add_argument("--wait-ready", action="store_true", default=False,
+            help="Return from start/restart only once the daemons report that they are ready")
+        parser.add_argument("--timeout", type=float, default=None,
+            help="Seconds to wait for the daemon readiness or termination")
+        return parser
+
+def _launcherName(obj):
+    name = getattr(obj, "name", None)
+    if name:
+        return name
+    path = getattr(obj.pidfile, "path", None)
+    if path is None:
+        raise ValueError("Can not name the daemon of {0!r}".format(obj))
+    return os.path.splitext(os.path.basename(path))[0]
+
+def main(argv):
+    if not argv:
+        sys.stderr.write("Usage: python -m daemon2.fleet DIRECTORY {status,stop} [NAME...]\n")
+        return 2
+    # Without the daemon definitions, the daemons can not be started.
+    return DaemonFleet.from_directory(argv[0]).act(argv[1:], actions=("stop", "status"))
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
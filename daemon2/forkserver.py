@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+"""Fork server: a small template process that forks daemons on request.
+
+Forking the daemon straight from a large application copies its whole
+address space into every daemon. The fork server is a fresh interpreter
+started once (with an optional set of preloaded modules) that performs the
+`launcher.spawn_daemon` double fork on behalf of the launchers connecting
+to its unix socket. The connection itself serves as the status pipe, so the
+launcher gets the PID, readiness and startup failures just as with a local
+fork.
+
+Daemons sent to the fork server are pickled: their `target` (and other
+callables) have to be importable by the server and the `stdin`, `stdout`
+and `stderr` streams have to be ``None``.
+"""
+import errno
+import logging
+import os
+import signal
+import socket
+import struct
+import sys
+
+from . import (
+    exceptions,
+    handshake,
+    launcher,
+    memory,
+    waiter,
+)
+
+log = logging.getLogger(__name__)
+
+HEADER = struct.Struct("!I")
+
+class ForkServer(object):
+    """ Client-side handle of the fork server process.
+
+        `address` is the path of the unix socket the server listens on (a
+        private temporary directory is used if ``None``); `preload` lists
+        the modules imported by the server before it starts serving.
+    """
+
+    def __init__(self, address=None, preload=()):
+        super(ForkServer, self).__init__()
+        self.address = address
+        self.preload = tuple(preload)
+        self._process = None
+        self._tmpDir = None
+
+    @property
+    def pid(self):
+        return self._process.pid if self._process is not None else None
+
+    @property
+    def running(self):
+        return self._process is not None and self._process.poll() is None
+
+    def start(self):
+        """Launch the server and wait until it accepts connections."""
+        if self.running:
+            raise exceptions.DaemonError("Fork server is already running.")
+        import subprocess
+        import tempfile
+        if self.address is None:
+            self._tmpDir = tempfile.mkdtemp(prefix="daemon2-forkserver-")
+            self.address = os.path.join(self._tmpDir, "socket")
+        env = dict(os.environ)
+        # Let the server unpickle everything this process is able to import.
+        env["PYTHONPATH"] = os.pathsep.join(path for path in sys.path if path)
+        self._process = subprocess.Popen(
+            [sys.executable, "-m", "daemon2.forkserver", self.address] + list(self.preload),
+            stdout=subprocess.PIPE, close_fds=True, env=env,
+        )
+        line = self._process.stdout.readline()
+        self._process.stdout.close()
+        if line.strip() != b"ready":
+            self._process.wait()
+            raise exceptions.DaemonStartupError("Fork server failed to start (rc={0}).".format(
+                self._process.returncode), stage=u"forkserver")
+        log.debug("Fork server started (pid={0}, address={1!r}).".format(self._process.pid, self.address))
+
+    def stop(self):
+        """Shut the server down. Daemons spawned by it keep running."""
+        if self.running:
+            self._process.terminate()
+        if self._process is not None:
+            self._process.wait()
+            self._process = None
+        if self._tmpDir:
+            import shutil
+            shutil.rmtree(self._tmpDir, ignore_errors=True)
+            self._tmpDir = None
+            self.address = None
+
+    def spawn(self, daemon, pidfile, takeover=False, token=None):
+        """Request the daemon spawn; returns the `handshake.StatusReader` connected to the daemon."""
+        import pickle
+        payload = pickle.dumps((daemon, pidfile, takeover, token), pickle.HIGHEST_PROTOCOL)
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            conn.connect(self.address)
+            conn.sendall(HEADER.pack(len(payload)) + payload)
+            fd = os.dup(conn.fileno())
+        except socket.error as exc:
+            raise exceptions.DaemonProcessDetachError(u"Fork server request failed ({0})".format(exc))
+        finally:
+            conn.close()
+        return handshake.StatusReader(fd)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        self.stop()
+
+def _recvExactly(conn, size):
+    data = b""
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise EOFError("Connection closed after {0} of {1} bytes.".format(len(data), size))
+        data += chunk
+    return data
+
+def handle(conn):
+    """Serve a single spawn request received over `conn`."""
+    import pickle
+    fd = os.dup(conn.fileno())
+    try:
+        (size, ) = HEADER.unpack(_recvExactly(conn, HEADER.size))
+        (daemon, pidfile, takeover, token) = pickle.loads(_recvExactly(conn, size))
+    except:
+        handshake.StatusWriter(fd).sendError(u"forkserver")
+        return
+    try:
+        firstPid = launcher.spawn_daemon(daemon, pidfile, fd, takeover=takeover, token=token)
+    except exceptions.PIDFileLockedError:
+        handshake.StatusWriter(fd).sendError(u"pidlock")
+        return
+    except:
+        handshake.StatusWriter(fd).sendError(u"fork")
+        return
+    os.close(fd)
+    waiter.wait_for_exit(firstPid)
+
+def serve(address, preload=()):
+    """Run the fork server loop."""
+    for name in preload:
+        __import__(name)
+    # Every request forks this process: keep the preloaded heap shared with the daemons.
+    memory.prepare_fork()
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    oldMask = os.umask(0o077)
+    try:
+        sock.bind(address)
+    finally:
+        os.umask(oldMask)
+    sock.listen(128)
+    signal.signal(signal.SIGTERM, lambda signalNumber, stackFrame: sys.exit(0))
+
+    sys.stdout.write("ready\n")
+    sys.stdout.flush()
+    try:
+        while True:
+            try:
+                (conn, _) = sock.accept()
+            except socket.error as exc:
+                if exc.args[0] == errno.EINTR:
+                    continue
+                raise
+            try:
+                handle(conn)
+            except Exception:
+                log.exception("Failed to serve the fork request.")
+            finally:
+                conn.close()
+    finally:
+        sock.close()
+        try:
+            os.unlink(address)
+        except OSError:
+            pass
+
+if __name__ == "__main__":
+    serve(sys.argv[1], sys.argv[2:])
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+
+"""Status protocol spoken between the launcher and the daemon it spawns.
+
+The daemon side writes newline-terminated JSON messages of the form
+``[kind, payload]`` into the pipe created by `Launcher._forkDaemon`; the
+launcher side reads them with an optional deadline.
+"""
+import errno
+import json
+import os
+import select
+import sys
+import time
+import traceback
+
+from . import (
+    exceptions,
+    util,
+)
+
+PID = u"pid"
+READY = u"ready"
+ERROR = u"error"
+TIMINGS = u"timings"
+EOF = None
+
+class StatusWriter(object):
+    """Daemon side of the status pipe."""
+
+    def __init__(self, fd):
+        super(StatusWriter, self).__init__()
+        self.fd = fd
+
+    @property
+    def closed(self):
+        return self.fd is None
+
+    def send(self, kind, payload=None):
+        """Send the message to the launcher.
+
+        Returns ``False`` if the launcher is not listening anymore.
+        """
+        if self.closed:
+            return False
+        data = (json.dumps([kind, payload]) + "\n").encode("utf-8")
+        while data:
+            try:
+                written = os.write(self.fd, data)
+            except OSError as exc:
+                if exc.errno == errno.EINTR:
+                    continue
+                elif exc.errno == errno.EPIPE:
+                    # Nobody is reading the other end.
+                    self.close()
+                    return False
+                raise
+            data = data[written:]
+        return True
+
+    def sendError(self, stage, excInfo=None):
+        """Report the exception that aborted the daemon startup at `stage`.
+
+        `excInfo` defaults to the exception currently being handled.
+        Closes the status pipe.
+        """
+        (excType, exc, tb) = excInfo or sys.exc_info()
+        self.send(ERROR, {
+            u"stage": stage,
+            u"type": u"{0}.{1}".format(excType.__module__, excType.__name__),
+            u"message": u"{0}".format(exc),
+            u"traceback": u"".join(traceback.format_exception(excType, exc, tb)),
+        })
+        self.close()
+
+    def close(self):
+        if not self.closed:
+            util.close_fd(self.fd)
+            self.fd = None
+
+class StatusReader(object):
+    """Launcher side of the status pipe."""
+
+    def __init__(self, fd):
+        super(StatusReader, self).__init__()
+        self.fd = fd
+        self._buffer = b""
+        self._eof = False
+        self.received = {} # kind -> payload of the last message of that kind
+
+    def receive(self, timeout=None):
+        """Return the next ``(kind, payload)`` message.
+
+        Returns ``None`` if nothing arrived in `timeout` seconds and
+        ``(EOF, None)`` once the daemon side has closed the pipe.
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while b"\n" not in self._buffer:
+            if self._eof or self.fd is None:
+                return (EOF, None)
+            if timeout is None:
+                remaining = None
+            else:
+                remaining = max(deadline - time.time(), 0)
+            try:
+                (rList, _, _) = select.select([self.fd], (), (), remaining)
+            except select.error as exc:
+                if exc.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not rList:
+                return None
+            self._read()
+        return self._pop()
+
+    def feed(self):
+        """Read the data waiting in the pipe without blocking.
+
+        Meant to be called once the descriptor is readable (see
+        `asyncLauncher`). Returns the list of the messages completed by the
+        data, ending with ``(EOF, None)`` if the daemon side closed the pipe.
+        """
+        self._read()
+        messages = []
+        while b"\n" in self._buffer:
+            messages.append(self._pop())
+        if self._eof:
+            messages.append((EOF, None))
+        return messages
+
+    def _read(self):
+        chunk = os.read(self.fd, 4096)
+        if chunk:
+            self._buffer += chunk
+        else:
+            self._eof = True
+
+    def _pop(self):
+        (line, self._buffer) = self._buffer.split(b"\n", 1)
+        (kind, payload) = json.loads(line.decode("utf-8"))
+        self.received[kind] = payload
+        return (kind, payload)
+
+    def waitFor(self, kind, timeout=None):
+        """Block until the message of `kind` arrives and return its payload."""
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            if timeout is None:
+                remaining = None
+            else:
+                remaining = max(deadline - time.time(), 0)
+            msg = self.receive(remaining)
+            if msg is None:
+                raise exceptions.DaemonTimeoutError(
+                    "Daemon did not report {0!r} in {1} seconds.".format(kind, timeout))
+            if expect(kind, msg):
+                return msg[1]
+
+    def close(self):
+        if self.fd is not None:
+            util.close_fd(self.fd)
+            self.fd = None
+
+def expect(kind, msg):
+    """Tell whether `msg` is the awaited message of `kind`.
+
+    Raises `exceptions.DaemonStartupError` if the message reports the
+    startup failure or the end of the status stream.
+    """
+    (msgKind, payload) = msg
+    if msgKind == kind:
+        return True
+    elif msgKind == ERROR:
+        raise exceptions.DaemonStartupError(
+            "Daemon failed during {0}: {1}: {2}".format(
+                payload[u"stage"], payload[u"type"], payload[u"message"]),
+            stage=payload[u"stage"],
+            excType=payload[u"type"],
+            excMessage=payload[u"message"],
+            remoteTraceback=payload[u"traceback"],
+        )
+    elif msgKind is EOF:
+        raise exceptions.DaemonStartupError(
+            "Daemon exited before reporting {0!r}.".format(kind))
+    return False
+
+class CompletedStatus(object):
+    """Status of a daemon that reported everything it had to report up front.
+
+    Used for daemons that do not speak the protocol (see `execdaemon`).
+    """
+
+    def __init__(self, messages):
+        super(CompletedStatus, self).__init__()
+        self.received = dict(messages)
+
+    def waitFor(self, kind, timeout=None):
+        try:
+            return self.received[kind]
+        except KeyError:
+            raise exceptions.DaemonStartupError("Daemon does not report {0!r}.".format(kind))
+
+    def close(self):
+        pass
+
+_activeWriter = None
+
+def activate(writer):
+    """Make `writer` the channel used by `notify_ready` in this process."""
+    global _activeWriter
+    _activeWriter = writer
+
+def notify_failure(stage, excInfo=None):
+    """Report the startup failure to the launcher.
+
+    Does nothing once the readiness has already been reported.
+    """
+    writer = _activeWriter
+    if writer is not None and not writer.closed:
+        writer.sendError(stage, excInfo)
+
+def notify_ready():
+    """Report to the launcher that the daemon is ready to serve.
+
+    Closes the status pipe; subsequent calls (and calls made outside of a
+    daemon spawned by a `Launcher`) do nothing.
+    """
+    writer = _activeWriter
+    if writer is not None and not writer.closed:
+        writer.send(READY)
+        writer.close()
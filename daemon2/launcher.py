@@ -20,14 +20,18 @@
 
 import os
 import logging
-import select
-
-import psutil
+import sys
 
 from . import (
     background,
     exceptions,
+    execdaemon,
+    handshake,
+    memory,
+    pidfiles,
+    termination,
     util,
+    waiter,
 )
 
 log = logging.getLogger(__name__)
@@ -39,43 +43,101 @@ class Launcher(object):
     """
 
     _spawnedPid = None # PID of the child daemon if it had been spawned by this launcher.
+    _spawnedRecord = None # `pidfiles.PidfileRecord` of the spawned daemon.
+    _pidfileCache = None
     pidfile = None
-
-    def __init__(self, pidfile=None):
-        """ Set up a new instance. """
+    forkServer = None
+    requires = () # Names of the daemons this one depends on (see `fleet.DaemonFleet`).
+    startupTimings = None # Timings reported by the last daemon started from a fresh interpreter.
+    pidTimeout = 10 # Seconds to wait for the spawned daemon to report its PID.
+    terminationPolicy = termination.TerminationPolicy()
+
+    def __init__(self, pidfile=None, forkServer=None, requires=()):
+        """ Set up a new instance.
+
+        If `forkServer` (a started `forkserver.ForkServer`) is given, the
+        daemons are forked by it instead of by the calling process.
+        `requires` names the daemons that have to be ready before this one
+        is started by `fleet.DaemonFleet`.
+        """
         super(Launcher, self).__init__()
         self.pidfile = pidfile
+        self.forkServer = forkServer
+        self.requires = tuple(requires)
 
-    def start(self, daemon):
+    def start(self, daemon, wait_ready=False, timeout=None):
         """
             Runs the daemon.
 
-            Return PID of the newly spawned daemon process.
+            Return PID of the newly spawned daemon process. Raises
+            `DaemonStartupError` as soon as the daemon reports a failure
+            that happened before it got ready.
+
+            If `wait_ready` is set, blocks until the daemon reports that it is
+            ready to serve (see `daemon2.notify_ready`). `DaemonTimeoutError`
+            is raised if that does not happen in `timeout` seconds.
         """
+        token = self._prepareStart()
+        (childPid, status) = self._forkDaemon(daemon, token=token)
+        self._setSpawnedPid(childPid, token)
+        try:
+            if wait_ready and childPid:
+                status.waitFor(handshake.READY, timeout)
+                log.debug("Daemon is ready (pid={}).".format(childPid))
+        finally:
+            status.close()
+        return childPid
+
+    def _prepareStart(self):
+        """Check that the daemon can be started; returns the token of the new instance."""
         self._unlockPidfile()
         if self.running:
             raise exceptions.DaemonError("Daemon is already running.")
         log.debug("Launching daemon...")
-        childPid = self._forkDaemon(daemon)
-        self._spawnedPid = childPid
-        return childPid
-
+        return pidfiles.new_token()
 
-    def terminate(self, block=True, timeout=None):
+    def terminate(self, block=True, timeout=None, policy=None):
         """Terminate the daemon.
 
-            Blocks until the daemon quits if `block` = True
+            The daemon's process group is terminated according to `policy`
+            (`terminationPolicy` by default); `timeout` overrides the grace
+            period the daemon gets before the termination escalates.
+
+            Blocks until the daemon quits if `block` = True, raising
+            `DaemonTimeoutError` if it survives the whole policy.
+
+            Returns the `termination.TerminationReport`.
         """
+        (pid, policy) = self._terminationTarget(policy)
+        return self._checkTerminated(policy.execute(pid, block=block, grace=timeout))
+
+    def _terminationTarget(self, policy):
+        """Return PID of the running daemon and the `policy` (or the default one) to terminate it by."""
         if not self.running:
             raise exceptions.DaemonError("Daemon is not running.")
+        pid = self.pid
+        assert pid, "If it is running, we have to have its PID"
+        return (pid, policy or self.terminationPolicy)
 
-        process = self.process
-        assert process, "If it is running, we have to have process handle for that"
-        process.terminate()
-        if block:
-            process.wait(timeout)
+    def _checkTerminated(self, report, what=u"Daemon"):
+        """Return the `report`, raise `DaemonTimeoutError` if the process survived the termination."""
+        if report.exited is False:
+            raise exceptions.DaemonTimeoutError(
+                "{0} (pid={1}) survived the termination: {2}".format(what, report.pid, report))
+        return report
 
-    def restart(self, daemon):
+    def wait(self, timeout=None):
+        """Block until the daemon exits.
+
+            Wakes up as soon as the daemon process terminates. Returns
+            ``False`` if it is still running after `timeout` seconds.
+        """
+        pid = self.pid
+        if not pid:
+            return True
+        return waiter.wait_for_exit(pid, timeout)
+
+    def restart(self, daemon, wait_ready=False, timeout=None):
         """Restart the daemon.
 
         Does not raise exceptions if it wasn't previously running.
@@ -84,29 +146,83 @@ class Launcher(object):
         if self.running:
             self.terminate()
         assert not self.running
-        return self.start(daemon)
+        return self.start(daemon, wait_ready=wait_ready, timeout=timeout)
+
+    def reload(self, daemon, timeout=None, policy=None):
+        """Restart the daemon without a period in which nobody serves.
+
+        The new daemon is started next to the running one. Once it reports
+        that it is ready (waiting at most `timeout` seconds), the pidfile is
+        atomically switched over to it and only then the old daemon is
+        terminated according to `policy`, which gives it the chance to
+        finish the requests it is processing.
+
+        Both generations serve the same listening sockets: the sockets
+        declared in the daemon's `listen` are handed over to the new daemon
+        by the running one (see `sockets.HandoffServer`), so the launching
+        process does not need to hold them; sockets inherited from the
+        launching process (listed in the daemon's `files_preserve`) are
+        shared as well.
+
+        If the daemon is not running, it is simply started. If the new
+        daemon fails to get ready, it is terminated and the old one keeps
+        running. Returns PID of the new daemon.
+        """
+        self._unlockPidfile()
+        if not self.running:
+            return self.start(daemon, wait_ready=True, timeout=timeout)
+        (oldPid, token) = self._prepareReload()
+        (newPid, status) = self._forkDaemon(daemon, takeover=True, token=token)
+        try:
+            status.waitFor(handshake.READY, timeout)
+        except:
+            if self._reloadFailed(newPid, oldPid):
+                (policy or self.terminationPolicy).execute(newPid)
+            raise
+        finally:
+            status.close()
+
+        self._switchOver(newPid, token)
+        self._checkTerminated((policy or self.terminationPolicy).execute(oldPid), u"Old daemon")
+        log.debug("Daemon reloaded (pid={0} -> {1}).".format(oldPid, newPid))
+        return newPid
+
+    def _prepareReload(self):
+        """Check that the running daemon can be reloaded; returns its PID and the token of the new one."""
+        if self.pidfile and not hasattr(self.pidfile, "path"):
+            raise exceptions.DaemonError("Reload requires a path-based pidfile, got {0!r}.".format(self.pidfile))
+        oldPid = self.pid
+        log.debug("Reloading daemon (pid={0})...".format(oldPid))
+        return (oldPid, pidfiles.new_token())
+
+    def _reloadFailed(self, newPid, oldPid):
+        """Log the failed reload; tells whether the new daemon is still there to be terminated."""
+        log.error("New daemon (pid={0}) failed to get ready, keeping the old one (pid={1}).".format(
+            newPid, oldPid))
+        return waiter.pid_exists(newPid)
+
+    def _switchOver(self, newPid, token):
+        """Point the pidfile at the new daemon that got ready."""
+        self._setSpawnedPid(newPid, token)
+        if self.pidfile:
+            pidfiles.replace_record(self.pidfile.path, self._spawnedRecord)
 
     def _unlockPidfile(self):
         """Unlock the pidlock that exists but does not point to the valid daemon process."""
         if not self.pidfile:
             return
-        pid = self.pidfile.read_pid()
+        record = self._readPidfile()
 
-        if not pid:
+        if not (record and record.pid):
             return
 
-        if not psutil.pid_exists(pid):
+        if pidfiles.is_stale(record):
             log.info("Breaking lock for the {!r}".format(self.pidfile))
             self.pidfile.break_lock()
 
     @property
     def running(self):
-        proc = self.process
-        if proc:
-            rv = proc.is_running()
-        else:
-            rv = False
-        return rv
+        return not pidfiles.is_stale(self._identity())
 
     _processCache = None
     @property
@@ -115,6 +231,7 @@ class Launcher(object):
 
         if (not self._processCache) or (pid != self._processCache[0]):
             if pid:
+                import psutil
                 try:
                     process = psutil.Process(pid)
                 except psutil.NoSuchProcess:
@@ -126,14 +243,32 @@ class Launcher(object):
 
         return self._processCache[1]
 
+    @property
+    def record(self):
+        """`pidfiles.PidfileRecord` describing the daemon (``None`` if unknown)."""
+        return self._identity()
+
     @property
     def pid(self):
+        record = self._identity()
+        return record.pid if record else None
+
+    def memory(self):
+        """Return the `memory.MemoryUsage` of the daemon and its child processes (workers) by PID."""
+        pid = self.pid if self.running else None
+        if not pid:
+            return {}
+        return memory.report(pid)
+
+    def _identity(self):
+        """Return the `pidfiles.PidfileRecord` describing the daemon (``None`` if unknown)."""
         pid1 = self._spawnedPid
 
         if self.pidfile:
-            pid2 = self.pidfile.read_pid()
+            fileRecord = self._readPidfile()
         else:
-            pid2 = None
+            fileRecord = None
+        pid2 = fileRecord.pid if fileRecord else None
 
         if None not in (pid1, pid2):
             if pid1 != pid2:
@@ -141,55 +276,181 @@ class Launcher(object):
                     pid1=pid1, pid2=pid2,
                 ))
 
-        return (pid1 or pid2)
+        if pid1:
+            return self._spawnedRecord
+        return fileRecord
 
-    def _forkDaemon(self, daemon):
-        """Fork to the daemonic mode and execute the `daemon` payload."""
-        def _fork(error_message):
-            """ Fork a child process, then exit the parent process.
+    def _setSpawnedPid(self, pid, token=None):
+        self._spawnedPid = pid
+        self._spawnedRecord = pidfiles.make_record(pid, token) if pid else None
 
-            If the fork fails, raise a ``DaemonProcessDetachError``
-            with ``error_message``.
+    def _readPidfile(self):
+        """Return the `pidfiles.PidfileRecord` stored in the pidfile.
 
-            """
-            try:
-                return os.fork()
-            except OSError, exc:
-                raise exceptions.DaemonProcessDetachError(u"{0}: [{1}] {2}".format(
-                    error_message, exc.errno, exc.strerror,
-                ))
+        Path-based pidfiles are read through `pidfiles.PidfileCache`, so
+        repeated calls cost a single ``stat()`` while the file is unchanged.
+        """
+        path = getattr(self.pidfile, "path", None)
+        if path is None:
+            pid = self.pidfile.read_pid()
+            return pidfiles.PidfileRecord(pid, None, None, None) if pid else None
+        if self._pidfileCache is None or self._pidfileCache.path != path:
+            self._pidfileCache = pidfiles.PidfileCache(path)
+        return self._pidfileCache.read()
 
-        (pidRead, pidWrite) = os.pipe()
-
-        if _fork(u"Failed first fork"):
-            # Original parent
-            util.close_fd(pidWrite)
-            (rList, _, _) = select.select([pidRead], (), (), 10)
-            if rList:
-                # Child started sending data
-                with os.fdopen(pidRead, "r") as fobj:
-                    # the `pidRead` is implicity closed by the `with` statement.
-                    txtPid = fobj.read()
-                    if txtPid:
-                        childPid = int(txtPid)
-                    else:
-                        # Something went wrong
-                        childPid = None
-            else:
-                # Select timeout. Something bad probably happened.
-                childPid = None
+    def _forkDaemon(self, daemon, takeover=False, token=None):
+        """Fork to the daemonic mode and execute the `daemon` payload.
+
+        If `takeover` is set, the daemon does not lock the pidfile itself
+        (see `reload`). `token` is recorded in the pidfile by the daemon.
+
+        Returns the daemon PID and the `handshake.StatusReader` connected to it.
+        """
+        (firstPid, status) = self._spawn(daemon, takeover, token)
+        try:
+            childPid = status.waitFor(handshake.PID, self.pidTimeout)
+        except:
+            excInfo = sys.exc_info()
+            status.close()
+            # The first child holds the reserved lock until it exits.
+            self._reapFirst(firstPid)
+            self._startupFailed(takeover, firstPid, excInfo)
+        self._reapFirst(firstPid)
+        self._noteTimings(status)
+        return (childPid, status)
+
+    def _reapFirst(self, firstPid):
+        """Reap the first child, it quits right after the second fork.
+
+        Otherwise its zombie lingers in the daemon's process group.
+        """
+        if firstPid:
+            waiter.wait_for_exit(firstPid, self.pidTimeout)
 
-            return childPid
+    def _startupFailed(self, takeover, firstPid, excInfo):
+        """Clean up after the daemon that failed to start and re-raise the failure.
+
+        `excInfo` is the ``sys.exc_info()`` of the failure; the first child
+        has to be reaped already.
+        """
+        self._cancelReservation(takeover, firstPid)
+        exc = excInfo[1]
+        if isinstance(exc, exceptions.DaemonStartupError) and exc.stage == u"pidlock":
+            raise exceptions.PIDFileLockedError(exc.excMessage or u"{0}".format(exc))
+        raise excInfo[0], excInfo[1], excInfo[2]
+
+    def _spawn(self, daemon, takeover, token):
+        """Start forking the `daemon` without waiting for it.
+
+        Returns PID of the process to be reaped once the daemon is forked
+        (``None`` if there is none) and the status reader of the daemon.
+        """
+        if isinstance(daemon, execdaemon.ExecDaemon):
+            # Readiness of an external command can not be told; it is ready once it is executed.
+            pid = daemon.spawn(self.pidfile, token=token, takeover=takeover)
+            status = handshake.CompletedStatus({handshake.PID: pid, handshake.READY: None})
+            firstPid = None
+        elif getattr(daemon, "fresh_interpreter", False):
+            from . import run
+            (firstPid, status) = run.spawn_fresh(daemon, self.pidfile, takeover=takeover, token=token)
+        elif self.forkServer:
+            status = self.forkServer.spawn(daemon, self.pidfile, takeover=takeover, token=token)
+            firstPid = None
         else:
-            os.setsid()
-            daemon.setupProcessSession([pidWrite])
-            pid = _fork(u"Failed second fork")
+            (pidRead, pidWrite) = os.pipe()
             try:
-                if not pid:
-                    with os.fdopen(pidWrite, "w") as fobj:
-                        fobj.write(str(os.getpid()))
-                    # Second child
-                    daemon.run(self.pidfile)
-                # call _exit for both first and second children
+                firstPid = spawn_daemon(daemon, self.pidfile, pidWrite, takeover=takeover, token=token)
             finally:
-                os._exit(0)
\ No newline at end of file
+                util.close_fd(pidWrite)
+            status = handshake.StatusReader(pidRead)
+        return (firstPid, status)
+
+    def _noteTimings(self, status):
+        timings = status.received.get(handshake.TIMINGS)
+        if timings:
+            self.startupTimings = timings
+            log.debug("Fresh interpreter startup timings: {0}".format(timings))
+
+    def _cancelReservation(self, takeover, firstPid):
+        """Remove the pidfile lock reserved for the daemon that failed to start."""
+        if self.pidfile and not takeover:
+            pids = set([os.getpid(), firstPid])
+            if self.forkServer:
+                pids.add(self.forkServer.pid)
+            pids.discard(None)
+            pidfiles.cancel_reservation(self.pidfile, pids)
+
+def _fork(error_message):
+    """ Fork a child process.
+
+    If the fork fails, raise a ``DaemonProcessDetachError``
+    with ``error_message``.
+
+    """
+    try:
+        return os.fork()
+    except OSError, exc:
+        raise exceptions.DaemonProcessDetachError(u"{0}: [{1}] {2}".format(
+            error_message, exc.errno, exc.strerror,
+        ))
+
+def spawn_daemon(daemon, pidfile, statusFd, takeover=False, token=None):
+    """ Double-fork the `daemon` into the background.
+
+        The daemon reports its PID, readiness or startup failure through
+        the `statusFd` descriptor (see `handshake`). Returns PID of the
+        intermediate child, which exits right after forking the daemon and
+        has to be reaped by the caller. `token` is recorded in the pidfile.
+
+        Unless `takeover` is set, the `pidfile` is locked before forking
+        (`exceptions.PIDFileLockedError` is raised right away if another
+        daemon holds it) and the lock is handed over to the daemon. If it is
+        set, the daemon takes the `listen` sockets over from the daemon the
+        `pidfile` names.
+
+        """
+    reserved = bool(pidfile) and not takeover
+    if reserved:
+        pidfiles.reserve(pidfile)
+    try:
+        firstPid = _fork(u"Failed first fork")
+    except:
+        if reserved:
+            pidfile.release()
+        raise
+    if firstPid:
+        if reserved:
+            pidfiles.hand_over(pidfile)
+        return firstPid
+
+    # First child
+    status = handshake.StatusWriter(statusFd)
+    stage = u"setupProcessSession"
+    rc = 0
+    try:
+        # Other threads of the launcher (e.g. `fleet.DaemonFleet`) might have held them.
+        util.reinit_logging_locks()
+        os.setsid()
+        daemon.setupProcessSession([statusFd] + pidfiles.lock_descriptors(pidfile),
+            predecessor=pidfile if takeover else None)
+        stage = u"fork"
+        pid = _fork(u"Failed second fork")
+        if not pid:
+            # Second child
+            if reserved:
+                stage = u"pidlock"
+                pidfiles.stamp(pidfile, token)
+            stage = u"run"
+            status.send(handshake.PID, os.getpid())
+            daemon.run(pidfile, status, acquirePidfile=False, token=token)
+    except:
+        if reserved and stage != u"run":
+            try:
+                pidfiles.drop_reservation(pidfile)
+            except Exception:
+                pass
+        status.sendError(stage)
+        rc = 1
+    finally:
+        # call _exit for both first and second children
+        os._exit(rc)
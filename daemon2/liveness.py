@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+"""Cheap daemon liveness checks.
+
+A process is alive if ``kill(pid, 0)`` finds it and its single
+``/proc/<pid>/stat`` read shows neither a zombie nor a start time other
+than the one recorded when its PID was learned (which means the PID got
+reused by an unrelated process). Systems without ``/proc`` get the
+``kill(pid, 0)`` answer alone.
+"""
+import errno
+import os
+
+from . import waiter
+
+PROC = "/proc"
+PROC_STAT = "/proc/{0}/stat"
+BOOT_ID = "/proc/sys/kernel/random/boot_id"
+
+# Process states of `/proc/<pid>/stat` that do not count as running.
+DEAD_STATES = ("Z", "X", "x")
+
+def read_stat(pid):
+    """ Return the ``(state, start time)`` of the process `pid`.
+
+        The start time is in clock ticks since boot. Returns ``None`` if
+        there is no such process or ``/proc`` is not available.
+        """
+    try:
+        with open(PROC_STAT.format(pid), "rb") as fobj:
+            data = fobj.read()
+    except (IOError, OSError) as exc:
+        if exc.errno in (errno.ENOENT, errno.ESRCH, errno.EACCES):
+            return None
+        raise
+    # The command name is parenthesized and may contain spaces or parentheses itself.
+    fields = data[data.rindex(b")") + 2:].split()
+    return (fields[0].decode("ascii"), int(fields[19]))
+
+def start_time(pid):
+    """ Return the start time of the process `pid` (``None`` if unknown). """
+    stat = read_stat(pid)
+    return stat[1] if stat else None
+
+def running_pids():
+    """ Return the set of PIDs of all the processes (``None`` if ``/proc`` is not available). """
+    try:
+        names = os.listdir(PROC)
+    except OSError:
+        return None
+    return frozenset(int(name) for name in names if name.isdigit())
+
+_bootId = None
+
+def boot_id():
+    """ Return the identifier of the current boot (``None`` if unknown). """
+    global _bootId
+    if _bootId is None:
+        try:
+            with open(BOOT_ID, "r") as fobj:
+                _bootId = fobj.read().strip()
+        except IOError:
+            _bootId = ""
+    return _bootId or None
+
+def is_alive(pid, startTime=None):
+    """ Tell whether `pid` is a running (not zombie) process.
+
+        If `startTime` is given, the process has to have been started at
+        that time; otherwise it is an unrelated process that reused the PID.
+        """
+    if not pid or not waiter.pid_exists(pid):
+        return False
+    stat = read_stat(pid)
+    if stat is None:
+        return True
+    (state, started) = stat
+    if state in DEAD_STATES:
+        return False
+    return startTime is None or started == startTime
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+"""Keeping the memory of the forked processes shared.
+
+Pages of the master process stay shared with the forked workers until one
+of them writes to them, and the interpreter writes to every object it
+touches: reference counts change and the garbage collector links the
+objects it examines. `prepare_fork` collects the garbage and moves the
+surviving objects out of the collector's reach (``gc.freeze``, Python 3.7
+and newer) right before forking, so that the collections in the workers do
+not dirty the pages of the preloaded objects; raising the collection
+thresholds makes the collections rarer.
+
+`usage` tells how much memory of a process is shared and how much is its
+own, from ``/proc/<pid>/smaps_rollup``.
+"""
+import collections
+import errno
+import gc
+
+from . import liveness
+
+SMAPS_ROLLUP = "/proc/{0}/smaps_rollup"
+SMAPS = "/proc/{0}/smaps"
+CHILDREN = "/proc/{0}/task/{0}/children"
+
+# Memory of a process in bytes: shared with other processes or private to it.
+MemoryUsage = collections.namedtuple("MemoryUsage", "rss pss shared private swap")
+
+_FIELDS = {
+    b"Rss": "rss",
+    b"Pss": "pss",
+    b"Shared_Clean": "shared",
+    b"Shared_Dirty": "shared",
+    b"Private_Clean": "private",
+    b"Private_Dirty": "private",
+    b"Swap": "swap",
+}
+
+def prepare_fork(freeze=True, threshold=None):
+    """ Get the heap of the current process ready to be shared with its forks.
+
+        Collects the garbage, freezes the remaining objects if `freeze` is
+        true and ``gc.freeze`` is available, and sets the collection
+        `threshold` (a tuple for ``gc.set_threshold``) if given. Returns the
+        number of the objects frozen (``None`` if none were).
+        """
+    gc.collect()
+    frozen = None
+    if freeze and hasattr(gc, "freeze"):
+        gc.freeze()
+        frozen = gc.get_freeze_count()
+    if threshold:
+        gc.set_threshold(*threshold)
+    return frozen
+
+def usage(pid):
+    """ Return the `MemoryUsage` of the process `pid`.
+
+        Reads ``/proc/<pid>/smaps_rollup``, or sums up ``/proc/<pid>/smaps``
+        on kernels older than 4.14. Returns ``None`` if there is no such
+        process or the files can not be read.
+        """
+    for path in (SMAPS_ROLLUP, SMAPS):
+        try:
+            with open(path.format(pid), "rb") as fobj:
+                data = fobj.read()
+        except (IOError, OSError) as exc:
+            if exc.errno == errno.ENOENT and path is SMAPS_ROLLUP:
+                continue
+            if exc.errno in (errno.ENOENT, errno.ESRCH, errno.EACCES):
+                return None
+            raise
+        return _parse(data)
+    return None
+
+def _parse(data):
+    totals = dict.fromkeys(MemoryUsage._fields, 0)
+    for line in data.splitlines():
+        (key, sep, value) = line.partition(b":")
+        attr = _FIELDS.get(key)
+        if attr is not None:
+            # Values are in kB.
+            totals[attr] += int(value.split()[0]) * 1024
+    return MemoryUsage(**totals)
+
+def child_pids(pid):
+    """ Return the PIDs of the child processes of `pid`. """
+    try:
+        with open(CHILDREN.format(pid), "rb") as fobj:
+            return [int(child) for child in fobj.read().split()]
+    except (IOError, OSError) as exc:
+        if exc.errno not in (errno.ENOENT, errno.EACCES):
+            raise
+    # Kernel without the `children` file: look for the processes naming `pid` as their parent.
+    children = []
+    for child in sorted(liveness.running_pids() or ()):
+        try:
+            with open(liveness.PROC_STAT.format(child), "rb") as fobj:
+                data = fobj.read()
+        except (IOError, OSError):
+            continue
+        if int(data[data.rindex(b")") + 2:].split()[1]) == pid:
+            children.append(child)
+    return children
+
+def describe(usage):
+    """ Return the human readable summary of the `MemoryUsage`. """
+    return "rss={0} kB, shared={1} kB, private={2} kB, pss={3} kB, swap={4} kB".format(
+        *(value // 1024 for value in (usage.rss, usage.shared, usage.private, usage.pss, usage.swap)))
+
+def report(pid):
+    """ Return the ordered mapping of `pid` and its child processes to their `MemoryUsage`. """
+    rv = collections.OrderedDict()
+    for process in [pid] + child_pids(pid):
+        processUsage = usage(process)
+        if processUsage is not None:
+            rv[process] = processUsage
+    return rv
@@ -0,0 +1,448 @@
+# -*- coding: utf-8 -*-
+
+"""PID files.
+
+Daemons started by the `launcher.Launcher` record more than the PID::
+
+    12345
+    start_time=4242424
+    boot_id=0f8c2a1e-7d3b-4f55-9e0c-6f1f3e2d9a77
+    token=5b2f6e0c9a4d1e83
+
+The first line is the PID alone, so readers that only know the classic
+format (``lockfile``, init scripts, ``pkill -F``) keep working. The start
+time of the process (in clock ticks since boot) and the boot id tell
+whether the PID still names the process that wrote the file, without
+looking at any other process; the token is generated by the launcher for
+every daemon it starts.
+"""
+import binascii
+import collections
+import errno
+import fcntl
+import os
+import threading
+import time
+
+from . import (
+    exceptions,
+    liveness,
+)
+
+PidfileRecord = collections.namedtuple("PidfileRecord", "pid startTime bootId token")
+
+_FIELDS = (
+    ("start_time", "startTime", int),
+    ("boot_id", "bootId", str),
+    ("token", "token", str),
+)
+
+def lockfile_class():
+    """ Return ``lockfile.pidlockfile.PIDLockFile``, importing ``lockfile`` on first use.
+
+        For the ``isinstance()`` checks and the subclasses of the pidfiles
+        created by `PIDLockFile`.
+        """
+    from lockfile.pidlockfile import PIDLockFile
+    return PIDLockFile
+
+def PIDLockFile(*args, **kwargs):
+    """ Create a ``lockfile.pidlockfile.PIDLockFile``.
+
+        The `lockfile` package is imported by the first call, so that
+        ``import daemon2`` does not pay for it.
+        """
+    return lockfile_class()(*args, **kwargs)
+
+class FlockPidfile(object):
+    """ PID file locked with ``flock()``.
+
+        The lock is held on an open descriptor, so the kernel releases it
+        the moment the holder dies: a stale lock is impossible and the file
+        left behind by a crashed daemon is simply locked again by the next
+        one. Waiting for the lock blocks in ``flock()`` instead of polling;
+        with a timeout, a helper thread does the waiting, so no signals or
+        timers of the application are touched.
+
+        Offers the subset of the ``lockfile.pidlockfile.PIDLockFile``
+        interface used by the launchers. `acquire` waits at most `timeout`
+        seconds (the one given to the constructor by default); ``None``
+        waits forever and ``0`` does not wait at all.
+    """
+
+    def __init__(self, path, timeout=None):
+        super(FlockPidfile, self).__init__()
+        self.path = path
+        self.timeout = timeout
+        self._fd = None
+
+    def acquire(self, timeout=None):
+        """Lock the file and write the PID of the current process into it.
+
+        Raises `exceptions.PIDFileLockedError` if the lock is not obtained
+        in time.
+        """
+        self._acquire(self.timeout if timeout is None else timeout)
+
+    def _acquire(self, timeout):
+        if self.i_am_locking():
+            return
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            fd = _open_cloexec(self.path, os.O_RDWR | os.O_CREAT)
+            remaining = None if deadline is None else max(deadline - time.time(), 0)
+            try:
+                locked = _flock(fd, remaining)
+                # The holder might have removed the file before releasing the lock.
+                if locked and _same_file(fd, self.path):
+                    break
+            except:
+                os.close(fd)
+                raise
+            os.close(fd)
+            if not locked:
+                raise exceptions.PIDFileLockedError(u"{0!r} is locked by the pid {1}".format(
+                    self.path, self.read_pid()))
+        if self.read_pid() != os.getpid():
+            data = "{0}\n".format(os.getpid()).encode("ascii")
+            os.ftruncate(fd, 0)
+            os.write(fd, data)
+        self._fd = fd
+
+    def adopt(self):
+        """Take the lock over from the previous holder in the background.
+
+        Used by the daemon started by `launcher.Launcher.reload`: the lock is
+        obtained as soon as the previous daemon generation exits, on the file
+        the launcher switched over to the new daemon.
+        """
+        thread = threading.Thread(target=self._acquire, args=(None, ), name="pidfile-adopt")
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def release(self):
+        """Remove the file and release the lock."""
+        if not self.i_am_locking():
+            raise exceptions.PIDFileError(u"{0!r} is not locked by this process".format(self.path))
+        fd = self._fd
+        self._fd = None
+        try:
+            # Removed while still locked, so that nobody locks the dying file.
+            _unlink(self.path)
+        finally:
+            os.close(fd)
+
+    def read_pid(self):
+        """Return the PID stored in the file (``None`` if none)."""
+        record = read_record(self.path)
+        return record.pid if record else None
+
+    def is_locked(self):
+        """Tell whether some process holds the lock."""
+        try:
+            fd = _open_cloexec(self.path, os.O_RDONLY)
+        except OSError as exc:
+            if exc.errno == errno.ENOENT:
+                return False
+            raise
+        try:
+            return not _flock(fd, 0, fcntl.LOCK_SH)
+        finally:
+            os.close(fd)
+
+    def i_am_locking(self):
+        """Tell whether the lock is held by this process (through this object)."""
+        return self._fd is not None and _same_file(self._fd, self.path)
+
+    def break_lock(self):
+        """Remove the file unless some process holds the lock."""
+        try:
+            fd = _open_cloexec(self.path, os.O_RDWR)
+        except OSError as exc:
+            if exc.errno == errno.ENOENT:
+                return
+            raise
+        try:
+            if _flock(fd, 0) and _same_file(fd, self.path):
+                _unlink(self.path)
+        finally:
+            os.close(fd)
+
+    def detach(self):
+        """Forget the lock without releasing it.
+
+        Called in the process that locked the file before forking the
+        daemon: the lock stays held through the descriptor the daemon
+        inherited.
+        """
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def fileno(self):
+        """Return the descriptor holding the lock (``None`` if not locked)."""
+        return self._fd
+
+    def __repr__(self):
+        return "<{0} {1!r}>".format(self.__class__.__name__, self.path)
+
+def _open_cloexec(path, flags):
+    fd = os.open(path, flags, 0o644)
+    fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+    return fd
+
+def _same_file(fd, path):
+    """Tell whether `fd` refers to the file currently present at `path`."""
+    try:
+        st = os.stat(path)
+    except OSError as exc:
+        if exc.errno == errno.ENOENT:
+            return False
+        raise
+    fst = os.fstat(fd)
+    return (st.st_dev, st.st_ino) == (fst.st_dev, fst.st_ino)
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError as exc:
+        if exc.errno != errno.ENOENT:
+            raise
+
+def _flock(fd, timeout, operation=fcntl.LOCK_EX):
+    """ Lock `fd`, waiting at most `timeout` seconds (forever if ``None``).
+
+        Returns whether the lock got acquired. If it did not, the caller
+        has to close `fd`, which also releases the lock acquired too late.
+        """
+    try:
+        fcntl.flock(fd, operation | fcntl.LOCK_NB)
+        return True
+    except (IOError, OSError) as exc:
+        if exc.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+    if timeout is None:
+        _flock_blocking(fd, operation)
+        return True
+    if timeout <= 0:
+        return False
+    # ``flock()`` has no timeout: a helper thread blocks in it on a duplicate
+    # of `fd` (the lock belongs to the open file both refer to) and is left
+    # behind once the timeout expires.
+    waitFd = os.dup(fd)
+    fcntl.fcntl(waitFd, fcntl.F_SETFD, fcntl.fcntl(waitFd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+    outcome = []
+
+    def _wait():
+        try:
+            _flock_blocking(waitFd, operation)
+            outcome.append(None)
+        except Exception as exc:
+            outcome.append(exc)
+        finally:
+            os.close(waitFd)
+
+    thread = threading.Thread(target=_wait, name="flock-wait")
+    thread.daemon = True
+    thread.start()
+    thread.join(timeout)
+    if not outcome:
+        return False
+    if outcome[0] is not None:
+        raise outcome[0]
+    return True
+
+def _flock_blocking(fd, operation):
+    while True:
+        try:
+            fcntl.flock(fd, operation)
+            return
+        except (IOError, OSError) as exc:
+            if exc.errno != errno.EINTR:
+                raise
+
+def reserve(pidfile):
+    """ Lock `pidfile` on behalf of the daemon about to be forked.
+
+        Does not wait: raises `exceptions.PIDFileLockedError` if the file is
+        locked already. The forked daemon claims the reserved lock with
+        `stamp`; the forking process gives it up with `hand_over`.
+        """
+    try:
+        pidfile.acquire(0)
+    except exceptions.PIDFileLockedError:
+        raise
+    except Exception as exc:
+        # Like `lockfile.AlreadyLocked`.
+        if not pidfile.is_locked():
+            raise
+        raise exceptions.PIDFileLockedError(u"{0!r} is locked by the pid {1} ({2})".format(
+            getattr(pidfile, "path", pidfile), pidfile.read_pid(), exc))
+
+def hand_over(pidfile):
+    """ Drop the reference the forking process holds to the reserved lock. """
+    detach = getattr(pidfile, "detach", None)
+    if detach is not None:
+        detach()
+
+def lock_descriptors(pidfile):
+    """ Return the descriptors holding the lock of `pidfile`; they must survive the daemonization. """
+    fileno = getattr(pidfile, "fileno", None)
+    fd = fileno() if fileno is not None else None
+    return [] if fd is None else [fd]
+
+def drop_reservation(pidfile):
+    """ Remove the reserved `pidfile` from the forked process holding its lock.
+
+        Called by the daemon that fails before claiming the lock: the file
+        is removed while the lock is still held, so that the launcher does
+        not have to race with the exit of this process to break it.
+        """
+    path = getattr(pidfile, "path", None)
+    for fd in lock_descriptors(pidfile):
+        if path is not None and _same_file(fd, path):
+            _unlink(path)
+
+def cancel_reservation(pidfile, pids):
+    """ Remove the lock reserved by one of the `pids` for a daemon that failed to claim it. """
+    if pidfile.read_pid() in pids:
+        pidfile.break_lock()
+
+def new_token():
+    """ Generate the random token identifying a daemon instance. """
+    return binascii.hexlify(os.urandom(8)).decode("ascii")
+
+def make_record(pid, token=None):
+    """ Describe the running process `pid`. """
+    return PidfileRecord(pid, liveness.start_time(pid), liveness.boot_id(), token)
+
+def format_record(record):
+    """ Return the PID file content for `record`. """
+    lines = [str(record.pid)]
+    for (key, attr, _) in _FIELDS:
+        value = getattr(record, attr)
+        if value is not None:
+            lines.append("{0}={1}".format(key, value))
+    return "\n".join(lines) + "\n"
+
+def parse_record(text):
+    """ Parse the PID file content; returns ``None`` if it does not start with a PID. """
+    lines = text.splitlines()
+    try:
+        pid = int(lines[0].strip())
+    except (IndexError, ValueError):
+        return None
+    values = {}
+    for line in lines[1:]:
+        (key, sep, value) = line.strip().partition("=")
+        values[key] = value
+    fields = {}
+    for (key, attr, convert) in _FIELDS:
+        try:
+            fields[attr] = convert(values[key]) if values.get(key) else None
+        except ValueError:
+            fields[attr] = None
+    return PidfileRecord(pid, **fields)
+
+def read_record(path):
+    """ Return the `PidfileRecord` stored in the file at `path` (``None`` if none). """
+    try:
+        with open(path, "r") as fobj:
+            text = fobj.read()
+    except IOError as exc:
+        if exc.errno == errno.ENOENT:
+            return None
+        raise
+    return parse_record(text)
+
+def write_record(path, record):
+    """ Rewrite the content of the existing PID file in place.
+
+        Used by the lock holder; the file is not created, so a lock that
+        got broken in the meantime is not resurrected.
+        """
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        data = format_record(record).encode("ascii")
+        os.write(fd, data)
+        os.ftruncate(fd, len(data))
+    finally:
+        os.close(fd)
+
+def replace_record(path, record):
+    """ Atomically replace the content of the PID file at `path`.
+
+        Writes `record` into a temporary file next to `path` and renames it
+        over `path`, so readers see either the old or the new content and
+        the file never stops existing.
+
+        """
+    tmpPath = u"{0}.{1}.tmp".format(path, os.getpid())
+    try:
+        fd = os.open(tmpPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.write(fd, format_record(record).encode("ascii"))
+        finally:
+            os.close(fd)
+        os.rename(tmpPath, path)
+    except OSError as exc:
+        raise exceptions.DaemonOSEnvironmentError(u"Unable to replace PID file {0!r} ({1})".format(
+            path, exc,
+        ))
+
+def stamp(pidfile, token=None, pid=None):
+    """ Record the extended information about the process `pid` (the current one by default) in the locked `pidfile`. """
+    path = getattr(pidfile, "path", None)
+    if path is not None:
+        write_record(path, make_record(pid or os.getpid(), token))
+
+def is_stale(record, livePids=None):
+    """ Tell whether `record` does not describe a running process.
+
+        Costs a ``kill(pid, 0)`` and a ``/proc/<pid>/stat`` read at most: a
+        record from another boot is stale without looking at the process,
+        one with the start time is stale if the PID got reused since.
+        `livePids` (see `liveness.running_pids`) saves the lookup of the
+        processes that are gone when checking many records.
+        """
+    if record is None or not record.pid:
+        return True
+    if record.bootId and record.bootId != liveness.boot_id():
+        return True
+    if livePids is not None and record.pid not in livePids:
+        return True
+    return not liveness.is_alive(record.pid, record.startTime)
+
+class PidfileCache(object):
+    """ PID file contents, read again only when the file changes.
+
+        The file is identified by its inode, modification time and size, so
+        a check costs a single ``stat()`` while the file stays the same.
+        Files in the classic format get the start time of the process
+        recorded when the PID is read.
+    """
+
+    def __init__(self, path):
+        super(PidfileCache, self).__init__()
+        self.path = path
+        self.record = None
+        self._key = None
+
+    def read(self):
+        """Return the `PidfileRecord` stored in the file (``None`` if none)."""
+        try:
+            st = os.stat(self.path)
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+            key = None
+        else:
+            key = (st.st_ino, st.st_mtime, st.st_size)
+        if key is None or key != self._key:
+            record = read_record(self.path) if key else None
+            if record and record.startTime is None:
+                record = record._replace(startTime=liveness.start_time(record.pid))
+            self.record = record
+            self._key = key
+        return self.record
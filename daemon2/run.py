@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+
+"""Launching daemons from a fresh interpreter.
+
+A forked daemon keeps every module, cache and heap page of the launching
+process. For daemons with ``fresh_interpreter=True`` the launcher instead
+executes ``python -m daemon2.run pkg.module:callable``, passing the daemon
+settings (serialized to JSON) and the status pipe in the environment. The
+new interpreter imports the target, rebuilds the `background.Daemon` and
+double-forks it as usual, reporting the startup timings over the status
+pipe before the daemon's PID.
+
+Everything referenced by the daemon has to be serializable: callables
+(`target`, `signal_map` values) must be importable module-level objects,
+`stdin`, `stdout`, `stderr` and `files_preserve` must be file descriptors
+or objects with a ``fileno()`` method.
+
+Started by hand, ``python -m daemon2.run pkg.module:callable`` daemonizes
+the callable with the default settings and prints the daemon PID.
+"""
+import json
+import logging
+import os
+import sys
+import time
+
+from . import (
+    background,
+    exceptions,
+    execdaemon,
+    handshake,
+    launcher,
+    sockets,
+    waiter,
+    workers,
+)
+
+log = logging.getLogger(__name__)
+
+SETTINGS_ENV = "DAEMON2_SETTINGS"
+STATUS_FD_ENV = "DAEMON2_STATUS_FD"
+SPAWNED_AT_ENV = "DAEMON2_SPAWNED_AT"
+
+def callable_spec(func):
+    """ Return the ``module:name`` string `func` can be imported by. """
+    module = getattr(func, "__module__", None)
+    name = getattr(func, "__name__", None)
+    if not (module and name) or module == "__main__":
+        raise exceptions.DaemonError("{0!r} can not be referenced from a fresh interpreter.".format(func))
+    spec = u"{0}:{1}".format(module, name)
+    if getattr(sys.modules.get(module), name, None) is not func:
+        raise exceptions.DaemonError("{0!r} is not importable as {1!r}.".format(func, spec))
+    return spec
+
+def resolve_spec(spec):
+    """ Import the object named by the ``module:name`` string. """
+    (moduleName, sep, name) = spec.partition(u":")
+    if not sep:
+        raise ValueError("{0!r} is not in the 'module:name' form.".format(spec))
+    __import__(moduleName)
+    obj = sys.modules[moduleName]
+    for attr in name.split(u"."):
+        obj = getattr(obj, attr)
+    return obj
+
+def _fileno(obj):
+    if obj is None or isinstance(obj, int):
+        return obj
+    return obj.fileno()
+
+def serialize_daemon(daemon, pidfile=None, takeover=False, token=None):
+    """ Return the JSON-compatible settings of `daemon`. """
+    target = daemon.target
+    if not isinstance(target, basestring):
+        target = callable_spec(target)
+    listen = []
+    for spec in daemon.listen:
+        if isinstance(spec, sockets.Listener):
+            spec = dict(vars(spec))
+        listen.append(spec)
+    policy = daemon.restart_policy
+    if daemon.source is not None:
+        raise exceptions.DaemonError("{0!r} can not be passed to a fresh interpreter.".format(daemon.source))
+    return {
+        u"name": daemon.name,
+        u"target": target,
+        u"chroot_directory": daemon.chroot_directory,
+        u"working_directory": daemon.working_directory,
+        u"umask": daemon.umask,
+        u"uid": daemon.uid,
+        u"gid": daemon.gid,
+        u"prevent_core": daemon.prevent_core,
+        u"files_preserve": [_fileno(obj) for obj in daemon.files_preserve],
+        u"stdio": [_fileno(obj) is not None for obj in (daemon.stdin, daemon.stdout, daemon.stderr)],
+        u"signal_map": dict(
+            (name, handle if handle is None or isinstance(handle, basestring) else callable_spec(handle))
+            for (name, handle) in daemon.signal_map.items()
+        ),
+        u"logging": daemon.loggingConfig,
+        u"explicit_ready": daemon.explicit_ready,
+        u"workers": daemon.workers,
+        u"supervise": daemon.supervise,
+        u"restart_policy": None if policy is None else dict(vars(policy)),
+        u"listen": listen,
+        u"cleanup_timeout": daemon.cleanup_timeout,
+        u"drain_timeout": daemon.drain_timeout,
+        u"threads": daemon.threads,
+        u"queue_size": daemon.queue_size,
+        u"preload": [step if isinstance(step, basestring) else callable_spec(step) for step in daemon.preload],
+        u"gc_freeze": daemon.gc_freeze,
+        u"gc_threshold": daemon.gc_threshold,
+        u"pidfile": None if pidfile is None else {
+            u"class": callable_spec(type(pidfile)),
+            u"path": pidfile.path,
+        },
+        u"takeover": takeover,
+        u"token": token,
+    }
+
+def deserialize_daemon(settings):
+    """ Rebuild the daemon and its pidfile from `settings`; returns ``(daemon, pidfile)``. """
+    (stdin, stdout, stderr) = (
+        os.fdopen(fd, mode) if present else None
+        for (present, fd, mode) in zip(settings[u"stdio"], (0, 1, 2), ("r", "w", "w"))
+    )
+    policy = settings[u"restart_policy"]
+    listen = [
+        spec if isinstance(spec, basestring) else sockets.Listener(**dict(
+            (str(key), tuple(value) if key == u"address" and isinstance(value, list) else value)
+            for (key, value) in spec.items()
+        ))
+        for spec in settings[u"listen"]
+    ]
+    daemon = background.Daemon(settings[u"name"], resolve_spec(settings[u"target"]),
+        chroot_directory=settings[u"chroot_directory"],
+        working_directory=settings[u"working_directory"],
+        umask=settings[u"umask"],
+        uid=settings[u"uid"],
+        gid=settings[u"gid"],
+        prevent_core=settings[u"prevent_core"],
+        files_preserve=settings[u"files_preserve"],
+        stdin=stdin,
+        stdout=stdout,
+        stderr=stderr,
+        signal_map=dict(
+            (str(name), handle if handle is None else resolve_spec(handle))
+            for (name, handle) in settings[u"signal_map"].items()
+        ),
+        logging=settings[u"logging"],
+        explicit_ready=settings[u"explicit_ready"],
+        workers=settings[u"workers"],
+        supervise=settings[u"supervise"],
+        restart_policy=None if policy is None else workers.RestartPolicy(
+            **dict((str(key), value) for (key, value) in policy.items())),
+        listen=listen,
+        cleanup_timeout=settings[u"cleanup_timeout"],
+        drain_timeout=settings[u"drain_timeout"],
+        threads=settings[u"threads"],
+        queue_size=settings[u"queue_size"],
+        # Module names have no colon, callables are ``module:name`` specs.
+        preload=[resolve_spec(step) if u":" in step else str(step) for step in settings[u"preload"]],
+        gc_freeze=settings[u"gc_freeze"],
+        gc_threshold=None if settings[u"gc_threshold"] is None else tuple(settings[u"gc_threshold"]),
+    )
+    pidfileSettings = settings[u"pidfile"]
+    if pidfileSettings:
+        pidfile = resolve_spec(pidfileSettings[u"class"])(pidfileSettings[u"path"])
+    else:
+        pidfile = None
+    return (daemon, pidfile)
+
+def spawn_fresh(daemon, pidfile, takeover=False, token=None):
+    """ Start the `daemon` from a fresh interpreter.
+
+        Returns PID of the interpreter (which exits once the daemon is
+        forked and has to be reaped by the caller) and the
+        `handshake.StatusReader` connected to the daemon.
+        """
+    settings = serialize_daemon(daemon, pidfile, takeover, token)
+    (statusRead, statusWrite) = os.pipe()
+    try:
+        env = dict(os.environ)
+        env[SETTINGS_ENV] = json.dumps(settings)
+        env[STATUS_FD_ENV] = str(statusWrite)
+        env[SPAWNED_AT_ENV] = repr(time.time())
+        env["PYTHONPATH"] = os.pathsep.join(os.path.abspath(path) for path in sys.path if path)
+        interpreter = execdaemon.ExecDaemon(
+            [sys.executable, "-m", "daemon2.run", settings[u"target"]],
+            env=env,
+            working_directory=os.getcwd(),
+            umask=daemon.umask,
+            files_preserve=[statusWrite] + settings[u"files_preserve"],
+            stdin=daemon.stdin,
+            stdout=daemon.stdout,
+            stderr=daemon.stderr,
+        )
+        pid = interpreter.spawn(None)
+    except:
+        os.close(statusRead)
+        raise
+    finally:
+        os.close(statusWrite)
+    return (pid, handshake.StatusReader(statusRead))
+
+def main(argv):
+    startedAt = time.time()
+    spawnedAt = float(os.environ.pop(SPAWNED_AT_ENV, startedAt))
+    statusFd = os.environ.pop(STATUS_FD_ENV, None)
+    settings = os.environ.pop(SETTINGS_ENV, None)
+    status = handshake.StatusWriter(int(statusFd)) if statusFd else None
+
+    if len(argv) != 1 and not status:
+        sys.stderr.write("Usage: python -m daemon2.run pkg.module:callable\n")
+        return 2
+
+    stage = u"import"
+    try:
+        modulesBefore = len(sys.modules)
+        importStarted = time.time()
+        if settings:
+            settings = json.loads(settings)
+            (daemon, pidfile) = deserialize_daemon(settings)
+        else:
+            (daemon, pidfile) = (background.Daemon(argv[-1], resolve_spec(argv[-1])), None)
+        timings = {
+            u"interpreter": importStarted - spawnedAt,
+            u"import": time.time() - importStarted,
+            u"modules": len(sys.modules) - modulesBefore,
+        }
+    except:
+        if status:
+            status.sendError(stage)
+            return 1
+        raise
+
+    if not status:
+        print(launcher.Launcher().start(daemon))
+        return 0
+
+    status.send(handshake.TIMINGS, timings)
+    try:
+        firstPid = launcher.spawn_daemon(daemon, pidfile, status.fd,
+            takeover=settings[u"takeover"], token=settings[u"token"])
+    except exceptions.PIDFileLockedError:
+        status.sendError(u"pidlock")
+        return 1
+    except:
+        status.sendError(u"fork")
+        return 1
+    status.close()
+    waiter.wait_for_exit(firstPid)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
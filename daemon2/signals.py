@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+"""Deferred dispatch of the user signal handlers.
+
+The handlers of `background.Daemon.signal_map` are not run by the Python
+signal handler: that would run them in the main thread at whatever
+bytecode the target happens to execute, and a burst of signals would
+re-enter them. The signal handler only notes the arrival of the signal and
+wakes up the dispatcher thread through a pipe (the self-pipe trick, which
+unlike ``signal.set_wakeup_fd`` tells the signals apart on Python 2 as
+well); the thread calls the handler. A signal arriving while the same
+signal still waits for its dispatch is coalesced into it and counted as
+dropped.
+"""
+import collections
+import errno
+import fcntl
+import logging
+import os
+import select
+import signal
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+SignalStats = collections.namedtuple("SignalStats", [
+    "received", # Signals delivered to the process.
+    "dispatched", # Handler calls.
+    "dropped", # Signals coalesced into a pending dispatch.
+    "lastLatency", # Seconds between the arrival and the handler call (``None`` if never called).
+    "maxLatency",
+])
+
+class SignalDispatcher(object):
+    """ Calls the registered signal handlers from a dedicated thread.
+
+        Handlers take no arguments. Exceptions they raise are logged.
+    """
+
+    def __init__(self):
+        super(SignalDispatcher, self).__init__()
+        self.handlers = {} # signal number -> handler
+        self._pending = {} # signal number -> arrival time of the oldest undispatched signal
+        self._received = collections.Counter()
+        self._dispatched = collections.Counter()
+        self._latency = {} # signal number -> (last, max)
+        self._pipe = None
+        self._thread = None
+
+    def register(self, signalNumber, handler):
+        """Register `handler` for `signalNumber`; returns the function to be installed with ``signal.signal``."""
+        self.handlers[signalNumber] = handler
+        return self.onSignal
+
+    def start(self):
+        """Start the dispatcher thread."""
+        if self._thread is not None or not self.handlers:
+            return
+        (rfd, wfd) = os.pipe()
+        for fd in (rfd, wfd):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        self._pipe = (rfd, wfd)
+        self._thread = threading.Thread(target=self._run, args=(rfd, ), name="signal-dispatcher")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def restart(self):
+        """Start over in the child process of a ``fork()``, which does not inherit the thread."""
+        self._close()
+        self._thread = None
+        self._pending.clear()
+        self._received.clear()
+        self._dispatched.clear()
+        self._latency.clear()
+        self.start()
+
+    def stop(self, timeout=1.0):
+        """Restore the default handlers and wait (at most `timeout` seconds) for the dispatcher thread to finish."""
+        for signalNumber in self.handlers:
+            signal.signal(signalNumber, signal.SIG_DFL)
+        (pipe, thread) = (self._pipe, self._thread)
+        (self._pipe, self._thread) = (None, None)
+        if pipe is None:
+            return
+        if thread is None:
+            self._pipe = pipe
+            self._close()
+            return
+        # The thread finishes once it reads the end of the pipe and closes the read end itself, so
+        # the descriptor can not get reused by another file while the thread still reads it.
+        os.close(pipe[1])
+        if thread is not threading.current_thread():
+            thread.join(timeout)
+            if thread.is_alive():
+                log.warning("Signal dispatcher thread did not finish in {0} seconds.".format(timeout))
+
+    def _close(self):
+        """Close the pipe in the process without the dispatcher thread."""
+        if self._pipe is not None:
+            for fd in self._pipe:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+            self._pipe = None
+
+    def onSignal(self, signalNumber, stackFrame):
+        """Python signal handler: notes the signal and wakes the dispatcher thread up."""
+        self._received[signalNumber] += 1
+        self._pending.setdefault(signalNumber, time.time())
+        pipe = self._pipe
+        if pipe is None:
+            return
+        try:
+            os.write(pipe[1], b"\0")
+        except OSError as exc:
+            # A full pipe wakes the thread up just as well.
+            if exc.errno not in (errno.EAGAIN, errno.EBADF):
+                raise
+
+    def _run(self, rfd):
+        try:
+            while True:
+                try:
+                    select.select([rfd], (), ())
+                    data = os.read(rfd, 512)
+                except (select.error, OSError) as exc:
+                    if exc.args[0] in (errno.EINTR, errno.EAGAIN):
+                        continue
+                    raise
+                if not data:
+                    # The write end got closed by `stop`.
+                    return
+                for signalNumber in sorted(self._pending):
+                    self._dispatch(signalNumber)
+        finally:
+            try:
+                os.close(rfd)
+            except OSError:
+                pass
+
+    def _dispatch(self, signalNumber):
+        arrived = self._pending.pop(signalNumber, None)
+        if arrived is None:
+            return
+        latency = time.time() - arrived
+        (_, maxLatency) = self._latency.get(signalNumber, (None, 0.0))
+        self._latency[signalNumber] = (latency, max(latency, maxLatency))
+        self._dispatched[signalNumber] += 1
+        try:
+            self.handlers[signalNumber]()
+        except Exception:
+            log.exception("Handler of the signal {0} failed.".format(signalNumber))
+
+    def stats(self):
+        """Return the mapping of the registered signal numbers to `SignalStats`."""
+        rv = {}
+        for signalNumber in self.handlers:
+            received = self._received[signalNumber]
+            dispatched = self._dispatched[signalNumber]
+            pending = 1 if signalNumber in self._pending else 0
+            (lastLatency, maxLatency) = self._latency.get(signalNumber, (None, None))
+            rv[signalNumber] = SignalStats(received, dispatched, received - dispatched - pending,
+                lastLatency, maxLatency)
+        return rv
@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+
+"""Listening sockets bound by the daemon before it drops privileges.
+
+The sockets are handed over from one daemon generation to the next one on
+`Launcher.reload`: every daemon listening on some sockets serves them on a
+unix socket in the abstract namespace named after its pidfile and PID
+(`HandoffServer`), and the new generation receives the descriptors from
+there (``SCM_RIGHTS``) instead of binding the addresses again. Only the
+processes of the same user (or root) get them.
+"""
+import errno
+import fcntl
+import json
+import logging
+import os
+import socket
+import stat
+import struct
+import sys
+import threading
+
+from . import exceptions
+
+log = logging.getLogger(__name__)
+
+LISTEN_FDS_ENV = "DAEMON2_LISTEN_FDS"
+HANDOFF_TIMEOUT = 5.0 # Seconds to wait for the sockets of the previous daemon generation.
+
+# Constants missing from the `socket` module on older interpreters.
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", 15 if sys.platform.startswith("linux") else None)
+SO_DOMAIN = getattr(socket, "SO_DOMAIN", 39 if sys.platform.startswith("linux") else None)
+SO_PEERCRED = getattr(socket, "SO_PEERCRED", 17 if sys.platform.startswith("linux") else None)
+
+_UCRED = struct.Struct("3i") # pid, uid, gid
+_LENGTH = struct.Struct("!I")
+
+class Listener(object):
+    """ Declaration of a listening socket.
+
+        `kind` is one of ``"tcp"``, ``"udp"`` and ``"unix"``. `address` is a
+        ``(host, port)`` tuple for the first two and a filesystem path for
+        the latter. `backlog` is passed to ``listen()`` (not used for UDP),
+        `reuse_port` enables ``SO_REUSEPORT`` so that several processes (e.g.
+        two daemon generations during `Launcher.reload`) can bind the same
+        address, and `mode` sets the permissions of the unix socket file.
+    """
+
+    def __init__(self, address, kind=u"tcp", backlog=128, reuse_port=False,
+        reuse_address=True, mode=None,
+    ):
+        super(Listener, self).__init__()
+        if kind not in (u"tcp", u"udp", u"unix"):
+            raise ValueError("Unknown socket kind {0!r}".format(kind))
+        self.address = address
+        self.kind = kind
+        self.backlog = backlog
+        self.reuse_port = reuse_port
+        self.reuse_address = reuse_address
+        self.mode = mode
+
+    @classmethod
+    def parse(cls, spec, **kwargs):
+        """ Create the `Listener` from the ``kind://address`` string.
+
+            Accepts ``tcp://host:port``, ``udp://host:port`` (IPv6 hosts
+            enclosed in brackets) and ``unix:///path/to/socket``.
+            """
+        (kind, sep, rest) = spec.partition(u"://")
+        if not sep:
+            raise ValueError("Listen address {0!r} lacks the 'kind://' prefix.".format(spec))
+        if kind == u"unix":
+            address = rest
+        else:
+            (host, sep, port) = rest.rpartition(u":")
+            if not sep or not port.isdigit():
+                raise ValueError("Listen address {0!r} lacks the port.".format(spec))
+            address = (host.strip(u"[]"), int(port))
+        return cls(address, kind=kind, **kwargs)
+
+    def open(self):
+        """Create, bind and return the listening socket."""
+        if self.kind == u"unix":
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._removeStaleSocket(self.address)
+            bindAddress = self.address
+        else:
+            sockType = socket.SOCK_STREAM if self.kind == u"tcp" else socket.SOCK_DGRAM
+            (host, port) = self.address
+            (family, _, _, _, bindAddress) = socket.getaddrinfo(
+                host or None, port, socket.AF_UNSPEC, sockType, 0, socket.AI_PASSIVE)[0]
+            sock = socket.socket(family, sockType)
+        try:
+            if self.reuse_address and self.kind != u"unix":
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.reuse_port:
+                if SO_REUSEPORT is None:
+                    raise exceptions.DaemonOSEnvironmentError(u"SO_REUSEPORT is not supported on this system")
+                sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+            sock.bind(bindAddress)
+            if self.kind == u"unix" and self.mode is not None:
+                os.chmod(self.address, self.mode)
+            if self.kind != u"udp":
+                sock.listen(self.backlog)
+        except socket.error as exc:
+            sock.close()
+            raise exceptions.DaemonOSEnvironmentError(u"Unable to listen on {0!r} ({1})".format(self, exc))
+        if hasattr(sock, "set_inheritable"):
+            sock.set_inheritable(True)
+        return sock
+
+    @property
+    def key(self):
+        """Identity of the declaration, the sockets are handed over between the equal ones."""
+        address = list(self.address) if isinstance(self.address, tuple) else self.address
+        return json.dumps([self.kind, address])
+
+    def _removeStaleSocket(self, path):
+        try:
+            if stat.S_ISSOCK(os.stat(path).st_mode):
+                os.unlink(path)
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+
+    def __repr__(self):
+        return "<{0} {1}://{2}>".format(self.__class__.__name__, self.kind, self.address)
+
+def as_listener(spec):
+    """ Convert the `listen` option element to the `Listener`. """
+    if isinstance(spec, Listener):
+        return spec
+    return Listener.parse(spec)
+
+_sockets = []
+
+def bind_all(specs, inherited=None):
+    """ Open the listening sockets for every element of `specs`.
+
+        `inherited` maps `Listener.key` to the sockets received from the
+        previous daemon generation (see `receive`); those are used instead
+        of binding the address again, the unused ones are closed.
+
+        The sockets are published for `listening_sockets` and their file
+        descriptors are exported in the ``DAEMON2_LISTEN_FDS`` environment
+        variable (comma-separated), so that the processes executed by the
+        daemon can pick them up.
+        """
+    inherited = dict(inherited or {})
+    opened = []
+    try:
+        for spec in specs:
+            listener = as_listener(spec)
+            sock = inherited.pop(listener.key, None)
+            opened.append(sock if sock is not None else listener.open())
+    except:
+        for sock in opened:
+            sock.close()
+        raise
+    finally:
+        for sock in inherited.values():
+            sock.close()
+    _sockets[:] = opened
+    os.environ[LISTEN_FDS_ENV] = u",".join(str(sock.fileno()) for sock in opened)
+    return opened
+
+def listening_sockets():
+    """ Return the listening sockets created for the current daemon.
+
+        In a process that did not bind them itself, the sockets are
+        reconstructed from the ``DAEMON2_LISTEN_FDS`` environment variable.
+        """
+    if not _sockets and os.environ.get(LISTEN_FDS_ENV):
+        for fd in os.environ[LISTEN_FDS_ENV].split(u","):
+            fd = int(fd)
+            _sockets.append(_fromfd(fd))
+            os.close(fd)
+    return list(_sockets)
+
+def _fromfd(fd):
+    """Return the socket object for the socket descriptor `fd` (a duplicate of it)."""
+    probe = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        family = probe.getsockopt(socket.SOL_SOCKET, SO_DOMAIN) if SO_DOMAIN else socket.AF_INET
+        sockType = probe.getsockopt(socket.SOL_SOCKET, socket.SO_TYPE)
+    finally:
+        probe.close()
+    return socket.fromfd(fd, family, sockType)
+
+def handoff_address(path, pid):
+    """ Return the abstract unix socket address the daemon `pid` locked in `path` hands its sockets over on. """
+    import hashlib
+    digest = hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest()[:16]
+    return "\0daemon2-listen-{0}-{1}".format(digest, pid)
+
+class HandoffServer(object):
+    """ Hands the listening sockets of the daemon over to its next generation.
+
+        `listeners` are ``(Listener.key, socket)`` pairs. The connections
+        are served by a background thread; a client gets the descriptors
+        only if it runs as the same user as the daemon or as root.
+    """
+
+    def __init__(self, path, listeners):
+        super(HandoffServer, self).__init__()
+        self.address = handoff_address(path, os.getpid())
+        self.listeners = list(listeners)
+        self._sock = None
+
+    def start(self):
+        """Start serving the sockets."""
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            fcntl.fcntl(sock.fileno(), fcntl.F_SETFD, fcntl.fcntl(sock.fileno(), fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+            sock.bind(self.address)
+            sock.listen(4)
+        except socket.error as exc:
+            sock.close()
+            raise exceptions.DaemonOSEnvironmentError(u"Unable to serve the socket handoff ({0})".format(exc))
+        self._sock = sock
+        thread = threading.Thread(target=self._serve, args=(sock, ), name="socket-handoff")
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        """Close the socket in the forked workers, which must not keep the address.
+
+        The socket is shared with the daemon, it is not shut down.
+        """
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def _serve(self, sock):
+        while True:
+            try:
+                (conn, _) = sock.accept()
+            except socket.error as exc:
+                if exc.args[0] == errno.EINTR:
+                    continue
+                # Closed by `close`.
+                return
+            try:
+                self._handOver(conn)
+            except Exception:
+                log.exception("Socket handoff failed.")
+            finally:
+                conn.close()
+
+    def _handOver(self, conn):
+        import _multiprocessing
+        (pid, uid, gid) = _UCRED.unpack(conn.getsockopt(socket.SOL_SOCKET, SO_PEERCRED, _UCRED.size))
+        if uid not in (0, os.geteuid()):
+            log.warning("Refused to hand the sockets over to the pid {0} (uid={1}).".format(pid, uid))
+            return
+        header = json.dumps([key for (key, _) in self.listeners]).encode("utf-8")
+        conn.sendall(_LENGTH.pack(len(header)) + header)
+        for (_, listenSocket) in self.listeners:
+            _multiprocessing.sendfd(conn.fileno(), listenSocket.fileno())
+        log.info("Listening sockets handed over to the pid {0}.".format(pid))
+
+def receive(path, pid, timeout=HANDOFF_TIMEOUT):
+    """ Receive the listening sockets of the daemon `pid` locked in `path`.
+
+        Returns the mapping of `Listener.key` to the sockets; it is empty
+        if the daemon does not serve any.
+        """
+    import _multiprocessing
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.settimeout(timeout)
+        try:
+            conn.connect(handoff_address(path, pid))
+        except socket.error as exc:
+            if exc.args[0] in (errno.ECONNREFUSED, errno.ENOENT):
+                return {}
+            raise
+        (size, ) = _LENGTH.unpack(_recvExactly(conn, _LENGTH.size))
+        keys = json.loads(_recvExactly(conn, size).decode("utf-8"))
+        # The descriptors follow right away; ``recvfd`` needs the blocking socket.
+        conn.settimeout(None)
+        rv = {}
+        try:
+            for key in keys:
+                fd = _multiprocessing.recvfd(conn.fileno())
+                try:
+                    rv[key] = _fromfd(fd)
+                finally:
+                    os.close(fd)
+        except:
+            for sock in rv.values():
+                sock.close()
+            raise
+        return rv
+    except socket.error as exc:
+        raise exceptions.DaemonOSEnvironmentError(
+            u"Unable to receive the listening sockets of the pid {0} ({1})".format(pid, exc))
+    finally:
+        conn.close()
+
+def _recvExactly(conn, size):
+    data = b""
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise socket.error(errno.ECONNRESET, "Connection closed during the socket handoff")
+        data += chunk
+    return data
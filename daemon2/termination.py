@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+"""Escalating termination of the daemon and of the processes it spawned."""
+import collections
+import errno
+import logging
+import os
+import signal
+import time
+
+from . import waiter
+
+log = logging.getLogger(__name__)
+
+TerminationReport = collections.namedtuple("TerminationReport", [
+    "pid", # PID of the daemon process.
+    "pgid", # Process group that got signalled (``None`` if only `pid` was).
+    "signals", # Sequence of ``(signal number, seconds since the start)`` pairs.
+    "exited", # Whether everything exited (``None`` for non-blocking calls).
+    "elapsed", # Seconds spent terminating.
+])
+
+def group_alive(pgid):
+    """ Check whether any process is left in the process group `pgid`. """
+    try:
+        os.killpg(pgid, 0)
+    except OSError as exc:
+        if exc.errno == errno.ESRCH:
+            return False
+        elif exc.errno == errno.EPERM:
+            return True
+        raise
+    return True
+
+class TerminationPolicy(object):
+    """ Describes how the daemon gets terminated.
+
+        The daemon is sent ``SIGTERM`` and given `grace` seconds to exit,
+        after which `finalSignal` is sent and the daemon is waited for
+        another `finalGrace` seconds. If `group` is true, the signals are
+        delivered to the whole process group the daemon leads (the session
+        created by `Launcher._forkDaemon`), so the processes spawned by the
+        target are terminated as well.
+    """
+
+    def __init__(self, grace=10.0, group=True, finalSignal=signal.SIGKILL, finalGrace=5.0):
+        super(TerminationPolicy, self).__init__()
+        self.grace = grace
+        self.group = group
+        self.finalSignal = finalSignal
+        self.finalGrace = finalGrace
+
+    def execute(self, pid, block=True, grace=None):
+        """ Terminate the process `pid` and return the `TerminationReport`.
+
+            If `block` is false, only the first signal is sent. `grace`
+            overrides the policy's grace period when not ``None``.
+        """
+        steps = self.steps(pid, block=block, grace=grace)
+        step = next(steps)
+        while not isinstance(step, TerminationReport):
+            step = steps.send(self._waitAll(*step))
+        return step
+
+    def steps(self, pid, block=True, grace=None):
+        """ Generate the termination of the process `pid` step by step.
+
+            The signals are sent by the generator. It yields the waits for
+            the processes to exit as ``(pid, pgid, timeout)`` and has to be
+            sent back whether they exited in time (see `_waitAll`), so that
+            the waits can be performed by an event loop too. The last value
+            yielded is the `TerminationReport`.
+        """
+        if grace is None:
+            grace = self.grace
+        started = time.time()
+        pgid = self._getGroup(pid)
+        sent = []
+
+        def _send(signalNumber):
+            self.send(pid, pgid, signalNumber)
+            sent.append((signalNumber, time.time() - started))
+
+        _send(signal.SIGTERM)
+        if not block:
+            yield TerminationReport(pid, pgid, tuple(sent), None, time.time() - started)
+            return
+
+        exited = yield (pid, pgid, grace)
+        if not exited and self.finalSignal:
+            log.warning("Daemon (pid={0}) did not exit in {1} seconds, sending signal {2}.".format(
+                pid, grace, self.finalSignal))
+            _send(self.finalSignal)
+            exited = yield (pid, pgid, self.finalGrace)
+
+        report = TerminationReport(pid, pgid, tuple(sent), exited, time.time() - started)
+        log.debug("Termination finished: {0}".format(report))
+        yield report
+
+    def send(self, pid, pgid, signalNumber):
+        """Deliver `signalNumber` to the process group `pgid` (or to `pid` alone if ``None``)."""
+        try:
+            if pgid:
+                os.killpg(pgid, signalNumber)
+            else:
+                os.kill(pid, signalNumber)
+        except OSError as exc:
+            if exc.errno != errno.ESRCH:
+                raise
+
+    def _getGroup(self, pid):
+        """Return the process group to be signalled or ``None`` to signal `pid` only."""
+        if not self.group:
+            return None
+        try:
+            pgid = os.getpgid(pid)
+            sid = os.getsid(pid)
+        except OSError:
+            return None
+        if pgid != sid or pgid == os.getpgrp():
+            # Not a daemon session (or it is our own group) -- do not risk it.
+            return None
+        return pgid
+
+    def _waitAll(self, pid, pgid, timeout):
+        deadline = time.time() + timeout
+        if not waiter.wait_for_exit(pid, timeout):
+            return False
+        if pgid:
+            delay = 0.001
+            while group_alive(pgid):
+                pause = min(delay, deadline - time.time())
+                if pause <= 0:
+                    return False
+                time.sleep(pause)
+                delay = min(delay * 2, 0.05)
+        return True
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+
+"""Worker thread mode.
+
+A daemon with `background.Daemon.threads` set calls its `target` once per
+work item, from a pool of that many threads. The items come from the
+daemon's `source`:
+
+* `QueueSource` -- items put into a ``Queue.Queue`` by other threads;
+* `AcceptSource` -- connections accepted on a listening socket (one of
+  the daemon's `listen` sockets by default);
+* `SpoolSource` -- files dropped into a spool directory.
+
+The main thread feeds the items into a queue of at most `queue_size`
+items, so a pool that falls behind stops taking items from the source
+(backpressure). The work is in flight (see `drain`) from before an item
+is taken until the handler returns: on ``SIGTERM`` the source is not read
+anymore and the items taken are handled within the drain timeout. The
+sources get closed once the pool is done; `SpoolSource` puts the files
+the pool did not finish (the drain timed out) back into the spool.
+"""
+import errno
+import logging
+import os
+import select
+import threading
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from . import (
+    drain,
+    sockets,
+)
+
+log = logging.getLogger(__name__)
+
+# Drain timeout of the thread pool daemons without `drain_timeout` set.
+DEFAULT_DRAIN_TIMEOUT = 10.0
+
+# Seconds between the checks of the stop request while the source is idle.
+POLL_INTERVAL = 0.2
+
+class QueueSource(object):
+    """Items put into `queue` (a ``Queue.Queue``) by the other threads of the daemon."""
+
+    def __init__(self, queue):
+        super(QueueSource, self).__init__()
+        self.queue = queue
+
+    def get(self, timeout):
+        """Return the next item, ``None`` if there was none in `timeout` seconds."""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def done(self, item, error):
+        """Called once `item` is handled; `error` is the exception the handler raised (if any)."""
+
+    def close(self):
+        pass
+
+class AcceptSource(object):
+    """ Connections accepted on the listening socket `sock`.
+
+        `sock` is a socket object or an index into
+        `sockets.listening_sockets`. Items are the ``(connection, address)``
+        pairs; the connection is closed once it is handled.
+    """
+
+    def __init__(self, sock=0):
+        super(AcceptSource, self).__init__()
+        self.sock = sock
+
+    def _socket(self):
+        if isinstance(self.sock, int):
+            self.sock = sockets.listening_sockets()[self.sock]
+        return self.sock
+
+    def get(self, timeout):
+        sock = self._socket()
+        try:
+            (rList, _, _) = select.select([sock], (), (), timeout)
+            if not rList:
+                return None
+            return sock.accept()
+        except (select.error, IOError, OSError) as exc:
+            # Interrupted, or another process of the daemon was faster.
+            if exc.args[0] in (errno.EINTR, errno.EAGAIN, errno.ECONNABORTED):
+                return None
+            raise
+
+    def done(self, item, error):
+        item[0].close()
+
+    def close(self):
+        pass
+
+class SpoolSource(object):
+    """ Files dropped into the spool `directory`.
+
+        A file is claimed by moving it into the ``.work`` subdirectory
+        (so several daemons can share the spool) and its path there is the
+        item. Handled files are removed, the ones the handler failed on are
+        moved into the ``.failed`` subdirectory. Files whose names start with
+        a dot are not picked up, so writers can create them under such name
+        and rename them once complete. Files claimed but not finished when
+        the source gets closed are moved back into the spool.
+    """
+
+    def __init__(self, directory):
+        super(SpoolSource, self).__init__()
+        self.directory = directory
+        self.workDirectory = os.path.join(directory, ".work")
+        self.failedDirectory = os.path.join(directory, ".failed")
+        self._names = []
+        self._claimed = set() # Paths in `workDirectory` not finished yet.
+        self._lock = threading.Lock()
+
+    def get(self, timeout):
+        if not self._names:
+            self._names = sorted((name for name in os.listdir(self.directory) if not name.startswith(".")),
+                reverse=True)
+            if not self._names:
+                drain.stopping.wait(timeout)
+                return None
+        _ensureDirectory(self.workDirectory)
+        name = self._names.pop()
+        path = os.path.join(self.workDirectory, name)
+        try:
+            os.rename(os.path.join(self.directory, name), path)
+        except OSError as exc:
+            if exc.errno == errno.ENOENT:
+                # Claimed by somebody else.
+                return None
+            raise
+        with self._lock:
+            self._claimed.add(path)
+        return path
+
+    def done(self, item, error):
+        with self._lock:
+            self._claimed.discard(item)
+        if error is None:
+            os.unlink(item)
+        else:
+            _ensureDirectory(self.failedDirectory)
+            os.rename(item, os.path.join(self.failedDirectory, os.path.basename(item)))
+
+    def close(self):
+        """Move the claimed files that were not finished back into the spool."""
+        with self._lock:
+            (claimed, self._claimed) = (self._claimed, set())
+        for path in sorted(claimed):
+            log.warning("Returning unfinished {0!r} to the spool.".format(path))
+            try:
+                os.rename(path, os.path.join(self.directory, os.path.basename(path)))
+            except OSError as exc:
+                if exc.errno != errno.ENOENT:
+                    raise
+
+def _ensureDirectory(path):
+    try:
+        os.mkdir(path)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+
+class ThreadPool(object):
+    """ Calls `handler` for the items of `source` from `size` threads.
+
+        At most `queueSize` items (twice the number of threads by
+        default) wait for a free thread.
+    """
+
+    def __init__(self, handler, source, size, queueSize=None):
+        super(ThreadPool, self).__init__()
+        if size < 1:
+            raise ValueError("Thread pool size has to be positive, got {0!r}".format(size))
+        self.handler = handler
+        self.source = source
+        self.size = size
+        self.queue = queue.Queue(queueSize or 2 * size)
+        self.handled = 0
+        self.failed = 0
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def run(self):
+        """Feed the items to the threads until the stop request; returns the exit code."""
+        for idx in range(self.size):
+            thread = threading.Thread(target=self._work, name="pool-{0}".format(idx))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        try:
+            while not drain.shutdown_requested():
+                # In flight before the item is taken, so that ``SIGTERM`` can not end the daemon
+                # between taking the item and handing it over to the threads.
+                drain.tracker.begin()
+                item = None
+                try:
+                    item = self.source.get(POLL_INTERVAL)
+                finally:
+                    if item is None:
+                        drain.tracker.end()
+                if item is not None:
+                    # The thread handling the item ends its tracking.
+                    self._put(item)
+            # Let the threads finish before the source is closed; the drain timeout interrupts this.
+            while not drain.tracker.wait_idle(POLL_INTERVAL):
+                pass
+        finally:
+            self.source.close()
+            log.info("Thread pool finished: {0} item(s) handled, {1} failed.".format(self.handled, self.failed))
+        return 0
+
+    def _put(self, item):
+        while True:
+            try:
+                # Blocks while the pool is busy; with a timeout, so that signals get handled.
+                self.queue.put(item, timeout=POLL_INTERVAL)
+                return
+            except queue.Full:
+                continue
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            error = None
+            try:
+                self.handler(item)
+            except Exception as exc:
+                error = exc
+                log.exception("Handling of {0!r} failed.".format(item))
+            try:
+                self.source.done(item, error)
+            except Exception:
+                log.exception("Finishing of {0!r} failed.".format(item))
+            finally:
+                with self._lock:
+                    if error is None:
+                        self.handled += 1
+                    else:
+                        self.failed += 1
+                drain.tracker.end()
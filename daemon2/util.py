@@ -121,6 +121,52 @@ def close_fd(fd):
                 fd, exc,
             ))
 
+FD_DIRECTORIES = (u"/proc/self/fd", u"/dev/fd")
+
+def get_open_file_descriptors():
+    """ Return the sorted list of file descriptors open in this process.
+
+        Lists the per-process descriptor directory provided by the
+        kernel (``/proc/self/fd`` on Linux, ``/dev/fd`` on the BSDs).
+        Returns ``None`` if no such directory is available, in which
+        case the caller has to fall back on scanning the whole
+        descriptor range.
+
+        """
+    for path in FD_DIRECTORIES:
+        try:
+            names = os.listdir(path)
+        except OSError:
+            continue
+        # `/dev/fd` may be a static devfs that always lists 0, 1 and 2 only.
+        if path == u"/dev/fd" and len(names) <= 3:
+            continue
+        # The descriptor used by `listdir` itself is already closed
+        # by now; `close_fd` silently ignores it.
+        return sorted(int(name) for name in names if name.isdigit())
+    return None
+
+def close_file_descriptor_ranges(exclude=(), maxfd=None):
+    """ Close every file descriptor below `maxfd` except the ones in `exclude`.
+
+        Closes the gaps between the excluded descriptors with
+        ``os.closerange``, which does not raise on descriptors that
+        are not open. Falls back to one ``close_fd`` per slot if the
+        platform lacks ``os.closerange``.
+
+        """
+    if maxfd is None:
+        maxfd = get_maximum_file_descriptors()
+    keep = sorted(fd for fd in exclude if 0 <= fd < maxfd)
+    bounds = [-1] + keep + [maxfd]
+    closerange = getattr(os, "closerange", None)
+    for (low, high) in zip(bounds[:-1], bounds[1:]):
+        if closerange:
+            closerange(low + 1, high)
+        else:
+            for fd in reversed(range(low + 1, high)):
+                close_fd(fd)
+
 def close_all_open_files(exclude=()):
     """ Close all open file descriptors.
 
@@ -128,11 +174,36 @@ def close_all_open_files(exclude=()):
         specified, `exclude` is a set of file descriptors to *not*
         close.
 
+        Only the descriptors that are actually open are visited when
+        the system can enumerate them, so the cost does not depend on
+        the ``RLIMIT_NOFILE`` value.
+
+        """
+    exclude = frozenset(exclude)
+    openFds = get_open_file_descriptors()
+    if openFds is None:
+        close_file_descriptor_ranges(exclude)
+    else:
+        for fd in reversed(openFds):
+            if fd not in exclude:
+                close_fd(fd)
+
+def reinit_logging_locks():
+    """ Replace the locks of the `logging` module and its handlers.
+
+        A forked child inherits the locks in the state other threads of
+        the parent left them in; a lock held at the fork would never be
+        released in the child. Newer interpreters do this at fork.
+
         """
-    maxfd = get_maximum_file_descriptors()
-    fdIter = (fd for fd in reversed(range(maxfd)) if fd not in exclude)
-    for fd in fdIter:
-        close_fd(fd)
+    import logging
+    import threading
+    if getattr(logging, "_lock", None) is not None:
+        logging._lock = threading.RLock()
+    for ref in list(getattr(logging, "_handlerList", ())):
+        handler = ref() if callable(ref) else ref
+        if handler is not None:
+            handler.createLock()
 
 def redirect_stream(target_fileno, stream):
     """ Redirect a system stream to a specified file.
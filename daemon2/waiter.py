@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+"""Waiting for an arbitrary (not necessarily child) process to exit.
+
+Uses a Linux process file descriptor (``pidfd_open``) that becomes readable
+the moment the process terminates. Systems without pidfd support fall back
+on probing the process with ``kill(pid, 0)``.
+"""
+import errno
+import os
+import select
+import sys
+import time
+
+SYS_PIDFD_OPEN = 434 # Same syscall number on every Linux architecture but alpha.
+
+_libc = None
+
+def _syscall_pidfd_open(pid):
+    """Invoke the raw ``pidfd_open`` syscall for Python builds lacking `os.pidfd_open`."""
+    global _libc
+    if not sys.platform.startswith("linux"):
+        return None
+    import ctypes
+    if _libc is None:
+        _libc = ctypes.CDLL(None, use_errno=True)
+    fd = _libc.syscall(SYS_PIDFD_OPEN, pid, 0)
+    if fd < 0:
+        err = ctypes.get_errno()
+        if err == errno.ESRCH:
+            raise OSError(err, os.strerror(err))
+        return None
+    return fd
+
+def pidfd_open(pid):
+    """ Return a pidfd referring to the process `pid`.
+
+        Returns ``None`` if the system does not support pidfds and raises
+        ``OSError`` (``ESRCH``) if there is no such process.
+
+        """
+    opener = getattr(os, "pidfd_open", None)
+    if opener is None:
+        return _syscall_pidfd_open(pid)
+    try:
+        return opener(pid)
+    except OSError as exc:
+        if exc.errno == errno.ESRCH:
+            raise
+        return None
+
+def pid_exists(pid):
+    """ Check whether the process `pid` exists with the ``kill(pid, 0)`` probe. """
+    try:
+        os.kill(pid, 0)
+    except OSError as exc:
+        if exc.errno == errno.ESRCH:
+            return False
+        elif exc.errno == errno.EPERM:
+            # Exists, but belongs to somebody else.
+            return True
+        raise
+    return True
+
+def reap(pid):
+    """ Collect the exit status of `pid` if it is a terminated child of ours.
+
+        Returns ``True`` if the process got reaped.
+
+        """
+    try:
+        (childPid, _) = os.waitpid(pid, os.WNOHANG)
+    except OSError as exc:
+        if exc.errno in (errno.ECHILD, errno.EINTR):
+            return False
+        raise
+    return childPid == pid
+
+def _wait_pidfd(fd, timeout):
+    poller = select.poll()
+    poller.register(fd, select.POLLIN)
+    if timeout is not None:
+        deadline = time.time() + timeout
+    while True:
+        if timeout is None:
+            remaining = None
+        else:
+            remaining = int(max(deadline - time.time(), 0) * 1000)
+        try:
+            return bool(poller.poll(remaining))
+        except (select.error, IOError, OSError) as exc:
+            if exc.args[0] != errno.EINTR:
+                raise
+
+def _wait_probe(pid, timeout):
+    if timeout is not None:
+        deadline = time.time() + timeout
+    delay = 0.001
+    while not reap(pid) and pid_exists(pid):
+        if timeout is None:
+            pause = delay
+        else:
+            pause = min(delay, deadline - time.time())
+            if pause <= 0:
+                return False
+        time.sleep(pause)
+        delay = min(delay * 2, 0.05)
+    return True
+
+def wait_for_exit(pid, timeout=None):
+    """ Block until the process `pid` exits.
+
+        Returns ``False`` if the process is still alive after `timeout`
+        seconds (``None`` waits forever).
+
+        """
+    try:
+        fd = pidfd_open(pid)
+    except OSError:
+        return True
+    if fd is None:
+        return _wait_probe(pid, timeout)
+    try:
+        exited = _wait_pidfd(fd, timeout)
+    finally:
+        os.close(fd)
+    if exited:
+        reap(pid)
+    return exited
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+
+"""Pre-forked worker processes executing the daemon's target."""
+import collections
+import errno
+import fcntl
+import logging
+import os
+import select
+import signal
+import time
+
+from . import (
+    memory,
+    waiter,
+)
+
+log = logging.getLogger(__name__)
+
+def describe_status(status):
+    """ Return the human-readable description of the `waitpid` status. """
+    if os.WIFSIGNALED(status):
+        return u"killed by signal {0}".format(os.WTERMSIG(status))
+    return u"exited with code {0}".format(os.WEXITSTATUS(status))
+
+def returncode(status):
+    """ Convert the `waitpid` status to the exit code (``-N`` for signal ``N``). """
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+class RestartPolicy(object):
+    """ Decides when crashed workers get respawned.
+
+        The n-th consecutive crash of a worker delays its respawn by
+        ``backoff * 2 ** (n - 1)`` seconds, but no more than `maxBackoff`.
+        A worker that stayed up for `stableAfter` seconds resets its crash
+        count. More than `crashLoopLimit` crashes of all the workers within
+        `crashLoopWindow` seconds are considered a crash loop, in which case
+        the pool gives up and shuts down.
+    """
+
+    def __init__(self, backoff=0.1, maxBackoff=30.0, stableAfter=10.0,
+        crashLoopLimit=10, crashLoopWindow=60.0,
+    ):
+        super(RestartPolicy, self).__init__()
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.stableAfter = stableAfter
+        self.crashLoopLimit = crashLoopLimit
+        self.crashLoopWindow = crashLoopWindow
+
+    def delay(self, consecutiveCrashes):
+        """Return the respawn delay after `consecutiveCrashes` crashes in a row."""
+        if consecutiveCrashes < 1:
+            return 0
+        return min(self.backoff * 2 ** (consecutiveCrashes - 1), self.maxBackoff)
+
+class WorkerPool(object):
+    """ Supervises `count` worker processes forked from the daemon (master) process.
+
+        Each worker executes `daemon.runTarget`. Workers that crash (exit
+        with a non-zero code or get killed) are respawned as the `restartPolicy`
+        dictates; workers that exit cleanly are not. ``SIGTERM`` received by
+        the master is forwarded to the workers, which are given
+        `shutdownTimeout` seconds to exit before they get killed.
+
+        The master sleeps until ``SIGCHLD`` (or the next scheduled respawn)
+        wakes it up.
+    """
+
+    def __init__(self, daemon, count, restartPolicy=None, shutdownTimeout=10.0):
+        super(WorkerPool, self).__init__()
+        self.daemon = daemon
+        self.count = count
+        self.restartPolicy = restartPolicy or RestartPolicy()
+        self.shutdownTimeout = shutdownTimeout
+        self.workers = {} # pid -> worker slot number
+        self.pending = {} # slot -> time of the scheduled respawn
+        self.spawned = 0
+        self.restarts = 0
+        self.exitCodes = collections.Counter()
+        self.crashLoop = False
+        self._startedAt = {} # slot -> time the current worker got spawned
+        self._consecutiveCrashes = collections.Counter()
+        self._crashTimes = collections.deque()
+        self._wakeup = None
+
+    def run(self):
+        """Spawn the workers and supervise them until they are all gone.
+
+        Returns the exit code for the master: non-zero if the pool gave up
+        because of a crash loop.
+        """
+        self._installWakeup()
+        try:
+            for slot in range(self.count):
+                self.spawn(slot)
+            while (self.workers or self.pending) and not self.crashLoop:
+                self._reapWorkers()
+                self._respawnDue()
+                self._sleep(self._nextTimeout())
+        except SystemExit as err:
+            if err.code != signal.SIGTERM:
+                raise
+            log.debug("Shutting down {0} worker(s).".format(len(self.workers)))
+            for (slot, usage) in sorted(self.memory().items()):
+                log.info("Worker #{0} memory: {1}".format(slot, memory.describe(usage)))
+        finally:
+            self.shutdown()
+            self._removeWakeup()
+            log.info("Worker pool finished: {0}".format(self.stats()))
+        return 1 if self.crashLoop else 0
+
+    def stats(self):
+        """Return the restart counters."""
+        return {
+            "spawned": self.spawned,
+            "restarts": self.restarts,
+            "exitCodes": dict(self.exitCodes),
+            "crashLoop": self.crashLoop,
+        }
+
+    def memory(self):
+        """Return the `memory.MemoryUsage` of the running workers by their slot."""
+        rv = {}
+        for (pid, slot) in self.workers.items():
+            usage = memory.usage(pid)
+            if usage is not None:
+                rv[slot] = usage
+        return rv
+
+    def spawn(self, slot):
+        """Fork the worker for `slot`."""
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = slot
+            self._startedAt[slot] = time.time()
+            self.spawned += 1
+            log.debug("Worker #{0} spawned (pid={1}).".format(slot, pid))
+            return pid
+
+        rc = 1
+        try:
+            self._removeWakeup()
+            if self.daemon.signalDispatcher:
+                self.daemon.signalDispatcher.restart()
+            if self.daemon.handoffServer:
+                self.daemon.handoffServer.close()
+            import setproctitle
+            setproctitle.setproctitle(u"{0} [worker {1}]".format(self.daemon.name, slot))
+            rc = self.daemon.runTarget()
+        except:
+            self.daemon._announceException("Top-level exception in the worker #{0} of {1!r} (pid={2})".format(
+                slot, self.daemon.name, os.getpid(),
+            ))
+        finally:
+            os._exit(rc)
+
+    def onWorkerExit(self, slot, pid, status):
+        now = time.time()
+        code = returncode(status)
+        self.exitCodes[code] += 1
+        if code == 0:
+            log.debug("Worker #{0} (pid={1}) finished.".format(slot, pid))
+            return
+
+        policy = self.restartPolicy
+        if now - self._startedAt.get(slot, now) >= policy.stableAfter:
+            self._consecutiveCrashes[slot] = 0
+        self._consecutiveCrashes[slot] += 1
+
+        self._crashTimes.append(now)
+        while self._crashTimes and now - self._crashTimes[0] > policy.crashLoopWindow:
+            self._crashTimes.popleft()
+        if len(self._crashTimes) > policy.crashLoopLimit:
+            log.error("Worker #{0} (pid={1}) {2}; {3} crashes in {4} seconds, giving up.".format(
+                slot, pid, describe_status(status), len(self._crashTimes), policy.crashLoopWindow))
+            self.crashLoop = True
+            return
+
+        delay = policy.delay(self._consecutiveCrashes[slot])
+        log.warning("Worker #{0} (pid={1}) {2}, respawning in {3:.3f} seconds.".format(
+            slot, pid, describe_status(status), delay))
+        self.pending[slot] = now + delay
+
+    def shutdown(self):
+        """Terminate the remaining workers."""
+        self.pending.clear()
+        if not self.workers:
+            return
+        # The shutdown is already in progress; do not let repeated signals interrupt it.
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        for pid in self.workers:
+            self._signal(pid, signal.SIGTERM)
+        deadline = time.time() + self.shutdownTimeout
+        for pid in list(self.workers):
+            if not waiter.wait_for_exit(pid, max(deadline - time.time(), 0)):
+                log.warning("Worker (pid={0}) ignored SIGTERM, killing.".format(pid))
+                self._signal(pid, signal.SIGKILL)
+                waiter.wait_for_exit(pid)
+            del self.workers[pid]
+
+    def _signal(self, pid, signalNumber):
+        try:
+            os.kill(pid, signalNumber)
+        except OSError as exc:
+            if exc.errno != errno.ESRCH:
+                raise
+
+    def _reapWorkers(self):
+        while True:
+            try:
+                (pid, status) = os.waitpid(-1, os.WNOHANG)
+            except OSError as exc:
+                if exc.errno == errno.EINTR:
+                    continue
+                elif exc.errno == errno.ECHILD:
+                    return
+                raise
+            if not pid:
+                return
+            slot = self.workers.pop(pid, None)
+            if slot is not None:
+                self.onWorkerExit(slot, pid, status)
+
+    def _respawnDue(self):
+        now = time.time()
+        for (slot, when) in list(self.pending.items()):
+            if when <= now:
+                del self.pending[slot]
+                self.restarts += 1
+                self.spawn(slot)
+
+    def _nextTimeout(self):
+        if not self.pending:
+            return None
+        return max(min(self.pending.values()) - time.time(), 0)
+
+    def _installWakeup(self):
+        """Make ``SIGCHLD`` interrupt `_sleep`."""
+        (rfd, wfd) = os.pipe()
+        for fd in (rfd, wfd):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._wakeup = (rfd, wfd)
+        signal.signal(signal.SIGCHLD, _onChildSignal)
+        signal.set_wakeup_fd(wfd)
+
+    def _removeWakeup(self):
+        if self._wakeup is None:
+            return
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        for fd in self._wakeup:
+            os.close(fd)
+        self._wakeup = None
+
+    def _sleep(self, timeout):
+        """Sleep until a child exits or `timeout` seconds pass."""
+        if (self.workers or self.pending) and not self.crashLoop:
+            rfd = self._wakeup[0]
+            try:
+                (rList, _, _) = select.select([rfd], (), (), timeout)
+            except select.error as exc:
+                if exc.args[0] != errno.EINTR:
+                    raise
+                rList = ()
+            if rList:
+                try:
+                    os.read(rfd, 512)
+                except OSError as exc:
+                    if exc.errno != errno.EAGAIN:
+                        raise
+
+def _onChildSignal(signalNumber, stackFrame):
+    """The actual wake up is done by the byte written to the wakeup fd."""
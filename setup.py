@@ -44,6 +44,10 @@ setup(
         u"setproctitle",
         u"psutil",
         ],
+    extras_require={
+        # `daemon2.AsyncLauncher` on Python 2.
+        u"async": [u"trollius"],
+        },
 
     # PyPI metadata
     author=", ".join(aut.name for aut in version.authors),
@@ -0,0 +1,111 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+import daemon2
+
+def _slowStart():
+    time.sleep(0.5)
+    daemon2.notify_ready()
+    time.sleep(30)
+
+def _failingStart():
+    raise RuntimeError("failed to start")
+
+@unittest.skipIf(asyncio is None, "asyncio (or trollius) is not available")
+class AsyncLauncherTest(unittest.TestCase):
+
+    count = 4
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def _launcher(self, name):
+        launcher = daemon2.AsyncLauncher(daemon2.FlockPidfile(os.path.join(self.directory, name + ".pid")),
+            loop=self.loop)
+        def _cleanup():
+            if launcher.running:
+                self.loop.run_until_complete(launcher.terminate(timeout=5))
+        self.addCleanup(_cleanup)
+        return launcher
+
+    def _daemon(self, name, target=_slowStart):
+        return daemon2.Daemon(name, target=target, explicit_ready=True)
+
+    def _run(self, *futures):
+        return self.loop.run_until_complete(asyncio.gather(*futures))
+
+    def test_concurrent_start_stop(self):
+        launchers = [self._launcher("async{0}".format(idx)) for idx in range(self.count)]
+        started = time.time()
+        pids = self._run(*[
+            launcher.start(self._daemon("async{0}".format(idx)), wait_ready=True, timeout=5)
+            for (idx, launcher) in enumerate(launchers)
+        ])
+        # All the daemons got ready while the loop was waiting for them at once.
+        self.assertLess(time.time() - started, 0.5 * self.count)
+        self.assertEqual(pids, [launcher.pid for launcher in launchers])
+        self.assertTrue(all(launcher.running for launcher in launchers))
+
+        self.assertFalse(self._run(launchers[0].wait(timeout=0.1))[0])
+        reports = self._run(*[launcher.terminate(timeout=5) for launcher in launchers])
+        self.assertTrue(all(report.exited for report in reports))
+        self.assertFalse(any(launcher.running for launcher in launchers))
+        self.assertTrue(self._run(launchers[0].wait())[0])
+
+    def test_restart(self):
+        launcher = self._launcher("restarted")
+        (firstPid, ) = self._run(launcher.start(self._daemon("restarted"), wait_ready=True, timeout=5))
+        (secondPid, ) = self._run(launcher.restart(self._daemon("restarted"), wait_ready=True, timeout=5))
+        self.assertNotEqual(firstPid, secondPid)
+        self.assertTrue(launcher.running)
+        self.assertFalse(daemon2.liveness.is_alive(firstPid))
+
+    def test_reload(self):
+        launcher = self._launcher("reloaded")
+        # Not running: the reload starts the daemon.
+        (firstPid, ) = self._run(launcher.reload(self._daemon("reloaded"), timeout=5))
+        self.assertEqual(launcher.pid, firstPid)
+        (secondPid, ) = self._run(launcher.reload(self._daemon("reloaded"), timeout=5))
+        self.assertNotEqual(firstPid, secondPid)
+        self.assertEqual(launcher.pid, secondPid)
+        self.assertTrue(launcher.running)
+        self.assertFalse(daemon2.liveness.is_alive(firstPid))
+
+    def test_startup_error(self):
+        launcher = self._launcher("failing")
+        future = launcher.start(self._daemon("failing", _failingStart), wait_ready=True, timeout=5)
+        with self.assertRaises(daemon2.exceptions.DaemonStartupError) as ctx:
+            self.loop.run_until_complete(future)
+        self.assertEqual(ctx.exception.excType, "exceptions.RuntimeError"
+            if str is bytes else "builtins.RuntimeError")
+        self.assertTrue(self._run(launcher.wait(timeout=5))[0])
+        self.assertFalse(launcher.running)
+
+    def test_setup_error_removes_pidfile(self):
+        launcher = self._launcher("badcwd")
+        payload = daemon2.Daemon("badcwd", target=_slowStart, working_directory="/nonexistent/directory")
+        for _ in range(10):
+            with self.assertRaises(daemon2.exceptions.DaemonStartupError):
+                self.loop.run_until_complete(launcher.start(payload))
+            self.assertFalse(os.path.exists(launcher.pidfile.path))
+            self.assertFalse(launcher.running)
+
+    def test_ready_timeout(self):
+        launcher = self._launcher("slow")
+        future = launcher.start(self._daemon("slow"), wait_ready=True, timeout=0.1)
+        self.assertRaises(daemon2.exceptions.DaemonTimeoutError, self.loop.run_until_complete, future)
+        self.assertTrue(launcher.running)
@@ -1,13 +1,29 @@
+import fcntl
+import json
 import logging
 import multiprocessing as mp
 import os
+import shutil
+import signal
+import socket
+import subprocess
 import sys
+import tempfile
+import threading
+import time
 import unittest
 
 import daemon2
 
 log = logging.getLogger(__name__)
 
+def freshTarget():
+    """Target of the fresh interpreter test; module-level so that it is importable."""
+    with open(os.path.join(os.environ["DAEMON2_TEST_DIR"], "report"), "w") as fobj:
+        json.dump({"pid": os.getpid(), "inherited": "daemon2_launcher_marker" in sys.modules}, fobj)
+    daemon2.notify_ready()
+    time.sleep(30)
+
 class IntegralDaemonTest(unittest.TestCase):
 
     def setUp(self):
@@ -49,3 +65,450 @@ class IntegralDaemonTest(unittest.TestCase):
 
         rv = startedEvent.wait(5)
         self.assertTrue(rv)
+
+    def test_wait_ready(self):
+        readyEvent = mp.Event()
+        def _target():
+            time.sleep(0.2)
+            readyEvent.set()
+            daemon2.notify_ready()
+            time.sleep(0.2)
+
+        lockfile = daemon2.PIDLockFile(os.path.abspath("./test_ready.pid"))
+        payload = daemon2.Daemon("test_daemon_ready", target=_target, explicit_ready=True)
+        daemon = daemon2.Launcher(lockfile)
+        pid = daemon.start(payload, wait_ready=True, timeout=5)
+        self.assertTrue(pid)
+        self.assertTrue(readyEvent.is_set())
+
+    def test_wait_ready_timeout(self):
+        def _target():
+            time.sleep(0.5)
+
+        lockfile = daemon2.PIDLockFile(os.path.abspath("./test_ready_timeout.pid"))
+        payload = daemon2.Daemon("test_daemon_not_ready", target=_target, explicit_ready=True)
+        daemon = daemon2.Launcher(lockfile)
+        self.assertRaises(daemon2.exceptions.DaemonTimeoutError,
+            daemon.start, payload, wait_ready=True, timeout=0.1)
+
+    def test_pidfile_record(self):
+        def _target():
+            time.sleep(30)
+
+        pidPath = os.path.abspath("./test_record.pid")
+        # Stale lock naming a live process that merely reused the PID.
+        with open(pidPath, "w") as fobj:
+            fobj.write("{0}\nstart_time=1\n".format(os.getpid()))
+        daemon = daemon2.Launcher(daemon2.PIDLockFile(pidPath))
+        self.assertFalse(daemon.running)
+        pid = daemon.start(daemon2.Daemon("test_daemon_record", target=_target), wait_ready=True, timeout=5)
+        self.addCleanup(daemon.terminate, timeout=5)
+        record = daemon2.pidfiles.read_record(pidPath)
+        self.assertEqual(record.pid, pid)
+        self.assertEqual(record.token, daemon._spawnedRecord.token)
+        self.assertFalse(daemon2.pidfiles.is_stale(record))
+        self.assertTrue(daemon2.Launcher(daemon2.PIDLockFile(pidPath)).running)
+
+    def test_startup_error(self):
+        payload = daemon2.Daemon("test_daemon_bad_cwd", target=lambda: None,
+            working_directory="/nonexistent/directory")
+        daemon = daemon2.Launcher(daemon2.PIDLockFile(os.path.abspath("./test_error.pid")))
+        started = time.time()
+        with self.assertRaises(daemon2.exceptions.DaemonStartupError) as ctx:
+            daemon.start(payload)
+        self.assertLess(time.time() - started, 5)
+        self.assertEqual(ctx.exception.stage, "setupProcessSession")
+        self.assertIn("DaemonOSEnvironmentError", ctx.exception.excType)
+        # The pidfile reserved before forking is not left behind.
+        self.assertFalse(daemon.pidfile.is_locked())
+
+    def test_startup_error_flock_pidfile(self):
+        pidPath = os.path.abspath("./test_error_flock.pid")
+        payload = daemon2.Daemon("test_daemon_bad_cwd", target=lambda: None,
+            working_directory="/nonexistent/directory")
+        daemon = daemon2.Launcher(daemon2.FlockPidfile(pidPath))
+        # The failing child used to race with the launcher removing the reserved file.
+        for _ in range(20):
+            self.assertRaises(daemon2.exceptions.DaemonStartupError, daemon.start, payload)
+            self.assertFalse(os.path.exists(pidPath))
+            self.assertFalse(daemon.running)
+
+    def test_startup_error_after_stamp(self):
+        pidPath = os.path.abspath("./test_error_stamp.pid")
+        # Fails in configureSystem, after the daemon recorded itself in the pidfile.
+        payload = daemon2.Daemon("test_daemon_bad_signal", target=lambda: None,
+            signal_map={"SIGNONEXISTENT": lambda: None})
+        daemon = daemon2.Launcher(daemon2.FlockPidfile(pidPath))
+        with self.assertRaises(daemon2.exceptions.DaemonStartupError) as ctx:
+            daemon.start(payload, wait_ready=True, timeout=5)
+        self.assertEqual(ctx.exception.stage, "configureSystem")
+        self.assertTrue(daemon.wait(5))
+        self.assertFalse(os.path.exists(pidPath))
+
+    def test_reserved_pidfile_not_adopted(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        def _target():
+            with open(os.path.join(directory, "threads"), "w") as fobj:
+                json.dump([thread.name for thread in threading.enumerate()], fobj)
+            daemon2.notify_ready()
+            time.sleep(30)
+
+        pidPath = os.path.join(directory, "test.pid")
+        payload = daemon2.Daemon("test_daemon_reserved", target=_target, explicit_ready=True)
+        daemon = daemon2.Launcher(daemon2.FlockPidfile(pidPath))
+        daemon.start(payload, wait_ready=True, timeout=5)
+        self.assertTrue(daemon.pidfile.is_locked())
+        with open(os.path.join(directory, "threads")) as fobj:
+            self.assertNotIn("pidfile-adopt", json.load(fobj))
+        daemon.terminate(timeout=5)
+        self.assertFalse(os.path.exists(pidPath))
+
+    def test_locked_pidfile_fails_before_fork(self):
+        pidPath = os.path.abspath("./test_locked.pid")
+        (rfd, wfd) = os.pipe()
+        holder = os.fork()
+        if not holder:
+            try:
+                os.close(rfd)
+                lock = daemon2.FlockPidfile(pidPath)
+                lock.acquire(0)
+                # A PID that does not describe the holder: the launcher takes it for a stale file.
+                daemon2.pidfiles.write_record(pidPath, daemon2.pidfiles.PidfileRecord(1, 1, None, None))
+                os.write(wfd, b"x")
+                time.sleep(30)
+            finally:
+                os._exit(0)
+        os.close(wfd)
+        self.assertEqual(os.read(rfd, 1), b"x")
+        os.close(rfd)
+        self.addCleanup(os.unlink, pidPath)
+        self.addCleanup(daemon2.waiter.wait_for_exit, holder, 5)
+        self.addCleanup(os.kill, holder, signal.SIGKILL)
+
+        daemon = daemon2.Launcher(daemon2.FlockPidfile(pidPath))
+        self.assertFalse(daemon.running)
+        started = time.time()
+        self.assertRaises(daemon2.exceptions.PIDFileLockedError,
+            daemon.start, daemon2.Daemon("test_daemon_locked", target=lambda: None))
+        self.assertLess(time.time() - started, 1)
+        self.assertEqual(daemon.pid, 1)
+        self.assertTrue(os.path.exists(pidPath))
+
+    def test_target_error_before_ready(self):
+        def _target():
+            raise ValueError("broken configuration")
+
+        payload = daemon2.Daemon("test_daemon_target_error", target=_target, explicit_ready=True)
+        daemon = daemon2.Launcher(daemon2.PIDLockFile(os.path.abspath("./test_error2.pid")))
+        with self.assertRaises(daemon2.exceptions.DaemonStartupError) as ctx:
+            daemon.start(payload, wait_ready=True, timeout=5)
+        self.assertEqual(ctx.exception.stage, "target")
+        self.assertEqual(ctx.exception.excMessage, "broken configuration")
+        self.assertIn("ValueError", ctx.exception.remoteTraceback)
+
+    def test_wait_and_terminate(self):
+        payload = daemon2.Daemon("test_daemon_sleeper", target=lambda: time.sleep(30))
+        daemon = daemon2.Launcher(daemon2.PIDLockFile(os.path.abspath("./test_wait.pid")))
+        daemon.start(payload, wait_ready=True, timeout=5)
+        self.assertFalse(daemon.wait(0.1))
+        started = time.time()
+        daemon.terminate(block=True, timeout=5)
+        self.assertLess(time.time() - started, 5)
+        self.assertFalse(daemon.running)
+        self.assertTrue(daemon.wait(0))
+
+    def test_terminate_escalates_to_group(self):
+        childPid = mp.Value("i", 0)
+        def _target():
+            proc = subprocess.Popen(["sh", "-c", "trap '' TERM; while true; do sleep 1; done"])
+            childPid.value = proc.pid
+            daemon2.notify_ready()
+            proc.wait()
+
+        payload = daemon2.Daemon("test_daemon_group", target=_target, explicit_ready=True)
+        daemon = daemon2.Launcher(daemon2.PIDLockFile(os.path.abspath("./test_group.pid")))
+        daemon.start(payload, wait_ready=True, timeout=5)
+        policy = daemon2.TerminationPolicy(grace=0.3, finalGrace=5)
+        report = daemon.terminate(policy=policy)
+        self.assertTrue(report.exited)
+        self.assertEqual([sig for (sig, _) in report.signals], [signal.SIGTERM, signal.SIGKILL])
+        self.assertLess(report.elapsed, 5)
+        self.assertFalse(daemon2.waiter.pid_exists(childPid.value))
+
+    def _waitForFiles(self, directory, count, timeout=5):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            names = os.listdir(directory)
+            if len(names) >= count:
+                return [int(name) for name in names]
+            time.sleep(0.02)
+        self.fail("Expected {0} files in {1!r}, got {2}".format(count, directory, os.listdir(directory)))
+
+    def test_worker_pool(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        def _target():
+            open(os.path.join(directory, str(os.getpid())), "w").close()
+            time.sleep(30)
+
+        payload = daemon2.Daemon("test_daemon_workers", target=_target, workers=3)
+        daemon = daemon2.Launcher(daemon2.PIDLockFile(os.path.abspath("./test_workers.pid")))
+        masterPid = daemon.start(payload, wait_ready=True, timeout=5)
+        workerPids = self._waitForFiles(directory, 3)
+        self.assertNotIn(masterPid, workerPids)
+
+        os.kill(workerPids[0], signal.SIGKILL)
+        allPids = self._waitForFiles(directory, 4)
+
+        daemon.terminate(timeout=5)
+        for pid in allPids:
+            self.assertTrue(daemon2.waiter.wait_for_exit(pid, 5))
+
+    def test_worker_pool_preload(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        preloaded = []
+        def _target():
+            # The preload ran in the master, before the fork.
+            if preloaded == [True] and "json" in sys.modules:
+                open(os.path.join(directory, str(os.getpid())), "w").close()
+            time.sleep(30)
+
+        payload = daemon2.Daemon("test_daemon_preload", target=_target, workers=2,
+            preload=["json", lambda: preloaded.append(True)], gc_freeze=True, gc_threshold=(10000, 50, 50))
+        daemon = daemon2.Launcher(daemon2.PIDLockFile(os.path.abspath("./test_preload.pid")))
+        masterPid = daemon.start(payload, wait_ready=True, timeout=5)
+        workerPids = self._waitForFiles(directory, 2)
+        report = daemon.memory()
+        self.assertEqual(sorted(report), sorted([masterPid] + workerPids))
+        for usage in report.values():
+            self.assertGreater(usage.rss, 0)
+            self.assertEqual(usage.rss, usage.shared + usage.private)
+        daemon.terminate(timeout=5)
+        self.assertEqual(daemon.memory(), {})
+
+    def test_supervise_restarts_target(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        def _target():
+            open(os.path.join(directory, str(os.getpid())), "w").close()
+            if len(os.listdir(directory)) < 3:
+                raise RuntimeError("Simulated crash")
+            time.sleep(30)
+
+        payload = daemon2.Daemon("test_daemon_supervised", target=_target, supervise=True,
+            restart_policy=daemon2.RestartPolicy(backoff=0.01))
+        daemon = daemon2.Launcher(daemon2.PIDLockFile(os.path.abspath("./test_supervise.pid")))
+        daemon.start(payload, wait_ready=True, timeout=5)
+        self._waitForFiles(directory, 3)
+        self.assertTrue(daemon.running)
+        daemon.terminate(timeout=5)
+
+    def test_supervise_crash_loop(self):
+        def _target():
+            raise RuntimeError("Simulated crash")
+
+        payload = daemon2.Daemon("test_daemon_crash_loop", target=_target, supervise=True,
+            restart_policy=daemon2.RestartPolicy(backoff=0.01, crashLoopLimit=3))
+        daemon = daemon2.Launcher(daemon2.PIDLockFile(os.path.abspath("./test_crash_loop.pid")))
+        daemon.start(payload, wait_ready=True, timeout=5)
+        self.assertTrue(daemon.wait(5))
+
+    def _askPid(self, address):
+        conn = socket.create_connection(address, timeout=5)
+        try:
+            return int(conn.recv(64))
+        finally:
+            conn.close()
+
+    def test_reload_hands_over_socket(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.addCleanup(listener.close)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(16)
+        address = listener.getsockname()
+
+        def _target():
+            while True:
+                (conn, _) = listener.accept()
+                conn.sendall(str(os.getpid()).encode("ascii"))
+                conn.close()
+
+        pidPath = os.path.abspath("./test_reload.pid")
+        payload = daemon2.Daemon("test_daemon_reload", target=_target, files_preserve=[listener])
+        daemon = daemon2.Launcher(daemon2.PIDLockFile(pidPath))
+        oldPid = daemon.start(payload, wait_ready=True, timeout=5)
+        self.assertEqual(self._askPid(address), oldPid)
+
+        newPid = daemon.reload(payload, timeout=5)
+        self.assertNotEqual(newPid, oldPid)
+        self.assertFalse(daemon2.waiter.pid_exists(oldPid))
+        self.assertEqual(daemon.pidfile.read_pid(), newPid)
+        self.assertEqual(self._askPid(address), newPid)
+        self.assertTrue(daemon.running)
+
+        daemon.terminate(timeout=5)
+        self.assertFalse(os.path.exists(pidPath))
+
+    def test_reload_hands_over_listen_sockets(self):
+        probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        probe.bind(("127.0.0.1", 0))
+        address = probe.getsockname()
+        probe.close()
+
+        def _target():
+            (listener, ) = daemon2.listening_sockets()
+            while True:
+                (conn, _) = listener.accept()
+                conn.sendall(str(os.getpid()).encode("ascii"))
+                conn.close()
+
+        pidPath = os.path.abspath("./test_reload_listen.pid")
+        payload = daemon2.Daemon("test_daemon_reload_listen", target=_target,
+            listen=["tcp://{0}:{1}".format(*address)], workers=2)
+        oldPid = daemon2.Launcher(daemon2.FlockPidfile(pidPath)).start(payload, wait_ready=True, timeout=5)
+        self.assertIn(self._askPid(address), daemon2.memory.child_pids(oldPid))
+
+        # Like the CLI, a launcher that does not hold the sockets.
+        daemon = daemon2.Launcher(daemon2.FlockPidfile(pidPath))
+        newPid = daemon.reload(payload, timeout=5)
+        self.assertNotEqual(newPid, oldPid)
+        self.assertFalse(daemon2.waiter.pid_exists(oldPid))
+        self.assertIn(self._askPid(address), daemon2.memory.child_pids(newPid))
+
+        daemon.terminate(timeout=5)
+        self.assertFalse(os.path.exists(pidPath))
+
+    def test_reload_flock_pidfile(self):
+        def _target():
+            time.sleep(30)
+
+        pidPath = os.path.abspath("./test_reload_flock.pid")
+        payload = daemon2.Daemon("test_daemon_reload_flock", target=_target)
+        daemon = daemon2.Launcher(daemon2.FlockPidfile(pidPath))
+        oldPid = daemon.start(payload, wait_ready=True, timeout=5)
+        self.assertTrue(daemon.pidfile.is_locked())
+        self.assertRaises(daemon2.exceptions.PIDFileLockedError, daemon2.FlockPidfile(pidPath).acquire, 0)
+
+        newPid = daemon.reload(payload, timeout=5)
+        self.assertFalse(daemon2.waiter.pid_exists(oldPid))
+        # The new generation adopts the lock once the old one is gone.
+        deadline = time.time() + 5
+        while not daemon.pidfile.is_locked() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(daemon.pidfile.is_locked())
+        self.assertEqual(daemon.pidfile.read_pid(), newPid)
+
+        daemon.terminate(timeout=5)
+        self.assertFalse(os.path.exists(pidPath))
+
+    def test_listen_sockets(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        def _target():
+            (sock, ) = daemon2.listening_sockets()
+            with open(os.path.join(directory, "address"), "w") as fobj:
+                json.dump({
+                    "port": sock.getsockname()[1],
+                    "fds": os.environ["DAEMON2_LISTEN_FDS"],
+                    "fileno": sock.fileno(),
+                }, fobj)
+            daemon2.notify_ready()
+            time.sleep(30)
+
+        payload = daemon2.Daemon("test_daemon_listen", target=_target,
+            listen=["tcp://127.0.0.1:0"], explicit_ready=True)
+        daemon = daemon2.Launcher(daemon2.PIDLockFile(os.path.abspath("./test_listen.pid")))
+        daemon.start(payload, wait_ready=True, timeout=5)
+        self.addCleanup(daemon.terminate, timeout=5)
+        with open(os.path.join(directory, "address")) as fobj:
+            info = json.load(fobj)
+        self.assertEqual(info["fds"], str(info["fileno"]))
+        socket.create_connection(("127.0.0.1", info["port"]), timeout=5).close()
+
+    def test_exec_daemon(self):
+        pidPath = os.path.abspath("./test_exec.pid")
+        daemon = daemon2.Launcher(daemon2.PIDLockFile(pidPath))
+        self.addCleanup(lambda: os.path.exists(pidPath) and os.unlink(pidPath))
+        pid = daemon.start(daemon2.ExecDaemon(["sleep", "30"]), wait_ready=True)
+        self.assertEqual(daemon.pidfile.read_pid(), pid)
+        self.assertTrue(daemon.running)
+        self.assertEqual(os.getsid(pid), pid)
+        report = daemon.terminate(timeout=5)
+        self.assertTrue(report.exited)
+        self.assertFalse(daemon.running)
+
+    def test_exec_daemon_leaves_launcher_alone(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        (readFd, writeFd) = os.pipe()
+        self.addCleanup(os.close, readFd)
+        self.addCleanup(os.close, writeFd)
+        fcntl.fcntl(writeFd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        (cwd, mask) = (os.getcwd(), os.umask(0o022))
+        self.addCleanup(os.umask, mask)
+        payload = daemon2.ExecDaemon(["sh", "-c", "pwd >&{0}; umask >&{0}".format(writeFd)],
+            working_directory=directory, umask=0o077, files_preserve=[writeFd])
+        daemon = daemon2.Launcher()
+        daemon.start(payload)
+        daemon.wait(5)
+        self.assertEqual(os.read(readFd, 1024).split(), [os.path.realpath(directory), "0077"])
+        # The launcher keeps its own working directory, umask and descriptor flags.
+        self.assertEqual(os.getcwd(), cwd)
+        self.assertEqual(os.umask(0o022), 0o022)
+        self.assertTrue(fcntl.fcntl(writeFd, fcntl.F_GETFD) & fcntl.FD_CLOEXEC)
+
+    def test_exec_daemon_flock_pidfile(self):
+        pidPath = os.path.abspath("./test_exec_flock.pid")
+        self.addCleanup(lambda: os.path.exists(pidPath) and os.unlink(pidPath))
+        daemon = daemon2.Launcher(daemon2.FlockPidfile(pidPath))
+        fork = os.fork
+        def noFork():
+            raise AssertionError("The launcher forked.")
+        os.fork = noFork
+        try:
+            pid = daemon.start(daemon2.ExecDaemon(["sleep", "30"]))
+        finally:
+            os.fork = fork
+        self.assertEqual(daemon2.pidfiles.read_record(pidPath).pid, pid)
+        # The command holds the lock, another start fails.
+        self.assertTrue(daemon2.FlockPidfile(pidPath).is_locked())
+        with self.assertRaises(daemon2.exceptions.PIDFileLockedError):
+            daemon2.ExecDaemon(["sleep", "30"]).spawn(daemon2.FlockPidfile(pidPath))
+        daemon.terminate(timeout=5)
+        self.assertFalse(daemon2.FlockPidfile(pidPath).is_locked())
+
+    def test_exec_daemon_failure(self):
+        daemon = daemon2.Launcher()
+        with self.assertRaises(daemon2.exceptions.DaemonStartupError) as ctx:
+            daemon.start(daemon2.ExecDaemon(["/nonexistent/binary"]))
+        self.assertEqual(ctx.exception.stage, "exec")
+
+    def test_fresh_interpreter(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        os.environ["DAEMON2_TEST_DIR"] = directory
+        self.addCleanup(os.environ.pop, "DAEMON2_TEST_DIR")
+        sys.modules["daemon2_launcher_marker"] = sys.modules[__name__]
+        self.addCleanup(sys.modules.pop, "daemon2_launcher_marker")
+
+        payload = daemon2.Daemon("test_daemon_fresh", target=freshTarget,
+            explicit_ready=True, fresh_interpreter=True)
+        daemon = daemon2.Launcher(daemon2.PIDLockFile(os.path.abspath("./test_fresh.pid")))
+        pid = daemon.start(payload, wait_ready=True, timeout=10)
+        self.addCleanup(daemon.terminate, timeout=5)
+        with open(os.path.join(directory, "report")) as fobj:
+            report = json.load(fobj)
+        self.assertEqual(report["pid"], pid)
+        self.assertFalse(report["inherited"])
+        self.assertEqual(daemon.pidfile.read_pid(), pid)
+        self.assertGreater(daemon.startupTimings["modules"], 0)
+
+    def test_fresh_interpreter_import_error(self):
+        payload = daemon2.Daemon("test_daemon_fresh_error", target=freshTarget, fresh_interpreter=True)
+        payload.target = "test.no_such_module:target"
+        daemon = daemon2.Launcher()
+        with self.assertRaises(daemon2.exceptions.DaemonStartupError) as ctx:
+            daemon.start(payload, timeout=10)
+        self.assertEqual(ctx.exception.stage, "import")
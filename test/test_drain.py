@@ -0,0 +1,107 @@
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import time
+import unittest
+
+import daemon2
+from daemon2 import drain
+
+def _marker(name):
+    return os.path.join(os.environ["DAEMON2_TEST_DIR"], name)
+
+def _touch(name):
+    with open(_marker(name), "w") as fobj:
+        fobj.write(repr(time.time()))
+
+def _job(duration):
+    with daemon2.in_flight():
+        _touch("job-started")
+        time.sleep(duration)
+        _touch("job-done")
+
+def _pollingTarget():
+    threading.Thread(target=_job, args=(0.5, )).start()
+    daemon2.notify_ready()
+    while not daemon2.shutdown_requested():
+        time.sleep(0.05)
+
+def _blockedTarget():
+    threading.Thread(target=_job, args=(30, )).start()
+    daemon2.notify_ready()
+    while True:
+        time.sleep(30)
+
+def _alarmTarget():
+    # The target's own timer and SIGALRM handler keep working while the daemon drains.
+    signal.signal(signal.SIGALRM, lambda signalNumber, stackFrame: _touch("alarm"))
+    threading.Thread(target=_job, args=(1.0, )).start()
+    daemon2.notify_ready()
+    while not os.path.exists(_marker("job-started")):
+        time.sleep(0.01)
+    signal.setitimer(signal.ITIMER_REAL, 0.5)
+    while True:
+        time.sleep(30)
+
+class StopEventTest(unittest.TestCase):
+
+    def test_wait(self):
+        event = drain.StopEvent()
+        self.assertFalse(event.wait(0.05))
+        threading.Timer(0.1, event.set).start()
+        started = time.time()
+        self.assertTrue(event.wait(5))
+        self.assertLess(time.time() - started, 1)
+        event.clear()
+        self.assertFalse(event.is_set())
+        self.assertFalse(event.wait(0.05))
+
+    def test_tracker(self):
+        tracker = drain.InFlightTracker()
+        with tracker.track():
+            with tracker.track():
+                self.assertEqual(tracker.count, 2)
+            self.assertFalse(tracker.wait_idle(0.05))
+        self.assertTrue(tracker.wait_idle(0))
+
+class DrainTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        os.environ["DAEMON2_TEST_DIR"] = self.directory
+        self.launcher = daemon2.Launcher(daemon2.FlockPidfile(os.path.join(self.directory, "drain.pid")))
+        def _cleanup():
+            if self.launcher.running:
+                self.launcher.terminate(timeout=1)
+        self.addCleanup(_cleanup)
+
+    def _start(self, target, drainTimeout):
+        payload = daemon2.Daemon("drain_test", target=target, explicit_ready=True, drain_timeout=drainTimeout)
+        self.launcher.start(payload, wait_ready=True, timeout=5)
+        deadline = time.time() + 5
+        while not os.path.exists(_marker("job-started")) and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_work_finishes(self):
+        self._start(_pollingTarget, 5)
+        report = self.launcher.terminate(timeout=5)
+        self.assertEqual([sig for (sig, _) in report.signals], [signal.SIGTERM])
+        self.assertTrue(os.path.exists(_marker("job-done")))
+
+    def test_drain_timeout(self):
+        self._start(_blockedTarget, 0.3)
+        report = self.launcher.terminate(timeout=5)
+        # The daemon gave the job up by itself, it did not have to be killed.
+        self.assertEqual([sig for (sig, _) in report.signals], [signal.SIGTERM])
+        self.assertLess(report.elapsed, 3)
+        self.assertFalse(os.path.exists(_marker("job-done")))
+
+    def test_target_alarm_kept(self):
+        self._start(_alarmTarget, 5)
+        report = self.launcher.terminate(timeout=5)
+        self.assertEqual([sig for (sig, _) in report.signals], [signal.SIGTERM])
+        self.assertTrue(os.path.exists(_marker("job-done")))
+        self.assertTrue(os.path.exists(_marker("alarm")))
@@ -0,0 +1,112 @@
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import time
+import unittest
+
+try:
+    import trollius
+except ImportError:
+    trollius = None
+
+import daemon2
+from daemon2 import eventloop
+
+def _marker(name):
+    return os.path.join(os.environ["DAEMON2_TEST_DIR"], name)
+
+def _touch(name):
+    with open(_marker(name), "w") as fobj:
+        fobj.write(repr(time.time()))
+
+def _onUsr1():
+    _touch("usr1")
+
+if trollius:
+    @trollius.coroutine
+    def _service():
+        daemon2.notify_ready()
+        try:
+            yield trollius.From(trollius.sleep(30))
+        except trollius.CancelledError:
+            # Cleanup that needs the loop.
+            yield trollius.From(trollius.sleep(0.1))
+            _touch("cleaned")
+            # A bare ``raise`` after a ``yield`` has nothing to re-raise on Python 2.
+            raise trollius.CancelledError()
+
+    @trollius.coroutine
+    def _stubborn():
+        daemon2.notify_ready()
+        while True:
+            try:
+                yield trollius.From(trollius.sleep(30))
+            except trollius.CancelledError:
+                pass
+
+@unittest.skipIf(trollius is None, "trollius is not available")
+class CoroutineTargetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        os.environ["DAEMON2_TEST_DIR"] = self.directory
+        self.launcher = daemon2.Launcher(daemon2.FlockPidfile(os.path.join(self.directory, "async.pid")))
+        def _cleanup():
+            if self.launcher.running:
+                self.launcher.terminate(timeout=1)
+        self.addCleanup(_cleanup)
+
+    def _waitFor(self, name, timeout=5):
+        deadline = time.time() + timeout
+        while not os.path.exists(_marker(name)) and time.time() < deadline:
+            time.sleep(0.01)
+        return os.path.exists(_marker(name))
+
+    def test_detection(self):
+        self.assertTrue(eventloop.is_coroutine_function(_service))
+        self.assertFalse(eventloop.is_coroutine_function(_onUsr1))
+
+    def test_cancelled_on_terminate(self):
+        payload = daemon2.Daemon("async_service", target=_service, explicit_ready=True,
+            signal_map={"SIGUSR1": _onUsr1})
+        pid = self.launcher.start(payload, wait_ready=True, timeout=5)
+        os.kill(pid, signal.SIGUSR1)
+        self.assertTrue(self._waitFor("usr1"))
+        report = self.launcher.terminate(timeout=5)
+        self.assertTrue(report.exited)
+        self.assertEqual([sig for (sig, _) in report.signals], [signal.SIGTERM])
+        self.assertTrue(os.path.exists(_marker("cleaned")))
+
+    def test_cleanup_deadline(self):
+        payload = daemon2.Daemon("async_stubborn", target=_stubborn, explicit_ready=True,
+            cleanup_timeout=0.2)
+        self.launcher.start(payload, wait_ready=True, timeout=5)
+        report = self.launcher.terminate(timeout=5)
+        # The daemon gave up on the cleanup by itself, it did not have to be killed.
+        self.assertEqual([sig for (sig, _) in report.signals], [signal.SIGTERM])
+        self.assertLess(report.elapsed, 3)
+
+    def _runInProcess(self, target):
+        """Run `target` by `eventloop.run` in this process, sending it SIGTERM once it is going."""
+        payload = daemon2.Daemon("async_inprocess", target=target, cleanup_timeout=0.2)
+        oldHandler = signal.getsignal(signal.SIGTERM)
+        self.addCleanup(signal.signal, signal.SIGTERM, oldHandler)
+        self.addCleanup(daemon2.drain.stopping.clear)
+        threading.Timer(0.2, os.kill, (os.getpid(), signal.SIGTERM)).start()
+        started = time.time()
+        rc = eventloop.run(payload)
+        return (rc, time.time() - started)
+
+    def test_cleanup_deadline_exit_code(self):
+        (rc, elapsed) = self._runInProcess(_stubborn)
+        # The loop gave up on the target ignoring the cancellation.
+        self.assertEqual(rc, 1)
+        self.assertLess(elapsed, 3)
+
+    def test_cleanup_finished_exit_code(self):
+        (rc, _) = self._runInProcess(_service)
+        self.assertEqual(rc, 0)
+        self.assertTrue(os.path.exists(_marker("cleaned")))
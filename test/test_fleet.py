@@ -0,0 +1,164 @@
+import StringIO
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import daemon2
+
+def _slowStart():
+    time.sleep(0.5)
+    daemon2.notify_ready()
+    time.sleep(30)
+
+class DaemonFleetTest(unittest.TestCase):
+
+    count = 4
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.fleet = daemon2.DaemonFleet([
+            daemon2.BoundLauncher(
+                pidfile=os.path.join(self.directory, "fleet{0}.pid".format(idx)),
+                name="fleet{0}".format(idx),
+                target=_slowStart,
+                explicit_ready=True,
+            )
+            for idx in range(self.count)
+        ])
+        self.addCleanup(self.fleet.stop, timeout=5)
+
+    def test_parallel_start_stop(self):
+        started = time.time()
+        results = self.fleet.start(wait_ready=True, timeout=5)
+        # The daemons get ready in parallel, not one after another.
+        self.assertLess(time.time() - started, 0.5 * self.count)
+        self.assertEqual(list(results), ["fleet{0}".format(idx) for idx in range(self.count)])
+        self.assertTrue(all(result.ok for result in results.values()), results)
+
+        states = self.fleet.status()
+        self.assertTrue(all(state.running for state in states.values()))
+        self.assertEqual([state.pid for state in states.values()], [result.value for result in results.values()])
+
+        # Running daemons are not started again.
+        self.assertEqual([result.value for result in self.fleet.start().values()], [None] * self.count)
+
+        paths = []
+        def _pidfile(path):
+            paths.append(os.path.basename(path))
+            return daemon2.FlockPidfile(path)
+        directoryFleet = daemon2.DaemonFleet.from_directory(self.directory, pidfileFactory=_pidfile)
+        self.assertEqual(paths, ["fleet{0}.pid".format(idx) for idx in range(self.count)])
+        self.assertEqual(directoryFleet.status(), states)
+        results = directoryFleet.stop(["fleet0"], timeout=5)
+        self.assertTrue(results["fleet0"].ok)
+        self.assertFalse(self.fleet.status()["fleet0"].running)
+        out = StringIO.StringIO()
+        self.assertEqual(directoryFleet.act(["status", "fleet1"], out=out), 0)
+        self.assertEqual(out.getvalue(), "fleet1: running (pid {0})\n".format(states["fleet1"].pid))
+        out = StringIO.StringIO()
+        self.assertEqual(directoryFleet.act(["status"], out=out), 1)
+        self.assertEqual(out.getvalue().splitlines(), ["fleet0: stopped"] + [
+            "fleet{0}: running (pid {1})".format(idx, states["fleet{0}".format(idx)].pid)
+            for idx in range(1, self.count)
+        ])
+        out = StringIO.StringIO()
+        self.assertEqual(directoryFleet.act(["stop", "fleet1", "--timeout", "5"], out=out), 0)
+        self.assertRegexpMatches(out.getvalue(), r"^fleet1: ok \(\d+\.\d{3}s\)\n$")
+
+        results = self.fleet.stop(timeout=5)
+        self.assertTrue(all(result.ok for result in results.values()), results)
+        self.assertFalse(any(state.running for state in self.fleet.status().values()))
+
+    def test_failure_is_isolated(self):
+        self.fleet.launchers["fleet0"]._daemonObject.working_directory = "/nonexistent/directory"
+        results = self.fleet.start(wait_ready=True, timeout=5)
+        self.assertFalse(results["fleet0"].ok)
+        self.assertIsInstance(results["fleet0"].error, daemon2.exceptions.DaemonStartupError)
+        self.assertTrue(all(results["fleet{0}".format(idx)].ok for idx in range(1, self.count)))
+
+class DependencyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _launcher(self, name, requires=(), readyAfter=0, **kwargs):
+        marker = self._path(name)
+        def _target():
+            time.sleep(readyAfter)
+            seen = sorted(
+                other for other in ("cache", "api1", "api2") if os.path.exists(self._path(other) + ".started")
+            )
+            with open(marker + ".started", "w") as fobj:
+                fobj.write(" ".join(seen))
+            daemon2.notify_ready()
+            try:
+                time.sleep(30)
+            finally:
+                with open(marker + ".stopped", "w") as fobj:
+                    fobj.write(repr(time.time()))
+        return daemon2.BoundLauncher(pidfile=self._path(name + ".pid"), name=name, target=_target,
+            explicit_ready=True, requires=requires, **kwargs)
+
+    def _fleet(self, **kwargs):
+        fleet = daemon2.DaemonFleet([
+            self._launcher("cache", readyAfter=0.5, **kwargs),
+            self._launcher("api1", requires=["cache"]),
+            self._launcher("api2", requires=["cache"]),
+        ])
+        self.addCleanup(fleet.stop, timeout=5)
+        return fleet
+
+    def _read(self, name):
+        with open(self._path(name)) as fobj:
+            return fobj.read()
+
+    def test_ordered_start_and_stop(self):
+        fleet = self._fleet()
+        results = fleet.start(timeout=5)
+        self.assertTrue(all(result.ok for result in results.values()), results)
+        # The API daemons were started only after the cache got ready.
+        for name in ("api1", "api2"):
+            deadline = time.time() + 5
+            while not os.path.exists(self._path(name + ".started")) and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertIn("cache", self._read(name + ".started").split())
+        self.assertEqual(self._read("cache.started"), "")
+
+        results = fleet.stop(timeout=5)
+        self.assertTrue(all(result.ok for result in results.values()), results)
+        cacheStopped = float(self._read("cache.stopped"))
+        self.assertLess(float(self._read("api1.stopped")), cacheStopped)
+        self.assertLess(float(self._read("api2.stopped")), cacheStopped)
+
+    def test_unselected_prerequisite(self):
+        fleet = self._fleet()
+        results = fleet.start(["api1"], wait_ready=True, timeout=5)
+        self.assertEqual(sorted(results), ["api1", "cache"])
+        self.assertTrue(all(result.ok for result in results.values()), results)
+        self.assertIn("cache", self._read("api1.started").split())
+        states = fleet.status()
+        self.assertTrue(states["cache"].running)
+        self.assertFalse(states["api2"].running)
+
+    def test_failed_prerequisite(self):
+        fleet = self._fleet(working_directory="/nonexistent/directory")
+        results = fleet.start(timeout=5)
+        self.assertIsInstance(results["cache"].error, daemon2.exceptions.DaemonStartupError)
+        for name in ("api1", "api2"):
+            self.assertFalse(results[name].ok)
+            self.assertIsInstance(results[name].error, daemon2.exceptions.DaemonError)
+            self.assertFalse(os.path.exists(self._path(name + ".pid")))
+
+    def test_invalid_dependencies(self):
+        launchers = [self._launcher("api1", requires=["api2"]), self._launcher("api2")]
+        self.assertRaises(ValueError, daemon2.DaemonFleet, launchers, dependencies={"api2": ["api1"]})
+        self.assertRaises(ValueError, daemon2.DaemonFleet, launchers, dependencies={"api2": ["cache"]})
+        fleet = daemon2.DaemonFleet(launchers)
+        self.assertEqual(fleet.dependents("api2"), frozenset(["api1"]))
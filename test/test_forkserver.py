@@ -0,0 +1,61 @@
+import functools
+import os
+import pickle
+import shutil
+import tempfile
+import time
+import unittest
+
+import daemon2
+
+def _reportParent(path):
+    with open(path, "w") as fobj:
+        fobj.write(str(os.getpid()))
+    time.sleep(30)
+
+class ForkServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = daemon2.ForkServer(preload=["json"])
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_spawn(self):
+        path = os.path.join(self.directory, "pid")
+        payload = daemon2.Daemon("test_forkserver_daemon", target=functools.partial(_reportParent, path))
+        daemon = daemon2.Launcher(daemon2.PIDLockFile(os.path.abspath("./test_forkserver.pid")),
+            forkServer=self.server)
+        pid = daemon.start(payload, wait_ready=True, timeout=5)
+        self.addCleanup(daemon.terminate, timeout=5)
+        self.assertTrue(daemon.running)
+        deadline = time.time() + 5
+        while not os.path.exists(path) and time.time() < deadline:
+            time.sleep(0.01)
+        with open(path) as fobj:
+            self.assertEqual(int(fobj.read()), pid)
+
+    def test_startup_error(self):
+        payload = daemon2.Daemon("test_forkserver_bad_cwd", target=time.sleep,
+            working_directory="/nonexistent/directory")
+        daemon = daemon2.Launcher(forkServer=self.server)
+        with self.assertRaises(daemon2.exceptions.DaemonStartupError) as ctx:
+            daemon.start(payload)
+        self.assertEqual(ctx.exception.stage, "setupProcessSession")
+
+    def test_locked_pidfile(self):
+        path = os.path.join(self.directory, "locked.pid")
+        lock = daemon2.FlockPidfile(path)
+        lock.acquire(0)
+        self.addCleanup(lock.release)
+        # Make the launcher take the file for a stale one; only the lock tells otherwise.
+        daemon2.pidfiles.write_record(path, daemon2.pidfiles.PidfileRecord(1, 1, None, None))
+        daemon = daemon2.Launcher(daemon2.FlockPidfile(path), forkServer=self.server)
+        self.assertRaises(daemon2.exceptions.PIDFileLockedError,
+            daemon.start, daemon2.Daemon("test_forkserver_locked", target=time.sleep))
+
+    def test_unpicklable_daemon(self):
+        payload = daemon2.Daemon("test_forkserver_lambda", target=lambda: None)
+        daemon = daemon2.Launcher(forkServer=self.server)
+        self.assertRaises(pickle.PicklingError, daemon.start, payload)
@@ -0,0 +1,61 @@
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+# Modules that must not be loaded by a bare ``import daemon2``.
+HEAVY_MODULES = ("psutil", "lockfile", "setproctitle", "pty", "subprocess", "pickle", "tempfile", "shutil",
+    "asyncio", "trollius")
+
+_PROBE = """
+import json, sys
+import daemon2
+print(json.dumps(sorted(name for name in %r if name in sys.modules)))
+"""
+
+class ImportTest(unittest.TestCase):
+
+    def _probe(self):
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(path for path in sys.path if path)
+        output = subprocess.check_output([sys.executable, "-c", _PROBE % (HEAVY_MODULES, )], env=env)
+        return json.loads(output.decode("utf-8"))
+
+    def test_heavy_modules_not_imported(self):
+        self.assertEqual(self._probe(), [])
+
+    def test_cli_status(self):
+        # Status checks of a stopped daemon should not need psutil or lockfile.
+        probe = (
+            "import sys, daemon2\n"
+            "rc = daemon2.CLILauncher(pidfile=%r, name='test_import', target=None).act(['status'])\n"
+            "assert 'psutil' not in sys.modules and 'lockfile' not in sys.modules\n"
+            "sys.exit(rc)\n"
+        ) % (os.path.abspath("./test_import_status.pid"), )
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(path for path in sys.path if path)
+        process = subprocess.Popen([sys.executable, "-c", probe], env=env, stdout=subprocess.PIPE)
+        (output, _) = process.communicate()
+        self.assertEqual((process.returncode, output.strip()), (1, b"stopped"))
+
+    def test_pidlockfile(self):
+        import daemon2
+        lock = daemon2.PIDLockFile(os.path.abspath("./test_import.pid"))
+        self.assertEqual(lock.read_pid(), None)
+        self.assertFalse(lock.is_locked())
+
+    def test_pidlockfile_subclass(self):
+        import daemon2
+        from lockfile.pidlockfile import PIDLockFile
+        path = os.path.abspath("./test_import.pid")
+
+        class CustomPidfile(daemon2.pidfiles.lockfile_class()):
+            def read_pid(self):
+                return 42
+
+        self.assertIsInstance(daemon2.PIDLockFile(path), PIDLockFile)
+        custom = CustomPidfile(path)
+        self.assertIsInstance(custom, PIDLockFile)
+        self.assertEqual(custom.read_pid(), 42)
+        self.assertFalse(custom.is_locked())
@@ -0,0 +1,132 @@
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import time
+import unittest
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import daemon2
+from daemon2 import (
+    drain,
+    threadpool,
+)
+
+def _handleSpoolFile(path):
+    with open(path) as fobj:
+        delay = float(fobj.read())
+    name = os.path.basename(path)
+    results = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(path))), "results")
+    with open(os.path.join(results, name + ".started"), "w"):
+        pass
+    time.sleep(delay)
+    with open(os.path.join(results, name), "w") as fobj:
+        fobj.write(threading.current_thread().name)
+
+class ThreadPoolTest(unittest.TestCase):
+
+    def _run(self, pool):
+        thread = threading.Thread(target=pool.run)
+        thread.start()
+        def _stop():
+            drain.stopping.set()
+            thread.join()
+            drain.stopping.clear()
+        self.addCleanup(_stop)
+
+    def test_items_handled(self):
+        source = threadpool.QueueSource(queue.Queue())
+        handled = []
+        lock = threading.Lock()
+        def _handler(item):
+            time.sleep(0.01)
+            with lock:
+                handled.append((item, threading.current_thread().name))
+        pool = threadpool.ThreadPool(_handler, source, 4)
+        self._run(pool)
+        for item in range(20):
+            source.queue.put(item)
+        deadline = time.time() + 5
+        while pool.handled < 20 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(sorted(item for (item, _) in handled), list(range(20)))
+        self.assertGreater(len(set(name for (_, name) in handled)), 1)
+
+    def test_backpressure(self):
+        source = threadpool.QueueSource(queue.Queue())
+        release = threading.Event()
+        pool = threadpool.ThreadPool(lambda item: release.wait(5), source, 1, queueSize=1)
+        self.addCleanup(release.set)
+        self._run(pool)
+        for item in range(10):
+            source.queue.put(item)
+        time.sleep(0.3)
+        # One item is handled, one is queued, one waits to be queued; the rest is left in the source.
+        self.assertEqual(source.queue.qsize(), 7)
+        release.set()
+
+class SpoolDaemonTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.spool = os.path.join(self.directory, "spool")
+        self.results = os.path.join(self.directory, "results")
+        os.mkdir(self.spool)
+        os.mkdir(self.results)
+        self.launcher = daemon2.Launcher(daemon2.FlockPidfile(os.path.join(self.directory, "spool.pid")))
+        def _cleanup():
+            if self.launcher.running:
+                self.launcher.terminate(timeout=1)
+        self.addCleanup(_cleanup)
+
+    def _drop(self, name, delay):
+        with open(os.path.join(self.spool, "." + name), "w") as fobj:
+            fobj.write(repr(delay))
+        os.rename(os.path.join(self.spool, "." + name), os.path.join(self.spool, name))
+
+    def _waitFor(self, names, timeout=5):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if all(os.path.exists(os.path.join(self.results, name)) for name in names):
+                return True
+            time.sleep(0.01)
+        return False
+
+    def test_spool_drained_on_terminate(self):
+        payload = daemon2.Daemon("spool_test", target=_handleSpoolFile, threads=2,
+            source=daemon2.SpoolSource(self.spool), drain_timeout=5)
+        self.launcher.start(payload, wait_ready=True, timeout=5)
+        for idx in range(4):
+            self._drop("quick{0}".format(idx), 0)
+        self.assertTrue(self._waitFor(["quick{0}".format(idx) for idx in range(4)]))
+
+        for idx in range(2):
+            self._drop("slow{0}".format(idx), 0.5)
+        self.assertTrue(self._waitFor(["slow0.started", "slow1.started"]))
+        report = self.launcher.terminate(timeout=5)
+        self.assertEqual([sig for (sig, _) in report.signals], [signal.SIGTERM])
+        # The items taken were finished before the daemon exited.
+        self.assertTrue(os.path.exists(os.path.join(self.results, "slow0")))
+        self.assertTrue(os.path.exists(os.path.join(self.results, "slow1")))
+        self.assertEqual(os.listdir(self.spool), [".work"])
+        self.assertEqual(os.listdir(os.path.join(self.spool, ".work")), [])
+
+    def test_unfinished_returned_to_spool(self):
+        payload = daemon2.Daemon("spool_test", target=_handleSpoolFile, threads=1,
+            source=daemon2.SpoolSource(self.spool), drain_timeout=0.3, queue_size=1)
+        self.launcher.start(payload, wait_ready=True, timeout=5)
+        for idx in range(2):
+            self._drop("stuck{0}".format(idx), 30)
+        self.assertTrue(self._waitFor(["stuck0.started"]))
+        time.sleep(0.2)
+        report = self.launcher.terminate(timeout=5)
+        self.assertEqual([sig for (sig, _) in report.signals], [signal.SIGTERM])
+        # The drain gave up on both (the one handled and the one queued); they are not lost in ".work".
+        self.assertEqual(sorted(os.listdir(self.spool)), [".work", "stuck0", "stuck1"])
+        self.assertEqual(os.listdir(os.path.join(self.spool, ".work")), [])
@@ -0,0 +1,348 @@
+import json
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+from daemon2 import (
+    exceptions,
+    liveness,
+    memory,
+    pidfiles,
+    signals,
+    sockets,
+    util,
+    waiter,
+)
+
+def _isOpen(fd):
+    try:
+        os.fstat(fd)
+    except OSError:
+        return False
+    return True
+
+class CloseFilesTest(unittest.TestCase):
+
+    def _runInChild(self, func):
+        """Execute `func` in a forked child and return the JSON it reports."""
+        (rfd, wfd) = os.pipe()
+        pid = os.fork()
+        if not pid:
+            try:
+                os.close(rfd)
+                os.write(wfd, json.dumps(func(wfd)).encode("ascii"))
+            finally:
+                os._exit(0)
+        os.close(wfd)
+        with os.fdopen(rfd, "r") as fobj:
+            data = fobj.read()
+        os.waitpid(pid, 0)
+        return json.loads(data)
+
+    def _closeAndReport(self, closer):
+        def _payload(wfd):
+            opened = [os.open(os.devnull, os.O_RDONLY) for _ in range(5)]
+            keep = opened[1]
+            closer(exclude=[wfd, keep])
+            return {
+                "keep": _isOpen(keep),
+                "pipe": _isOpen(wfd),
+                "closed": [_isOpen(fd) for fd in opened if fd != keep],
+            }
+        return self._runInChild(_payload)
+
+    def test_close_all_open_files(self):
+        rv = self._closeAndReport(util.close_all_open_files)
+        self.assertTrue(rv["keep"])
+        self.assertTrue(rv["pipe"])
+        self.assertFalse(any(rv["closed"]))
+
+    def test_close_file_descriptor_ranges(self):
+        rv = self._closeAndReport(util.close_file_descriptor_ranges)
+        self.assertTrue(rv["keep"])
+        self.assertTrue(rv["pipe"])
+        self.assertFalse(any(rv["closed"]))
+
+    def test_get_open_file_descriptors(self):
+        fds = util.get_open_file_descriptors()
+        if fds is None:
+            self.skipTest("Descriptor enumeration is not supported.")
+        self.assertTrue(set([0, 1, 2]).issubset(fds))
+        fd = os.open(os.devnull, os.O_RDONLY)
+        try:
+            self.assertIn(fd, util.get_open_file_descriptors())
+        finally:
+            os.close(fd)
+
+class ListenerTest(unittest.TestCase):
+
+    def test_parse(self):
+        listener = sockets.Listener.parse("tcp://127.0.0.1:8080")
+        self.assertEqual((listener.kind, listener.address), ("tcp", ("127.0.0.1", 8080)))
+        listener = sockets.Listener.parse("udp://[::1]:53", reuse_port=True)
+        self.assertEqual((listener.kind, listener.address), ("udp", ("::1", 53)))
+        self.assertTrue(listener.reuse_port)
+        listener = sockets.Listener.parse("unix:///tmp/test.sock")
+        self.assertEqual((listener.kind, listener.address), ("unix", "/tmp/test.sock"))
+        self.assertRaises(ValueError, sockets.Listener.parse, "127.0.0.1:80")
+        self.assertRaises(ValueError, sockets.Listener.parse, "tcp://127.0.0.1")
+
+    def test_open_tcp(self):
+        sock = sockets.Listener(("127.0.0.1", 0)).open()
+        try:
+            client = socket.create_connection(sock.getsockname(), timeout=5)
+            client.close()
+        finally:
+            sock.close()
+
+class LivenessTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_is_alive(self):
+        pid = os.getpid()
+        startTime = liveness.start_time(pid)
+        if startTime is None:
+            self.skipTest("/proc is not available.")
+        self.assertTrue(liveness.is_alive(pid))
+        self.assertTrue(liveness.is_alive(pid, startTime))
+        # Same PID, different process.
+        self.assertFalse(liveness.is_alive(pid, startTime - 1))
+
+    def test_zombie(self):
+        pid = os.fork()
+        if not pid:
+            os._exit(0)
+        try:
+            deadline = time.time() + 5
+            while liveness.read_stat(pid)[0] != "Z" and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertFalse(liveness.is_alive(pid))
+        finally:
+            os.waitpid(pid, 0)
+        self.assertFalse(liveness.is_alive(pid))
+
+class MemoryTest(unittest.TestCase):
+
+    SMAPS_ROLLUP = b"""\
+55d0c2a1e000-7ffd3b9fe000 ---p 00000000 00:00 0                          [rollup]
+Rss:                9012 kB
+Pss:                4100 kB
+Shared_Clean:       5000 kB
+Shared_Dirty:        512 kB
+Private_Clean:       100 kB
+Private_Dirty:      3400 kB
+Referenced:         9012 kB
+Swap:                 16 kB
+SwapPss:              16 kB
+"""
+
+    def test_parse(self):
+        self.assertEqual(memory._parse(self.SMAPS_ROLLUP),
+            memory.MemoryUsage(rss=9012 * 1024, pss=4100 * 1024, shared=5512 * 1024, private=3500 * 1024,
+                swap=16 * 1024))
+
+    def test_usage(self):
+        usage = memory.usage(os.getpid())
+        if usage is None:
+            self.skipTest("/proc/<pid>/smaps is not available.")
+        self.assertGreater(usage.rss, 0)
+        self.assertIsNone(memory.usage(2 ** 22 + 1))
+
+    def test_children(self):
+        pid = os.fork()
+        if not pid:
+            time.sleep(30)
+            os._exit(0)
+        try:
+            self.assertIn(pid, memory.child_pids(os.getpid()))
+            self.assertIn(pid, memory.report(os.getpid()))
+        finally:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+
+class PidfileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, "pid")
+
+    def test_format(self):
+        record = pidfiles.make_record(os.getpid(), pidfiles.new_token())
+        text = pidfiles.format_record(record)
+        self.assertEqual(text.splitlines()[0], str(os.getpid()))
+        self.assertEqual(pidfiles.parse_record(text), record)
+        # Classic PID files.
+        self.assertEqual(pidfiles.parse_record("42\n"), pidfiles.PidfileRecord(42, None, None, None))
+        self.assertEqual(pidfiles.parse_record("garbage\n"), None)
+        self.assertEqual(pidfiles.parse_record(""), None)
+
+    def test_old_reader(self):
+        pidfiles.replace_record(self.path, pidfiles.make_record(os.getpid(), "token"))
+        self.assertEqual(pidfiles.PIDLockFile(self.path).read_pid(), os.getpid())
+
+    def test_is_stale(self):
+        record = pidfiles.make_record(os.getpid())
+        if record.startTime is None or record.bootId is None:
+            self.skipTest("/proc is not available.")
+        self.assertFalse(pidfiles.is_stale(record))
+        self.assertTrue(pidfiles.is_stale(record._replace(startTime=record.startTime - 1)))
+        self.assertTrue(pidfiles.is_stale(record._replace(bootId="previous-boot")))
+        self.assertTrue(pidfiles.is_stale(None))
+
+    def test_stamp(self):
+        lock = pidfiles.PIDLockFile(self.path)
+        lock.acquire()
+        self.addCleanup(lock.release)
+        pidfiles.stamp(lock, "token")
+        record = pidfiles.read_record(self.path)
+        self.assertEqual((record.pid, record.token), (os.getpid(), "token"))
+        self.assertTrue(lock.i_am_locking())
+
+    def test_cache(self):
+        cache = pidfiles.PidfileCache(self.path)
+        self.assertEqual(cache.read(), None)
+        with open(self.path, "w") as fobj:
+            fobj.write("{0}\n".format(os.getpid()))
+        self.assertEqual(cache.read().pid, os.getpid())
+        # Classic PID files get the start time recorded on the first read.
+        self.assertEqual(cache.read().startTime, liveness.start_time(os.getpid()))
+        pidfiles.replace_record(self.path, pidfiles.PidfileRecord(1, 5, None, "token"))
+        self.assertEqual(cache.read(), pidfiles.PidfileRecord(1, 5, None, "token"))
+        os.unlink(self.path)
+        self.assertEqual(cache.read(), None)
+
+class FlockPidfileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, "pid")
+
+    def _lockInChild(self, hold):
+        """Fork a child that locks the pidfile and exits after `hold` seconds."""
+        (rfd, wfd) = os.pipe()
+        pid = os.fork()
+        if not pid:
+            try:
+                os.close(rfd)
+                pidfiles.FlockPidfile(self.path).acquire(0)
+                os.write(wfd, b"x")
+                time.sleep(hold)
+            finally:
+                os._exit(0)
+        os.close(wfd)
+        self.assertEqual(os.read(rfd, 1), b"x")
+        os.close(rfd)
+        self.addCleanup(waiter.wait_for_exit, pid, 5)
+        return pid
+
+    def test_acquire_release(self):
+        lock = pidfiles.FlockPidfile(self.path)
+        self.assertFalse(lock.is_locked())
+        lock.acquire(0)
+        self.assertTrue(lock.is_locked())
+        self.assertTrue(lock.i_am_locking())
+        self.assertEqual(lock.read_pid(), os.getpid())
+        lock.release()
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(lock.i_am_locking())
+
+    def test_contention(self):
+        pid = self._lockInChild(30)
+        lock = pidfiles.FlockPidfile(self.path)
+        self.assertTrue(lock.is_locked())
+        self.assertEqual(lock.read_pid(), pid)
+        started = time.time()
+        self.assertRaises(exceptions.PIDFileLockedError, lock.acquire, 0.2)
+        self.assertLess(time.time() - started, 1)
+        lock.break_lock()
+        self.assertTrue(os.path.exists(self.path))
+        os.kill(pid, signal.SIGKILL)
+        waiter.wait_for_exit(pid, 5)
+        # The dead holder's lock is gone along with it, the file is not stale.
+        lock.acquire(0)
+        self.assertEqual(lock.read_pid(), os.getpid())
+        lock.release()
+
+    def test_wait_for_release(self):
+        self._lockInChild(0.2)
+        lock = pidfiles.FlockPidfile(self.path)
+        started = time.time()
+        lock.acquire(5)
+        self.assertLess(time.time() - started, 2)
+        self.assertTrue(lock.i_am_locking())
+        lock.release()
+
+    def test_timeout_leaves_no_lock_behind(self):
+        pid = self._lockInChild(0.3)
+        lock = pidfiles.FlockPidfile(self.path)
+        self.assertRaises(exceptions.PIDFileLockedError, lock.acquire, 0.1)
+        waiter.wait_for_exit(pid, 5)
+        time.sleep(0.1)
+        # The abandoned wait got the lock once the holder exited and dropped it right away.
+        self.assertFalse(lock.is_locked())
+        lock.acquire(0)
+        lock.release()
+
+    def test_application_timer(self):
+        self._lockInChild(30)
+        alarms = []
+        oldHandler = signal.signal(signal.SIGALRM, lambda signalNumber, stackFrame: alarms.append(signalNumber))
+        self.addCleanup(signal.signal, signal.SIGALRM, oldHandler)
+        self.addCleanup(signal.setitimer, signal.ITIMER_REAL, 0)
+        signal.setitimer(signal.ITIMER_REAL, 0.1)
+        lock = pidfiles.FlockPidfile(self.path)
+        started = time.time()
+        self.assertRaises(exceptions.PIDFileLockedError, lock.acquire, 0.5)
+        # The application's alarm fired on time and did not cut the wait short.
+        self.assertGreaterEqual(time.time() - started, 0.5)
+        self.assertEqual(alarms, [signal.SIGALRM])
+
+class SignalDispatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.dispatcher = signals.SignalDispatcher()
+        oldHandler = signal.signal(signal.SIGUSR1, self.dispatcher.register(signal.SIGUSR1, self._slowHandler))
+        self.addCleanup(signal.signal, signal.SIGUSR1, oldHandler)
+        self.addCleanup(self.dispatcher.stop)
+        self.dispatcher.start()
+
+    def _slowHandler(self):
+        self.calls.append(threading.current_thread().name)
+        time.sleep(0.2)
+
+    def test_burst_is_coalesced(self):
+        for _ in range(5):
+            os.kill(os.getpid(), signal.SIGUSR1)
+        # The handler does not run in the main thread, the burst is not re-entered.
+        deadline = time.time() + 5
+        while len(self.calls) < 1 and time.time() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.5)
+        self.assertIn(len(self.calls), (1, 2))
+        self.assertEqual(set(self.calls), set(["signal-dispatcher"]))
+        stats = self.dispatcher.stats()[signal.SIGUSR1]
+        self.assertEqual(stats.received, 5)
+        self.assertEqual(stats.dispatched, len(self.calls))
+        self.assertEqual(stats.dropped, 5 - len(self.calls))
+        self.assertLess(stats.maxLatency, 1)
+
+    def test_stop(self):
+        (rfd, wfd) = self.dispatcher._pipe
+        thread = self.dispatcher._thread
+        self.dispatcher.stop()
+        # The thread is gone before its descriptors could get reused.
+        self.assertFalse(thread.is_alive())
+        self.assertFalse(_isOpen(rfd))
+        self.assertFalse(_isOpen(wfd))
+        self.assertEqual(signal.getsignal(signal.SIGUSR1), signal.SIG_DFL)